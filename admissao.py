@@ -0,0 +1,71 @@
+# admissao.py
+# Controle de admissão do servidor: limites de taxa com token bucket.
+#
+# Uma requisição fora do limite é recusada na hora com {"status": "busy",
+# "retry_after": ms} em vez de entrar na fila; o cliente espera retry_after
+# antes de repetir. Assim a sobrecarga aparece como recusas rápidas, e não
+# como uma fila (e uma latência) que cresce sem limite.
+import collections
+import threading
+import time
+
+
+class TokenBucket:
+    """`rate` fichas por segundo, acumulando até `burst`. Cada requisição gasta uma."""
+
+    def __init__(self, rate, burst):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+
+    def take(self, now):
+        """Gasta uma ficha e retorna 0, ou retorna os segundos até haver uma (sem gastar)."""
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+        if self.tokens >= 1:
+            self.tokens -= 1
+            return 0.0
+        return (1 - self.tokens) / self.rate
+
+
+class RateLimiter:
+    """
+    Um TokenBucket por chave (cliente ou serviço), criado no primeiro uso.
+    Guarda no máximo `max_keys` chaves: a usada há mais tempo sai primeiro
+    (e volta com o bucket cheio). Com rate <= 0 tudo é admitido.
+    """
+
+    def __init__(self, rate, burst=None, max_keys=10000):
+        self.rate = rate
+        self.burst = max(1.0, burst if burst else rate)
+        self.max_keys = max_keys
+        self._lock = threading.Lock()
+        self._buckets = collections.OrderedDict()
+
+    def take(self, key):
+        """0 se a requisição de `key` é admitida; senão, os segundos até a próxima ficha."""
+        if self.rate <= 0:
+            return 0.0
+        with self._lock:
+            bucket = self._buckets.get(key)
+            if bucket is None:
+                bucket = self._buckets[key] = TokenBucket(self.rate, self.burst)
+                if len(self._buckets) > self.max_keys:
+                    self._buckets.popitem(last=False)
+            else:
+                self._buckets.move_to_end(key)
+            return bucket.take(time.monotonic())
+
+
+def parse_service_rates(spec):
+    """
+    "publish=500,history=100:200" -> {"publish": (500, None), "history": (100, 200)}
+    (serviço=taxa[:rajada]; sem rajada, ela é igual à taxa).
+    """
+    rates = {}
+    for item in filter(None, (part.strip() for part in spec.split(","))):
+        service, _, value = item.partition("=")
+        rate, _, burst = value.partition(":")
+        rates[service.strip()] = (float(rate), float(burst) if burst else None)
+    return rates
@@ -0,0 +1,559 @@
+# benchmark.py
+# Gerador de carga e benchmark dos caminhos REQ/REP (broker -> servidor) e PUB/SUB (proxy).
+#
+# Por padrão sobe cópias locais de broker.py, proxy.py, referencia.py e
+# servidor.py (portas próprias e dados em um diretório temporário, fora de
+# /app/data) e roda os cenários:
+#
+#   login    - tempestade de logins com nomes únicos
+#   channel  - criação de canais
+#   message  - mensagens privadas para um usuário existente
+#   batch    - as mesmas mensagens privadas, --batch-size por requisição 'batch'
+#   pipeline - as mesmas mensagens privadas pela biblioteca cliente.py (DEALER),
+#              com --pipeline requisições em andamento por cliente
+#   publish  - publicação em canal com N assinantes SUB, medindo também a
+#              latência de ponta a ponta (envio do publish -> entrega no SUB)
+#
+# Exemplos:
+#   python benchmark.py
+#   python benchmark.py --scenarios login,publish --clients 16 --requests 1000
+#   python benchmark.py --servers 3 --runtime asyncio --subscribers 1,10,100
+#   python benchmark.py --wire compact   # envelope compacto em vez do mapa
+#   python benchmark.py --scenarios message,pipeline --pipeline 32
+#   python benchmark.py --proxy-shards 2 --broker-shards 2   # modo escalado (shards.py)
+#   python benchmark.py --external   # usa os serviços do docker compose (localhost)
+import argparse
+import asyncio
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from datetime import datetime
+
+import msgpack
+import zmq
+
+from cliente import AsyncChatClient
+from protocolo import decode, encode_compact
+
+SCENARIOS = ("login", "channel", "message", "batch", "pipeline", "publish")
+REQUEST_TIMEOUT = 10.0
+READY_TIMEOUT = 30.0
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+
+# --- Serviços Locais ---
+class LocalCluster:
+    """
+    Sobe cópias dos serviços como subprocessos em `port_base`..`port_base + 8`
+    (P2P dos servidores a partir de `port_base + 10`; shards extras do proxy e
+    do broker a partir de `port_base + 200`). Os dados e os logs ficam em um
+    diretório temporário, apagado no fim (a menos de keep_data).
+
+    Com shards, `frontend` e `xpub` listam os endereços de todos, separados por vírgula.
+    """
+
+    def __init__(self, servers=1, runtime="threads", port_base=25555, keep_data=False, extra_env=None,
+                 proxy_shards=1, broker_shards=1):
+        self.servers = servers
+        self.runtime = runtime
+        self.proxy_shards = proxy_shards
+        self.broker_shards = broker_shards
+        self.keep_data = keep_data
+        self.extra_env = extra_env or {}
+        self.workdir = tempfile.mkdtemp(prefix="chat-bench-")
+        self.processes = []
+
+        self.xsub = f"tcp://127.0.0.1:{port_base}"
+        self.xpub = f"tcp://127.0.0.1:{port_base + 1}"
+        self.frontend = f"tcp://127.0.0.1:{port_base + 2}"
+        self.backend = f"tcp://127.0.0.1:{port_base + 3}"
+        self.reference = f"tcp://127.0.0.1:{port_base + 5}"
+        self.reference_pub = f"tcp://127.0.0.1:{port_base + 4}"
+        self.internal_xsub = f"tcp://127.0.0.1:{port_base + 6}"
+        self.internal_xpub = f"tcp://127.0.0.1:{port_base + 7}"
+        self.replay = f"tcp://127.0.0.1:{port_base + 8}"
+        self.p2p_base = port_base + 10
+        # Shard k >= 1: proxy em +0..+2 (xsub, xpub, replay) e broker em +3..+4 (frontend, backend)
+        shard_port = lambda k, offset: port_base + 200 + 10 * (k - 1) + offset
+        self.proxy_endpoints = [(self.xsub, self.xpub, self.replay)] + [
+            tuple(f"tcp://127.0.0.1:{shard_port(k, o)}" for o in range(3)) for k in range(1, proxy_shards)]
+        self.broker_endpoints = [(self.frontend, self.backend)] + [
+            tuple(f"tcp://127.0.0.1:{shard_port(k, o)}" for o in (3, 4)) for k in range(1, broker_shards)]
+        self.frontend = ",".join(frontend for frontend, _ in self.broker_endpoints)
+        self.xpub = ",".join(xpub for _, xpub, _ in self.proxy_endpoints)
+
+    def _spawn(self, script, name, env):
+        log = open(os.path.join(self.workdir, f"{name}.log"), "w")
+        process = subprocess.Popen(
+            [sys.executable, os.path.join(BASE_DIR, script)],
+            cwd=BASE_DIR, env={**os.environ, **self.extra_env, **env, "PYTHONUNBUFFERED": "1"},
+            stdout=log, stderr=subprocess.STDOUT,
+        )
+        self.processes.append((process, log))
+
+    def start(self):
+        bind = lambda address: address.replace("127.0.0.1", "*")
+        for k, (xsub, xpub, replay) in enumerate(self.proxy_endpoints):
+            self._spawn("proxy.py", f"proxy{k}" if k else "proxy", {
+                "PROXY_XSUB_BIND": bind(xsub), "PROXY_XPUB_BIND": bind(xpub), "PROXY_REPLAY_BIND": bind(replay),
+                "PROXY_INTERNAL_XSUB_BIND": bind(self.internal_xsub), "PROXY_INTERNAL_XPUB_BIND": bind(self.internal_xpub),
+                "PROXY_SHARD": str(k), "PROXY_SHARDS": str(self.proxy_shards),
+                "PROXY_ADVERTISE_HOST": "127.0.0.1", "REFERENCE_ADDRESS": self.reference,
+            })
+        self._spawn("referencia.py", "referencia", {
+            "REFERENCE_BIND": bind(self.reference), "REFERENCE_PUB_BIND": bind(self.reference_pub),
+        })
+        for k, (frontend, backend) in enumerate(self.broker_endpoints):
+            self._spawn("broker.py", f"broker{k}" if k else "broker", {
+                "BROKER_FRONTEND_BIND": bind(frontend), "BROKER_BACKEND_BIND": bind(backend),
+                "BROKER_SHARD": str(k), "BROKER_SHARDS": str(self.broker_shards),
+                "BROKER_ADVERTISE_HOST": "127.0.0.1", "REFERENCE_ADDRESS": self.reference,
+            })
+        for i in range(self.servers):
+            name = f"bench{i + 1}"
+            self._spawn("servidor.py", name, {
+                "SERVER_NAME": name, "SERVER_RUNTIME": self.runtime,
+                "DATA_PATH": os.path.join(self.workdir, name),
+                "P2P_HOST": "127.0.0.1", "P2P_PORT": str(self.p2p_base + i),
+                "PROXY_PUB_ADDRESS": self.xsub, "PROXY_SUB_ADDRESS": self.proxy_endpoints[0][1],
+                "PROXY_INTERNAL_PUB_ADDRESS": self.internal_xsub, "PROXY_INTERNAL_SUB_ADDRESS": self.internal_xpub,
+                "REFERENCE_ADDRESS": self.reference, "REFERENCE_PUB_ADDRESS": self.reference_pub,
+                "BROKER_ADDRESS": self.backend,
+                "PROXY_SHARDS": str(self.proxy_shards), "BROKER_SHARDS": str(self.broker_shards),
+            })
+        try:
+            wait_ready(self.frontend)
+        except Exception:
+            self.stop()
+            raise
+        return self
+
+    def stop(self):
+        for process, _ in self.processes:
+            process.terminate()
+        for process, log in self.processes:
+            try:
+                process.wait(5)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            log.close()
+        if self.keep_data:
+            print(f"Dados e logs mantidos em {self.workdir}")
+        else:
+            shutil.rmtree(self.workdir, ignore_errors=True)
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc):
+        self.stop()
+
+
+# --- Cliente ---
+class Client:
+    """Cliente REQ síncrono com relógio lógico, como os clientes do projeto."""
+
+    compact = False # Envelope compacto (protocolo.py) em vez do mapa; ver --wire
+
+    def __init__(self, context, address):
+        self.context = context
+        self.address = address
+        self.clock = 0
+        self.socket = None
+        self._connect()
+
+    def _connect(self):
+        if self.socket is not None:
+            self.socket.close()
+        self.socket = self.context.socket(zmq.REQ)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.setsockopt(zmq.RCVTIMEO, int(REQUEST_TIMEOUT * 1000))
+        for address in self.address.split(","): # Vários brokers (shards): o REQ alterna entre eles
+            self.socket.connect(address)
+
+    def call(self, service, **data):
+        """Envia a requisição e retorna a resposta, ou None em caso de timeout."""
+        self.clock += 1
+        if self.compact:
+            packed = encode_compact({"service": service, "data": {**data, "clock": self.clock}}, time.time_ns() // 1_000_000)
+        else:
+            packed = msgpack.packb({"service": service, "data": {**data, "timestamp": datetime.now().isoformat(), "clock": self.clock}})
+        self.socket.send(packed)
+        try:
+            reply, _ = decode(self.socket.recv())
+        except zmq.Again:
+            self._connect() # O REQ fica travado depois de um timeout
+            return None
+        self.clock = max(self.clock, reply.get("data", {}).get("clock", 0))
+        return reply
+
+    def close(self):
+        self.socket.close()
+
+
+def is_ok(reply):
+    if reply is None or reply.get("data", {}).get("status") not in ("OK", "sucesso"):
+        return False
+    results = reply["data"].get("results")
+    return results is None or all(r.get("status") in ("OK", "sucesso") for r in results)
+
+
+def wait_ready(address, timeout=READY_TIMEOUT):
+    """Espera até o broker ter um servidor respondendo."""
+    context = zmq.Context.instance()
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        client = Client(context, address)
+        client.socket.setsockopt(zmq.RCVTIMEO, 1000)
+        try:
+            if client.call("users") is not None:
+                return
+        finally:
+            client.close()
+    raise RuntimeError(f"Nenhum servidor respondeu em {address} depois de {timeout:.0f}s")
+
+
+# --- Medição ---
+def percentile(sorted_values, p):
+    if not sorted_values:
+        return float("nan")
+    return sorted_values[min(len(sorted_values) - 1, int(len(sorted_values) * p / 100))]
+
+
+def summarize(name, latencies_ns, elapsed, errors, **extra):
+    latencies = sorted(latencies_ns)
+    return {
+        "scenario": name,
+        "requests": len(latencies) + errors,
+        "errors": errors,
+        "rps": len(latencies) / elapsed if elapsed > 0 else 0.0,
+        "p50_ms": percentile(latencies, 50) / 1e6,
+        "p99_ms": percentile(latencies, 99) / 1e6,
+        "p999_ms": percentile(latencies, 99.9) / 1e6,
+        **extra,
+    }
+
+
+def run_clients(address, clients, requests, make_call):
+    """
+    Roda `clients` threads, cada uma com seu REQ, fazendo `requests` chamadas
+    `make_call(client, client_id, i)`. Retorna (latências em ns, segundos, erros).
+    """
+    context = zmq.Context.instance()
+    latencies = []
+    errors = [0]
+    lock = threading.Lock()
+    start_barrier = threading.Barrier(clients + 1)
+
+    def worker(client_id):
+        client = Client(context, address)
+        local, local_errors = [], 0
+        start_barrier.wait()
+        for i in range(requests):
+            t0 = time.perf_counter_ns()
+            reply = make_call(client, client_id, i)
+            t1 = time.perf_counter_ns()
+            if is_ok(reply):
+                local.append(t1 - t0)
+            else:
+                local_errors += 1
+        client.close()
+        with lock:
+            latencies.extend(local)
+            errors[0] += local_errors
+
+    threads = [threading.Thread(target=worker, args=(c,)) for c in range(clients)]
+    for t in threads:
+        t.start()
+    start_barrier.wait()
+    started = time.perf_counter()
+    for t in threads:
+        t.join()
+    return latencies, time.perf_counter() - started, errors[0]
+
+
+# --- Cenários REQ/REP ---
+def login_receiver(address, user, servers):
+    """Faz o login do destinatário das mensagens e espera ele chegar a todas as réplicas."""
+    setup = Client(zmq.Context.instance(), address)
+    setup.call("login", user=user)
+    wait_replicated(setup, "users", user, servers)
+    setup.close()
+
+
+def wait_replicated(client, service, name, servers, timeout=READY_TIMEOUT):
+    """
+    Espera `name` aparecer na lista de `service` ("users" ou "channels") de
+    todas as réplicas, para a medição não esbarrar no atraso da replicação
+    (a escrita seria atendida por um servidor que ainda não tem o nome). Sem
+    carga, o broker manda cada requisição ao servidor usado há mais tempo,
+    então 2 x `servers` respostas seguidas com o nome passam por todos (com
+    folga para os shards do broker).
+    """
+    deadline = time.monotonic() + timeout
+    streak = 0
+    while streak < 2 * servers:
+        if time.monotonic() > deadline:
+            raise RuntimeError(f"'{name}' não chegou a todas as réplicas em {timeout:.0f}s")
+        reply = client.call(service)
+        if reply is not None and name in reply.get("data", {}).get(service, []):
+            streak += 1
+        else:
+            streak = 0
+            time.sleep(0.05)
+
+
+def bench_login(address, clients, requests, run_id):
+    return summarize("login", *run_clients(
+        address, clients, requests,
+        lambda c, cid, i: c.call("login", user=f"{run_id}-u{cid}-{i}")
+    ))
+
+
+def bench_channel(address, clients, requests, run_id):
+    return summarize("channel", *run_clients(
+        address, clients, requests,
+        lambda c, cid, i: c.call("channel", channel=f"{run_id}-c{cid}-{i}")
+    ))
+
+
+def bench_message(address, clients, requests, run_id, servers=1):
+    receiver = f"{run_id}-dst"
+    login_receiver(address, receiver, servers)
+    return summarize("message", *run_clients(
+        address, clients, requests,
+        lambda c, cid, i: c.call("message", src=f"{run_id}-src{cid}", dst=receiver, message=f"msg {i}")
+    ))
+
+
+def bench_batch(address, clients, requests, run_id, batch_size, servers=1):
+    """Mensagens privadas em lotes: `requests` mensagens por cliente, `batch_size` por requisição."""
+    receiver = f"{run_id}-bdst"
+    login_receiver(address, receiver, servers)
+
+    def call(c, cid, i):
+        ops = [{"service": "message", "data": {"src": f"{run_id}-src{cid}", "dst": receiver, "message": f"msg {i}.{j}"}}
+               for j in range(batch_size)]
+        return c.call("batch", ops=ops)
+
+    result = summarize(f"batch-{batch_size}", *run_clients(address, clients, max(1, requests // batch_size), call))
+    result["ops_per_s"] = result["rps"] * batch_size
+    return result
+
+
+def bench_pipeline(address, clients, requests, run_id, depth, servers=1):
+    """
+    Mensagens privadas pela biblioteca cliente.py: cada cliente (um DEALER)
+    mantém até `depth` requisições em andamento, em vez de uma por vez como o REQ.
+    """
+    async def client_run(cid, latencies, errors):
+        async with AsyncChatClient(address, timeout=REQUEST_TIMEOUT, compact=Client.compact) as chat:
+            window = asyncio.Semaphore(depth)
+
+            async def send(i):
+                async with window:
+                    t0 = time.perf_counter_ns()
+                    try:
+                        reply = await chat.message(receiver, f"msg {i}", src=f"{run_id}-src{cid}")
+                    except TimeoutError:
+                        reply = None
+                    if is_ok(reply):
+                        latencies.append(time.perf_counter_ns() - t0)
+                    else:
+                        errors.append(i)
+
+            await asyncio.gather(*(send(i) for i in range(requests)))
+
+    async def main():
+        latencies, errors = [], []
+        started = time.perf_counter()
+        await asyncio.gather(*(client_run(c, latencies, errors) for c in range(clients)))
+        return latencies, time.perf_counter() - started, len(errors)
+
+    receiver = f"{run_id}-pdst"
+    login_receiver(address, receiver, servers)
+    return summarize(f"pipeline-{depth}", *asyncio.run(main()))
+
+
+# --- Cenário PUB/SUB ---
+class Subscribers:
+    """
+    `count` sockets SUB no XPUB do proxy, inscritos no tópico do canal.
+    Uma thread recebe de todos e registra a latência de entrega de cada
+    mensagem (o texto da mensagem carrega o instante de envio).
+    """
+
+    def __init__(self, xpub_address, channel, count):
+        self.context = zmq.Context.instance()
+        self.sockets = []
+        for _ in range(count):
+            socket = self.context.socket(zmq.SUB)
+            socket.setsockopt(zmq.LINGER, 0)
+            for address in xpub_address.split(","): # Todos os shards do proxy
+                socket.connect(address)
+            socket.setsockopt_string(zmq.SUBSCRIBE, channel)
+            self.sockets.append(socket)
+        self.latencies = []
+        self.probes = set() # Índices dos assinantes que já receberam uma sonda
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._loop, daemon=True)
+        self._thread.start()
+
+    def _loop(self):
+        poller = zmq.Poller()
+        for socket in self.sockets:
+            poller.register(socket, zmq.POLLIN)
+        index = {socket: i for i, socket in enumerate(self.sockets)}
+        while not self._stop.is_set():
+            for socket, _ in poller.poll(100):
+                while True:
+                    try:
+                        _, payload = socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    received = time.perf_counter_ns()
+                    message = msgpack.unpackb(payload, raw=False).get("message", "")
+                    if message.startswith("probe"):
+                        self.probes.add(index[socket])
+                    else:
+                        self.latencies.append(received - int(message))
+
+    def all_subscribed(self):
+        return len(self.probes) == len(self.sockets)
+
+    def close(self):
+        self._stop.set()
+        self._thread.join()
+        for socket in self.sockets:
+            socket.close()
+
+
+def bench_publish(address, xpub_address, clients, requests, run_id, subscriber_count, servers=1):
+    channel = f"{run_id}-pub{subscriber_count}"
+    setup = Client(zmq.Context.instance(), address)
+    setup.call("channel", channel=channel)
+    wait_replicated(setup, "channels", channel, servers)
+    subscribers = Subscribers(xpub_address, channel, subscriber_count)
+
+    # A inscrição no XPUB é assíncrona: publica sondas até todos os SUB as receberem
+    deadline = time.monotonic() + READY_TIMEOUT
+    while not subscribers.all_subscribed():
+        if time.monotonic() > deadline:
+            subscribers.close()
+            raise RuntimeError(f"Assinantes de '{channel}' não receberam as sondas")
+        setup.call("publish", channel=channel, user="bench", message="probe")
+        time.sleep(0.05)
+    setup.close()
+
+    latencies, elapsed, errors = run_clients(
+        address, clients, requests,
+        lambda c, cid, i: c.call("publish", channel=channel, user=f"{run_id}-p{cid}",
+                                 message=str(time.perf_counter_ns()))
+    )
+    expected = (len(latencies) + errors) * subscriber_count
+    # Espera as entregas pendentes (ou 2s sem novidades)
+    last, stalled = -1, time.monotonic()
+    while len(subscribers.latencies) < expected and time.monotonic() - stalled < 2.0:
+        if len(subscribers.latencies) != last:
+            last, stalled = len(subscribers.latencies), time.monotonic()
+        time.sleep(0.05)
+    subscribers.close()
+
+    delivery = sorted(subscribers.latencies)
+    return summarize(
+        f"publish x{subscriber_count}", latencies, elapsed, errors,
+        subscribers=subscriber_count,
+        delivered=len(delivery), expected=expected,
+        delivery_p50_ms=percentile(delivery, 50) / 1e6,
+        delivery_p99_ms=percentile(delivery, 99) / 1e6,
+        delivery_p999_ms=percentile(delivery, 99.9) / 1e6,
+    )
+
+
+# --- Relatório ---
+def print_results(results):
+    print(f"\n{'cenário':<16}{'reqs':>8}{'erros':>7}{'req/s':>10}{'p50 ms':>9}{'p99 ms':>9}{'p999 ms':>9}")
+    for r in results:
+        print(f"{r['scenario']:<16}{r['requests']:>8}{r['errors']:>7}{r['rps']:>10.0f}"
+              f"{r['p50_ms']:>9.2f}{r['p99_ms']:>9.2f}{r['p999_ms']:>9.2f}")
+
+    for r in results:
+        if "ops_per_s" in r:
+            print(f"{r['scenario']}: {r['ops_per_s']:.0f} operações/s")
+
+    deliveries = [r for r in results if "delivered" in r]
+    if deliveries:
+        print(f"\n{'entrega PUB/SUB':<16}{'assin.':>8}{'entregues':>12}{'p50 ms':>9}{'p99 ms':>9}{'p999 ms':>9}")
+        for r in deliveries:
+            print(f"{r['scenario']:<16}{r['subscribers']:>8}{r['delivered']:>6}/{r['expected']:<5}"
+                  f"{r['delivery_p50_ms']:>9.2f}{r['delivery_p99_ms']:>9.2f}{r['delivery_p999_ms']:>9.2f}")
+
+
+def run(args, frontend, xpub):
+    run_id = f"b{int(time.time())}"
+    scenarios = [s for s in args.scenarios.split(",") if s]
+    results = []
+    for scenario in scenarios:
+        print(f"Rodando '{scenario}' ({args.clients} clientes x {args.requests} requisições)...")
+        match scenario:
+            case "login":
+                results.append(bench_login(frontend, args.clients, args.requests, run_id))
+            case "channel":
+                results.append(bench_channel(frontend, args.clients, args.requests, run_id))
+            case "message":
+                results.append(bench_message(frontend, args.clients, args.requests, run_id, args.servers))
+            case "batch":
+                results.append(bench_batch(frontend, args.clients, args.requests, run_id, args.batch_size, args.servers))
+            case "pipeline":
+                results.append(bench_pipeline(frontend, args.clients, args.requests, run_id, args.pipeline, args.servers))
+            case "publish":
+                for count in (int(n) for n in args.subscribers.split(",")):
+                    results.append(bench_publish(frontend, xpub, args.clients, args.requests, run_id, count, args.servers))
+            case _:
+                raise SystemExit(f"Cenário desconhecido: {scenario} (opções: {', '.join(SCENARIOS)})")
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark dos serviços do chat (REQ/REP e PUB/SUB).")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Cenários separados por vírgula.")
+    parser.add_argument("--clients", type=int, default=8, help="Clientes REQ concorrentes.")
+    parser.add_argument("--requests", type=int, default=500, help="Requisições por cliente.")
+    parser.add_argument("--batch-size", type=int, default=50, help="Operações por requisição no cenário batch.")
+    parser.add_argument("--pipeline", type=int, default=16, help="Requisições em andamento por cliente no cenário pipeline.")
+    parser.add_argument("--subscribers", default="1,10,50", help="Quantidades de assinantes no cenário publish.")
+    parser.add_argument("--servers", type=int, default=1, help="Réplicas do servidor (cópias locais; com --external, quantas estão rodando).")
+    parser.add_argument("--runtime", default="threads", choices=("threads", "asyncio"), help="SERVER_RUNTIME dos servidores.")
+    parser.add_argument("--proxy-shards", type=int, default=1, help="Cópias (shards) locais do proxy.")
+    parser.add_argument("--broker-shards", type=int, default=1, help="Cópias (shards) locais do broker.")
+    parser.add_argument("--port-base", type=int, default=25555, help="Primeira porta usada pelas cópias locais.")
+    parser.add_argument("--keep-data", action="store_true", help="Mantém o diretório com dados e logs.")
+    parser.add_argument("--external", action="store_true", help="Usa serviços já rodando em vez de subir cópias.")
+    parser.add_argument("--broker", default="tcp://localhost:5557", help="Frontend(s) do broker, separados por vírgula (com --external).")
+    parser.add_argument("--proxy", default="tcp://localhost:5556", help="XPUB(s) do proxy, separados por vírgula (com --external).")
+    parser.add_argument("--wire", default="map", choices=("map", "compact"), help="Formato das requisições (ver protocolo.py).")
+    parser.add_argument("--json", help="Grava os resultados neste arquivo JSON.")
+    args = parser.parse_args()
+    Client.compact = args.wire == "compact"
+
+    if args.external:
+        wait_ready(args.broker)
+        results = run(args, args.broker, args.proxy)
+    else:
+        with LocalCluster(args.servers, args.runtime, args.port_base, args.keep_data,
+                          proxy_shards=args.proxy_shards, broker_shards=args.broker_shards) as cluster:
+            results = run(args, cluster.frontend, cluster.xpub)
+
+    print_results(results)
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump(results, f, indent=2)
+
+
+if __name__ == "__main__":
+    main()
@@ -1,15 +1,543 @@
+# broker.py
+# Broker REQ/REP com balanceamento por carga (padrão "least-recently-used worker").
+import bisect
+import collections
+import hashlib
+import os
+import socket
+import time
+from datetime import datetime
+
+import msgpack
 import zmq
 
-context = zmq.Context()
+from logs import setup_logging, get_logger
+from metricas import Counter, Gauge, start_metrics_server
+from protocolo import (
+    WORKER_READY, WORKER_HEARTBEAT, WORKER_REQUEST, WORKER_REPLY,
+    HEARTBEAT_INTERVAL, HEARTBEAT_LIVENESS,
+    decode, encode_compact,
+)
+from shards import advertised, announce_shard
+
+# Endereços (configuráveis para rodar cópias locais, ex.: benchmark.py)
+FRONTEND_BIND = os.environ.get("BROKER_FRONTEND_BIND", "tcp://*:5557")
+BACKEND_BIND = os.environ.get("BROKER_BACKEND_BIND", "tcp://*:5558")
+REFERENCE_ADDRESS = os.environ.get("REFERENCE_ADDRESS", "tcp://referencia:5560")
+
+# Tamanho máximo da fila de requisições esperando um servidor livre.
+# Com a fila cheia o broker para de ler clientes (backpressure nos sockets).
+QUEUE_MAX = int(os.environ.get("BROKER_QUEUE_MAX", "1000"))
+# Descarte por profundidade da fila: com BROKER_SHED_DEPTH requisições na
+# fila, as novas são recusadas na hora com {"status": "busy", "retry_after": ms}
+# (o tempo estimado para a fila esvaziar), em vez de esperar. 0 desliga.
+SHED_DEPTH = int(os.environ.get("BROKER_SHED_DEPTH", "500"))
+RETRY_AFTER_MIN_MS = 50
+RETRY_AFTER_MAX_MS = 5000
+FRONTEND_BATCH = 256 # Requisições lidas dos clientes por volta do loop
+
+# Roteamento: "load" (padrão) envia cada requisição ao servidor menos ocupado;
+# "hash" envia as requisições com chave (user, channel, dst) ao servidor dono
+# da chave no anel de hash consistente. Leituras continuam indo para qualquer um.
+ROUTING = os.environ.get("BROKER_ROUTING", "load")
+RING_VNODES = 64
+MEMBERSHIP_INTERVAL = float(os.environ.get("BROKER_MEMBERSHIP_INTERVAL", "2.0"))
+
+# Shards (ver shards.py): com BROKER_SHARDS > 1, cada cópia é um broker
+# completo que se anuncia ao referencia; os servidores conectam-se a todas.
+SHARD = int(os.environ.get("BROKER_SHARD", "0"))
+SHARDS = int(os.environ.get("BROKER_SHARDS", "1"))
+ADVERTISE_HOST = os.environ.get("BROKER_ADVERTISE_HOST", socket.gethostname())
+
+# Campo de "data" que define o dono de cada serviço de escrita
+KEY_FIELDS = {
+    "login": "user",
+    "channel": "channel",
+    "publish": "channel",
+    "message": "dst",
+}
+# Escritas cuja unicidade só o dono da chave verifica (ver batch_owner)
+UNIQUE_SERVICES = ("login", "channel")
+# Prefixo da identidade das partes de um lote dividido (ver split_batch)
+SPLIT_PREFIX = b"\xffbatch:"
+
+
+class Worker:
+    """Um servidor conectado ao backend, com quantas requisições ele aceita em paralelo."""
+
+    def __init__(self, identity, name, capacity):
+        self.identity = identity
+        self.name = name
+        self.capacity = capacity
+        # Envelope do cliente -> requisições em andamento, para responder a cada
+        # uma no seu envelope e formato se o servidor cair (ver drop_worker)
+        self.in_flight = {}
+        self.in_flight_total = 0
+        self.last_dispatch = 0.0
+        self.expiry = time.monotonic() + HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
+
+    def has_capacity(self):
+        return self.in_flight_total < self.capacity
+
+
+class HashRing:
+    """Anel de hash consistente com nós virtuais: adicionar um servidor move ~1/N das chaves."""
+
+    def __init__(self, names=()):
+        self._points = []
+        self._owners = []
+        points = sorted(
+            (self._hash(f"{name}#{i}"), name)
+            for name in names for i in range(RING_VNODES)
+        )
+        for point, name in points:
+            self._points.append(point)
+            self._owners.append(name)
+
+    @staticmethod
+    def _hash(value):
+        return int.from_bytes(hashlib.md5(value.encode("utf-8")).digest()[:8], "big")
+
+    def owner(self, key):
+        if not self._points:
+            return None
+        i = bisect.bisect(self._points, self._hash(key)) % len(self._points)
+        return self._owners[i]
+
+
+log = get_logger("broker")
+
+# --- Métricas ---
+REQUESTS = Counter("broker_requests_total", "Requisições recebidas de clientes.")
+REPLIES = Counter("broker_replies_total", "Respostas devolvidas aos clientes.")
+WORKERS_DROPPED = Counter("broker_workers_dropped_total", "Servidores removidos por falta de heartbeat.")
+SHED = Counter("broker_shed_total", "Requisições recusadas com 'busy' pela fila cheia.")
+QUEUE_DEPTH = Gauge("broker_queue_depth", "Requisições esperando um servidor livre.")
+WORKERS_READY = Gauge("broker_workers", "Servidores conectados ao backend.")
+IN_FLIGHT = Gauge("broker_in_flight", "Requisições em andamento nos servidores.")
+QUEUE_DEPTH.set_function(lambda: queued)
+WORKERS_READY.set_function(lambda: len(workers))
+IN_FLIGHT.set_function(lambda: sum(w.in_flight_total for w in list(workers.values())))
+
+workers = {} # identidade -> Worker
+queue = collections.deque() # [envelope do cliente..., b"", requisição] sem dono
+owner_queues = collections.defaultdict(collections.deque) # nome do servidor -> requisições para ele
+queued = 0 # Total de requisições nas filas
+
+reply_rate = 0.0 # Respostas por segundo (média móvel), para estimar o retry_after
+replies_counted = 0 # Respostas desde a última atualização de reply_rate
+
+live_names = None # Servidores ativos segundo o referencia (None = ainda não sabemos)
+ring = HashRing()
+
+
+def rebuild_ring():
+    """Refaz o anel com os servidores prontos no broker que o referencia considera ativos."""
+    global ring
+    names = {worker.name for worker in workers.values()}
+    if live_names is not None and names & live_names:
+        names &= live_names
+    ring = HashRing(sorted(names))
+
+
+def request_owner(client_frames):
+    """Nome do servidor dono da chave da requisição, ou None se ela pode ir para qualquer um."""
+    if ROUTING != "hash":
+        return None
+    try:
+        request, _ = decode(client_frames[-1]) # Mapa ou envelope compacto
+        if request.get("service") == "batch":
+            return batch_owner(request["data"]["ops"])
+        return key_owner(request)
+    except Exception:
+        return None
+
+def key_owner(request):
+    field = KEY_FIELDS.get(request.get("service"))
+    key = request.get("data", {}).get(field) if field else None
+    return ring.owner(str(key)) if key is not None else None
+
+def batch_owner(ops):
+    """
+    Um lote vai ao dono dos seus logins e canais novos, que só podem ter a
+    unicidade verificada no dono; publish e message rodam em qualquer um.
+    Sem nenhum deles, o lote vai ao dono da primeira operação. (Lotes com
+    donos diferentes são divididos antes, em split_batch.)
+    """
+    for op in ops:
+        if op.get("service") in UNIQUE_SERVICES:
+            return key_owner(op)
+    return key_owner(ops[0])
+
+def unique_owners(ops):
+    return {key_owner(op) for op in ops if isinstance(op, dict) and op.get("service") in UNIQUE_SERVICES}
+
+
+class SplitBatch:
+    """Lote dividido por dono: junta os resultados das partes na ordem das operações."""
+
+    def __init__(self, envelope, compact, size, parts):
+        self.envelope = envelope # Quadros do cliente antes da requisição
+        self.compact = compact
+        self.results = [None] * size
+        self.indexes = {} # identidade da parte -> posições das suas operações no lote
+        self.remaining = parts
+        self.clock = 0
+
+    def complete(self, part_id, data):
+        """Guarda a resposta de uma parte; retorna True quando todas chegaram."""
+        indexes = self.indexes.pop(part_id)
+        results = data.get("results")
+        for n, i in enumerate(indexes):
+            if isinstance(results, list) and n < len(results):
+                self.results[i] = results[n]
+            else: # A parte inteira falhou (ex.: busy, servidor indisponível)
+                self.results[i] = {k: v for k, v in data.items() if k not in ("timestamp", "results")}
+        self.clock = max(self.clock, data.get("clock") or 0)
+        self.remaining -= 1
+        return self.remaining == 0
+
+    def reply(self):
+        data = {"status": "OK", "results": self.results, "clock": self.clock}
+        return self.envelope + [encode_reply({"service": "batch", "data": data}, self.compact)]
+
+
+splits = {} # identidade da parte -> SplitBatch
+next_split_id = 0
+
+
+def split_batch(client_frames):
+    """
+    Com roteamento por hash, um lote com logins ou canais de donos diferentes
+    vira um lote por dono: cada operação vai com as do dono da sua chave (as
+    sem chave vão com a primeira parte), e a resposta junta os resultados.
+    Retorna as partes [identidade, b"", requisição], ou None se o lote não
+    precisa ser dividido.
+    """
+    global next_split_id
+    if ROUTING != "hash":
+        return None
+    try:
+        request, compact = decode(client_frames[-1])
+        if request.get("service") != "batch":
+            return None
+        ops = request["data"]["ops"]
+        if len(unique_owners(ops)) < 2:
+            return None
+        groups = {} # dono -> posições, na ordem do lote
+        for i, op in enumerate(ops):
+            groups.setdefault(key_owner(op) if isinstance(op, dict) else None, []).append(i)
+    except Exception:
+        return None
+
+    if None in groups: # Sem chave: vai com a primeira parte
+        keyless = groups.pop(None)
+        first = next(iter(groups))
+        groups[first] = sorted(groups[first] + keyless)
+
+    split = SplitBatch(client_frames[:-1], compact, len(ops), len(groups))
+    request_id = request["data"].get("request_id")
+    parts = []
+    for n, indexes in enumerate(groups.values()):
+        part_id = SPLIT_PREFIX + str(next_split_id).encode()
+        next_split_id += 1
+        data = dict(request["data"], ops=[ops[i] for i in indexes])
+        if request_id is not None:
+            data["request_id"] = f"{request_id}/{n}" # Deduplicação por parte no servidor
+        split.indexes[part_id] = indexes
+        splits[part_id] = split
+        parts.append([part_id, b"", msgpack.packb({"service": "batch", "data": data})])
+    return parts
+
+
+def finish_part(frontend, part_id, reply_packed):
+    """Resposta de uma parte de lote; a do cliente sai quando todas chegam."""
+    split = splits.pop(part_id, None)
+    if split is None:
+        return
+    try:
+        data = msgpack.unpackb(reply_packed, raw=False).get("data", {})
+    except Exception:
+        data = {"status": "erro", "description": "Resposta inválida do servidor"}
+    if split.complete(part_id, data):
+        frontend.send_multipart(split.reply())
+
+
+def pick_worker():
+    """Servidor com menos requisições em andamento; empate vai para o usado há mais tempo."""
+    best = None
+    for worker in workers.values():
+        if not worker.has_capacity():
+            continue
+        if best is None or (worker.in_flight_total, worker.last_dispatch) < (best.in_flight_total, best.last_dispatch):
+            best = worker
+    return best
+
+
+def worker_by_name(name):
+    for worker in workers.values():
+        if worker.name == name:
+            return worker
+    return None
+
+
+def dispatch(backend, worker, client_frames):
+    worker.in_flight.setdefault(tuple(client_frames[:-1]), []).append(client_frames[-1])
+    worker.in_flight_total += 1
+    worker.last_dispatch = time.monotonic()
+    backend.send_multipart([worker.identity, WORKER_REQUEST] + client_frames)
+
+
+def route(backend, frontend, client_frames):
+    """Despacha a requisição agora ou a coloca na fila do dono (ou na fila geral)."""
+    global queued
+    parts = split_batch(client_frames)
+    if parts is not None:
+        for part in parts:
+            route(backend, frontend, part)
+        return
+    owner = request_owner(client_frames)
+    if owner is not None:
+        worker = worker_by_name(owner)
+        if worker is not None and worker.has_capacity() and not owner_queues.get(owner):
+            dispatch(backend, worker, client_frames)
+        else:
+            owner_queues[owner].append(client_frames)
+            queued += 1
+        return
+
+    worker = pick_worker() if not queue else None
+    if worker is not None:
+        dispatch(backend, worker, client_frames)
+    else:
+        queue.append(client_frames)
+        queued += 1
+
+
+def drain_queue(backend):
+    """Despacha o que está nas filas enquanto houver servidores com capacidade."""
+    global queued
+    for worker in list(workers.values()):
+        pending = owner_queues.get(worker.name)
+        while pending and worker.has_capacity():
+            dispatch(backend, worker, pending.popleft())
+            queued -= 1
+        if pending is not None and not pending:
+            del owner_queues[worker.name]
+
+    while queue:
+        worker = pick_worker()
+        if worker is None:
+            return
+        dispatch(backend, worker, queue.popleft())
+        queued -= 1
+
+
+def requeue_orphans():
+    """Requisições esperando por um dono que saiu do anel voltam a ser roteadas."""
+    global queued
+    for name in list(owner_queues):
+        if worker_by_name(name) is None:
+            orphans = owner_queues.pop(name)
+            queued -= len(orphans)
+            for client_frames in orphans:
+                owner = request_owner(client_frames)
+                target = owner_queues[owner] if owner is not None else queue
+                target.append(client_frames)
+                queued += 1
+
+
+def busy_reply(request_packed):
+    """
+    Recusa por fila cheia, no formato da requisição. retry_after é o tempo
+    para a fila atual esvaziar no ritmo recente de respostas.
+    """
+    retry_after = int(1000 * queued / reply_rate) if reply_rate > 0 else 1000 # Sem medida ainda: 1 s
+    return broker_reply(request_packed, {"status": "busy", "description": "Servidor sobrecarregado, tente novamente",
+                                         "retry_after": min(RETRY_AFTER_MAX_MS, max(RETRY_AFTER_MIN_MS, retry_after))})
+
+
+def broker_reply(request_packed, data):
+    """Resposta dada pelo próprio broker, no formato da requisição."""
+    data["clock"] = 0
+    try:
+        request, compact = decode(request_packed)
+    except Exception:
+        request, compact = {}, False
+    return encode_reply({"service": request.get("service", "erro"), "data": data}, compact)
+
+
+def encode_reply(reply, compact):
+    if compact:
+        return encode_compact(reply, time.time_ns() // 1_000_000)
+    reply["data"]["timestamp"] = datetime.now().isoformat()
+    return msgpack.packb(reply)
+
+
+def update_reply_rate(elapsed):
+    global reply_rate, replies_counted
+    if elapsed > 0:
+        reply_rate = 0.5 * reply_rate + 0.5 * (replies_counted / elapsed)
+    replies_counted = 0
+
+
+def drop_worker(frontend, worker):
+    """Remove um servidor morto e responde erro aos clientes que esperavam por ele."""
+    log.warning("Servidor '%s' sem heartbeat, removido (%d requisições perdidas)", worker.name, worker.in_flight_total)
+    WORKERS_DROPPED.inc()
+    del workers[worker.identity]
+    for envelope, requests in worker.in_flight.items():
+        for request_packed in requests:
+            reply = broker_reply(request_packed, {"status": "erro", "description": "Servidor indisponível, tente novamente"})
+            if envelope[0] in splits:
+                finish_part(frontend, envelope[0], reply)
+            else:
+                frontend.send_multipart(list(envelope) + [reply])
+    rebuild_ring()
+    requeue_orphans()
+
+
+def handle_backend(frontend, frames):
+    global replies_counted
+    identity, command = frames[0], frames[1]
+    worker = workers.get(identity)
+
+    if command == WORKER_READY:
+        info = msgpack.unpackb(frames[2], raw=False)
+        if worker is not None:
+            drop_worker(frontend, worker) # Reconexão: descarta o estado antigo
+        worker = Worker(identity, info.get("name"), max(1, int(info.get("capacity", 1))))
+        workers[identity] = worker
+        rebuild_ring()
+        log.info("Servidor '%s' pronto (capacidade %d)", worker.name, worker.capacity)
+        return
+
+    if worker is None:
+        return # Servidor desconhecido (ex.: removido por timeout); espera o próximo READY
+
+    worker.expiry = time.monotonic() + HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
+
+    if command == WORKER_REPLY:
+        client_frames = frames[2:]
+        client_id = client_frames[0]
+        envelope = tuple(client_frames[:-1])
+        requests = worker.in_flight.get(envelope)
+        if requests:
+            requests.pop(0)
+            worker.in_flight_total -= 1
+            if not requests:
+                del worker.in_flight[envelope]
+        if client_id.startswith(SPLIT_PREFIX):
+            finish_part(frontend, client_id, client_frames[-1])
+        else:
+            frontend.send_multipart(client_frames)
+        REPLIES.inc()
+        replies_counted += 1
+
+
+def handle_membership(reply_packed):
+    """Atualiza os servidores ativos a partir da resposta 'list' do referencia."""
+    global live_names
+    reply = msgpack.unpackb(reply_packed, raw=False)
+    names = {s["name"] for s in reply.get("data", {}).get("list", [])}
+    if names != live_names:
+        live_names = names
+        rebuild_ring()
+        requeue_orphans()
+
+
+def main():
+    setup_logging("broker")
+    start_metrics_server()
+    context = zmq.Context()
+
+    frontend = context.socket(zmq.ROUTER)
+    frontend.bind(FRONTEND_BIND)
+
+    backend = context.socket(zmq.ROUTER)
+    backend.bind(BACKEND_BIND)
+
+    poll_both = zmq.Poller()
+    poll_both.register(backend, zmq.POLLIN)
+    poll_both.register(frontend, zmq.POLLIN)
+    poll_backend = zmq.Poller()
+    poll_backend.register(backend, zmq.POLLIN)
+
+    # Lista de servidores ativos do referencia (só no roteamento por hash)
+    membership = None
+    next_membership = time.monotonic()
+    if ROUTING == "hash":
+        membership = context.socket(zmq.DEALER)
+        membership.setsockopt(zmq.LINGER, 0)
+        membership.connect(REFERENCE_ADDRESS)
+        for poller in (poll_both, poll_backend):
+            poller.register(membership, zmq.POLLIN)
+
+    if SHARDS > 1:
+        announce_shard(context, REFERENCE_ADDRESS, "broker", SHARD, SHARDS, {
+            "frontend": advertised(FRONTEND_BIND, ADVERTISE_HOST),
+            "backend": advertised(BACKEND_BIND, ADVERTISE_HOST),
+        })
+
+    log.info("Broker iniciado (shard %d/%d, clientes: %s, servidores: %s, roteamento: %s)...",
+             SHARD, SHARDS, FRONTEND_BIND, BACKEND_BIND, ROUTING)
+    next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+    last_rate_update = time.monotonic()
+
+    while True:
+        # Só lê clientes enquanto há espaço na fila
+        poller = poll_both if queued < QUEUE_MAX else poll_backend
+        timeout = max(0, min(next_heartbeat, next_membership if membership else next_heartbeat) - time.monotonic())
+        socks = dict(poller.poll(timeout * 1000))
+
+        if membership is not None:
+            if membership in socks:
+                _, reply_packed = membership.recv_multipart()
+                handle_membership(reply_packed)
+                drain_queue(backend)
+            if time.monotonic() >= next_membership:
+                list_req = {"service": "list", "data": {"timestamp": datetime.now().isoformat(), "clock": 0}}
+                membership.send_multipart([b"", msgpack.packb(list_req)])
+                next_membership = time.monotonic() + MEMBERSHIP_INTERVAL
+
+        # O backend (respostas e heartbeats) é sempre tratado primeiro
+        if backend in socks:
+            while True:
+                try:
+                    frames = backend.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                handle_backend(frontend, frames)
+            drain_queue(backend)
 
-client_socket = context.socket(zmq.ROUTER)
-client_socket.bind("tcp://*:5557")
+        if frontend in socks:
+            # Em lotes limitados, para o backend (respostas e heartbeats) não esperar por uma enxurrada de clientes
+            for _ in range(FRONTEND_BATCH):
+                if queued >= QUEUE_MAX:
+                    break
+                try:
+                    client_frames = frontend.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                REQUESTS.inc()
+                if SHED_DEPTH and queued >= SHED_DEPTH:
+                    SHED.inc()
+                    frontend.send_multipart(client_frames[:-1] + [busy_reply(client_frames[-1])])
+                    continue
+                route(backend, frontend, client_frames)
 
-server_socket = context.socket(zmq.DEALER)
-server_socket.bind("tcp://*:5558")
+        now = time.monotonic()
+        if now >= next_heartbeat:
+            update_reply_rate(now - last_rate_update)
+            last_rate_update = now
+            for worker in list(workers.values()):
+                if now > worker.expiry:
+                    drop_worker(frontend, worker)
+                else:
+                    backend.send_multipart([worker.identity, WORKER_HEARTBEAT])
+            next_heartbeat = now + HEARTBEAT_INTERVAL
+            drain_queue(backend)
 
-zmq.proxy(client_socket, server_socket)
 
-client_socket.close()
-server_socket.close()
-context.term()
+if __name__ == "__main__":
+    main()
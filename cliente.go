@@ -48,6 +48,73 @@ type ListReply struct {
 	} `msgpack:"data"`
 }
 
+// Endereços do broker (REQ) e do proxy (SUB). Com shards (ver shards.py), o
+// mapa vem do referencia: o REQ conecta em todos os brokers (alternando entre
+// eles) e o SUB em todos os proxies (cada tópico só passa pelo shard dono).
+var brokerAddresses = []string{"tcp://broker:5557"}
+var proxyAddresses = []string{"tcp://proxy:5556"}
+
+// Struct para desserializar o mapa de shards ("shards" do referencia)
+type ShardsReply struct {
+	Data struct {
+		Proxy []struct {
+			Count int    `msgpack:"count"`
+			Xpub  string `msgpack:"xpub"`
+		} `msgpack:"proxy"`
+		Broker []struct {
+			Count    int    `msgpack:"count"`
+			Frontend string `msgpack:"frontend"`
+		} `msgpack:"broker"`
+	} `msgpack:"data"`
+}
+
+// Busca o mapa de shards no referencia; sem resposta ou sem shards, mantém os endereços padrão
+func discoverShards(context *zmq.Context) {
+	address := os.Getenv("REFERENCE_ADDRESS")
+	if address == "" {
+		address = "tcp://referencia:5560"
+	}
+	socket, err := context.NewSocket(zmq.REQ)
+	if err != nil {
+		return
+	}
+	defer socket.Close()
+	socket.SetLinger(0)
+	socket.SetRcvtimeo(2 * time.Second)
+	socket.Connect(address)
+
+	request := map[string]interface{}{
+		"service": "shards",
+		"data":    map[string]interface{}{"timestamp": time.Now().Format(time.RFC3339), "clock": 0},
+	}
+	reqBytes, _ := msgpack.Marshal(request)
+	if _, err := socket.SendBytes(reqBytes, 0); err != nil {
+		return
+	}
+	replyBytes, err := socket.RecvBytes(0)
+	if err != nil {
+		return
+	}
+	var shards ShardsReply
+	if msgpack.Unmarshal(replyBytes, &shards) != nil {
+		return
+	}
+
+	// Só usa um mapa completo (todos os shards anunciados)
+	if n := len(shards.Data.Proxy); n > 1 && shards.Data.Proxy[0].Count == n {
+		proxyAddresses = nil
+		for _, entry := range shards.Data.Proxy {
+			proxyAddresses = append(proxyAddresses, entry.Xpub)
+		}
+	}
+	if n := len(shards.Data.Broker); n > 1 && shards.Data.Broker[0].Count == n {
+		brokerAddresses = nil
+		for _, entry := range shards.Data.Broker {
+			brokerAddresses = append(brokerAddresses, entry.Frontend)
+		}
+	}
+}
+
 // Goroutine para receber mensagens (o socket SUB)
 func receiveMessages(context *zmq.Context, user string) {
 	subSocket, err := context.NewSocket(zmq.SUB)
@@ -56,8 +123,10 @@ func receiveMessages(context *zmq.Context, user string) {
 	}
 	defer subSocket.Close()
 
-	// Conecta ao proxy PUB/SUB
-	subSocket.Connect("tcp://proxy:5556")
+	// Conecta ao proxy PUB/SUB (todos os shards)
+	for _, address := range proxyAddresses {
+		subSocket.Connect(address)
+	}
 
 	// Inscreve-se no tópico de usuário privado
 	subSocket.SetSubscribe("user:" + user)
@@ -125,8 +194,12 @@ func main() {
 	context, _ := zmq.NewContext()
 	defer context.Term()
 
+	discoverShards(context)
+
 	reqSocket, _ := context.NewSocket(zmq.REQ)
-	reqSocket.Connect("tcp://broker:5557")
+	for _, address := range brokerAddresses {
+		reqSocket.Connect(address)
+	}
 	defer reqSocket.Close()
 
 	fmt.Println("Bem-vindo ao sistema de canais! (Cliente em Go)")
@@ -0,0 +1,312 @@
+# cliente.py
+# Biblioteca cliente (Python) do protocolo do chat, para integrações e para o benchmark.
+#
+# Diferente de cliente.go e cliente_automatico.js (REQ, uma requisição por
+# vez), usa um DEALER: cada requisição leva um id no envelope
+# ([id, "", requisição]), que o broker e o servidor devolvem com a
+# resposta, então várias requisições podem estar em andamento no mesmo
+# socket.
+#
+#   async with AsyncChatClient("tcp://localhost:5557") as chat:
+#       await chat.login("ana")
+#       replies = await asyncio.gather(*(chat.publish("geral", f"msg {i}") for i in range(100)))
+#
+#   with ChatClient("tcp://localhost:5557") as chat:   # fachada síncrona
+#       chat.login("ana")
+#       futures = [chat.submit("publish", channel="geral", user="ana", message="oi") for _ in range(100)]
+#       replies = [f.result() for f in futures]
+#
+# Com vários brokers (shards, ver shards.py), `address` pode ser uma lista (ou
+# endereços separados por vírgula): o DEALER alterna as requisições entre
+# eles. broker_frontends() busca a lista no referencia.
+import asyncio
+import itertools
+import threading
+import time
+import uuid
+from datetime import datetime
+
+import msgpack
+import zmq
+import zmq.asyncio
+
+from protocolo import decode, encode_compact
+from shards import complete_shards
+
+DEFAULT_ADDRESS = "tcp://localhost:5557"
+DEFAULT_TIMEOUT = 10.0
+# Escritas: levam um request_id ("<id do cliente>:<n>"), então uma repetição
+# depois de um timeout recebe a resposta da primeira (ver idempotencia.py)
+WRITE_SERVICES = ("login", "channel", "publish", "message", "batch")
+
+
+def broker_frontends(reference_address, timeout=2.0):
+    """Frontends dos shards do broker anunciados ao referencia, ou [DEFAULT_ADDRESS] sem shards."""
+    socket = zmq.Context.instance().socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+    socket.connect(reference_address)
+    try:
+        socket.send(msgpack.packb({"service": "shards", "data": {"timestamp": datetime.now().isoformat(), "clock": 0}}))
+        shard_map = msgpack.unpackb(socket.recv(), raw=False).get("data", {})
+    finally:
+        socket.close()
+    count = max((e.get("count", 1) for e in shard_map.get("broker", [])), default=1)
+    entries = complete_shards(shard_map, "broker", count) if count > 1 else None
+    return [e["frontend"] for e in entries] if entries else [DEFAULT_ADDRESS]
+
+
+def is_ok(reply):
+    """True se a resposta indica sucesso (os serviços usam "OK" ou "sucesso")."""
+    return reply.get("data", {}).get("status") in ("OK", "sucesso")
+
+
+class AsyncChatClient:
+    """
+    Cliente asyncio com requisições em paralelo (pipelining) sobre um DEALER.
+
+    - Relógio lógico (Lamport): cada envio incrementa o clock; cada resposta
+      aplica max(local, recebido).
+    - Timeouts: uma requisição sem resposta em `timeout` segundos levanta
+      TimeoutError; a resposta que chegar depois é descartada.
+    - Reconexão: o DEALER reconecta sozinho se o broker cair ou reiniciar
+      (com espera crescente até `reconnect_max` segundos). Uma requisição sem
+      resposta é repetida até `retries` vezes; as escritas repetem o mesmo
+      request_id, então o servidor não as aplica duas vezes.
+    - Sobrecarga: uma resposta "busy" (broker ou servidor recusando carga) é
+      repetida depois de `retry_after` ms, dentro das mesmas `retries`.
+    - Presença: start_keepalive() manda o keepalive ("presence") do usuário
+      periodicamente, para ele continuar online (ver PRESENCE_TTL no servidor).
+    - `compact=True` usa o envelope compacto de protocolo.py.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, timeout=DEFAULT_TIMEOUT, retries=2,
+                 compact=False, reconnect_max=5.0, context=None):
+        self.address = address
+        self.timeout = timeout
+        self.retries = retries
+        self.compact = compact
+        self.reconnect_max = reconnect_max
+        self.context = context or zmq.asyncio.Context.instance()
+        self.user = None
+        self.client_id = uuid.uuid4().hex[:16]
+        self.clock = 0
+        self.pending = {} # id -> Future
+        self._ids = itertools.count(1)
+        self._request_seq = itertools.count(1)
+        self._socket = None
+        self._receiver = None
+        self._keepalive = None
+
+    # --- Conexão ---
+    async def connect(self):
+        if self._socket is None:
+            self._socket = self.context.socket(zmq.DEALER)
+            self._socket.setsockopt(zmq.LINGER, 0)
+            self._socket.setsockopt(zmq.RECONNECT_IVL, 100)
+            self._socket.setsockopt(zmq.RECONNECT_IVL_MAX, int(self.reconnect_max * 1000))
+            addresses = self.address.split(",") if isinstance(self.address, str) else self.address
+            for address in addresses:
+                self._socket.connect(address)
+            self._receiver = asyncio.get_running_loop().create_task(self._receive_loop())
+        return self
+
+    async def close(self):
+        self.stop_keepalive()
+        if self._receiver is not None:
+            self._receiver.cancel()
+            self._receiver = None
+        if self._socket is not None:
+            self._socket.close()
+            self._socket = None
+        for future in self.pending.values():
+            if not future.done():
+                future.set_exception(ConnectionError("Cliente fechado"))
+        self.pending.clear()
+
+    async def __aenter__(self):
+        return await self.connect()
+
+    async def __aexit__(self, *exc):
+        await self.close()
+
+    async def _receive_loop(self):
+        while True:
+            frames = await self._socket.recv_multipart()
+            future = self.pending.pop(frames[0], None)
+            if future is None or future.done():
+                continue # Resposta de uma requisição que já expirou
+            try:
+                reply, _ = decode(frames[-1])
+                self.clock = max(self.clock, reply.get("data", {}).get("clock", 0))
+                future.set_result(reply)
+            except Exception as e:
+                future.set_exception(e)
+
+    # --- Requisições ---
+    def _pack(self, service, data):
+        self.clock += 1
+        if self.compact:
+            return encode_compact({"service": service, "data": {**data, "clock": self.clock}}, time.time_ns() // 1_000_000)
+        return msgpack.packb({"service": service, "data": {**data, "timestamp": datetime.now().isoformat(), "clock": self.clock}})
+
+    async def request(self, service, timeout=None, **data):
+        """Envia uma requisição e espera a resposta ({"service", "data"})."""
+        await self.connect()
+        if service in WRITE_SERVICES and "request_id" not in data:
+            data["request_id"] = f"{self.client_id}:{next(self._request_seq)}"
+        attempts = 1 + self.retries
+        for attempt in range(attempts):
+            req_id = next(self._ids).to_bytes(8, "big")
+            future = asyncio.get_running_loop().create_future()
+            self.pending[req_id] = future
+            try:
+                await self._socket.send_multipart([req_id, b"", self._pack(service, data)])
+                reply = await asyncio.wait_for(future, timeout or self.timeout)
+                if reply.get("data", {}).get("status") != "busy" or attempt == attempts - 1:
+                    return reply
+                await asyncio.sleep(reply["data"].get("retry_after", 100) / 1000)
+            except asyncio.TimeoutError:
+                if attempt == attempts - 1:
+                    raise TimeoutError(f"Sem resposta para '{service}' em {timeout or self.timeout}s")
+            finally:
+                self.pending.pop(req_id, None)
+
+    # --- Serviços ---
+    async def login(self, user):
+        reply = await self.request("login", user=user)
+        if is_ok(reply) or reply.get("data", {}).get("description") == "Usuário já existe":
+            self.user = user
+        return reply
+
+    async def users(self, online=None, after=None, limit=None):
+        """
+        Sem argumentos, todos os usuários. `online=True`/`False` filtra pela
+        presença; `after` (o "next" da resposta anterior) e `limit` paginam.
+        """
+        query = {k: v for k, v in (("online", online), ("after", after), ("limit", limit)) if v is not None}
+        return await self.request("users", **query)
+
+    async def presence(self, status="online", user=None):
+        """Keepalive do usuário ("online") ou saída ("offline")."""
+        return await self.request("presence", user=user or self.user, status=status)
+
+    def start_keepalive(self, interval=10.0):
+        """Manda presence() a cada `interval` segundos até stop_keepalive() ou close()."""
+        if self._keepalive is None:
+            self._keepalive = asyncio.get_running_loop().create_task(self._keepalive_loop(interval))
+
+    def stop_keepalive(self):
+        if self._keepalive is not None:
+            self._keepalive.cancel()
+            self._keepalive = None
+
+    async def _keepalive_loop(self, interval):
+        while True:
+            try:
+                await self.presence()
+            except (TimeoutError, ConnectionError):
+                pass # Tenta de novo no próximo intervalo
+            await asyncio.sleep(interval)
+
+    async def channel(self, name):
+        return await self.request("channel", channel=name)
+
+    async def channels(self):
+        return await self.request("channels")
+
+    async def publish(self, channel, message, user=None):
+        return await self.request("publish", channel=channel, user=user or self.user, message=message)
+
+    async def message(self, dst, message, src=None):
+        return await self.request("message", src=src or self.user, dst=dst, message=message)
+
+    async def history(self, channel=None, user=None, peer=None, before=None, limit=None):
+        data = {"channel": channel} if channel is not None else {"user": user or self.user, "peer": peer}
+        if before is not None:
+            data["before"] = before
+        if limit is not None:
+            data["limit"] = limit
+        return await self.request("history", **data)
+
+    async def batch(self, ops):
+        """Várias escritas em uma requisição: ops = [(serviço, {dados}), ...] ou [{"service", "data"}, ...]."""
+        ops = [op if isinstance(op, dict) else {"service": op[0], "data": op[1]} for op in ops]
+        return await self.request("batch", ops=ops)
+
+
+class ChatClient:
+    """
+    Fachada síncrona: um event loop próprio em uma thread de fundo roda o
+    AsyncChatClient. Os métodos bloqueiam até a resposta; `submit()` devolve
+    um concurrent.futures.Future, para manter várias requisições em andamento.
+    """
+
+    def __init__(self, address=DEFAULT_ADDRESS, **options):
+        self._loop = asyncio.new_event_loop()
+        self._thread = threading.Thread(target=self._loop.run_forever, name="chat-client", daemon=True)
+        self._thread.start()
+        self.client = self._call(self._create(address, options))
+
+    async def _create(self, address, options):
+        return await AsyncChatClient(address, **options).connect()
+
+    def _call(self, coroutine):
+        return asyncio.run_coroutine_threadsafe(coroutine, self._loop).result()
+
+    @property
+    def clock(self):
+        return self.client.clock
+
+    @property
+    def user(self):
+        return self.client.user
+
+    def submit(self, service, **data):
+        """Envia sem esperar; retorna um Future com a resposta."""
+        return asyncio.run_coroutine_threadsafe(self.client.request(service, **data), self._loop)
+
+    def request(self, service, **data):
+        return self._call(self.client.request(service, **data))
+
+    def login(self, user):
+        return self._call(self.client.login(user))
+
+    def users(self, online=None, after=None, limit=None):
+        return self._call(self.client.users(online, after, limit))
+
+    def presence(self, status="online", user=None):
+        return self._call(self.client.presence(status, user))
+
+    def start_keepalive(self, interval=10.0):
+        self._loop.call_soon_threadsafe(self.client.start_keepalive, interval)
+
+    def channel(self, name):
+        return self._call(self.client.channel(name))
+
+    def channels(self):
+        return self._call(self.client.channels())
+
+    def publish(self, channel, message, user=None):
+        return self._call(self.client.publish(channel, message, user))
+
+    def message(self, dst, message, src=None):
+        return self._call(self.client.message(dst, message, src))
+
+    def history(self, **query):
+        return self._call(self.client.history(**query))
+
+    def batch(self, ops):
+        return self._call(self.client.batch(ops))
+
+    def close(self):
+        self._call(self.client.close())
+        self._loop.call_soon_threadsafe(self._loop.stop)
+        self._thread.join()
+        self._loop.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
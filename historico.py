@@ -0,0 +1,115 @@
+# historico.py
+# Índice em memória do log de mensagens para o serviço "history".
+import bisect
+import threading
+
+DEFAULT_PAGE_SIZE = 50
+MAX_PAGE_SIZE = 200
+
+
+def history_key(record):
+    """Chave do índice: ("channel", nome) ou ("private", (usuário_a, usuário_b)) ordenados."""
+    if record.get("type") == "channel":
+        channel = record.get("channel")
+        return ("channel", channel) if isinstance(channel, str) else None
+    if record.get("type") == "private":
+        src, dst = record.get("from_user"), record.get("to_user")
+        if not isinstance(src, str) or not isinstance(dst, str):
+            return None
+        return ("private", tuple(sorted((src, dst))))
+    return None
+
+
+class HistoryIndex:
+    """
+    Índice por canal e por par de usuários sobre o log de mensagens (SegmentedLog).
+
+    Cada chave guarda uma lista ordenada de (clock, offset, length) apontando
+    para a linha do registro no log. Uma página é lida com um bisect no
+    clock e um pread por mensagem, então o custo de uma consulta é
+    O(log n + tamanho da página) e não depende do tamanho do log.
+
+    O índice é reconstruído na inicialização com uma única leitura do log
+    e depois mantido pelo callback add(), chamado pelo log logo após cada
+    lote ser gravado. Os offsets do SegmentedLog não mudam quando a retenção
+    reescreve um segmento; os registros removidos saem com discard().
+    """
+
+    def __init__(self, log):
+        self.log = log
+        self._lock = threading.Lock()
+        self._entries = {} # chave -> [(clock, offset, length), ...] ordenado
+        log.scan(self.add)
+        log.on_write = self.add
+
+    def add(self, record, offset, length):
+        key = history_key(record)
+        if key is None:
+            return
+        entry = (record.get("clock") or 0, offset, length)
+        with self._lock:
+            entries = self._entries.setdefault(key, [])
+            # Quase sempre chega em ordem; insort cobre as réplicas fora de ordem
+            if not entries or entries[-1] <= entry:
+                entries.append(entry)
+            else:
+                bisect.insort(entries, entry)
+
+    def page(self, key, before=None, limit=DEFAULT_PAGE_SIZE):
+        """
+        Retorna (mensagens, next_cursor) com até `limit` mensagens de clock
+        menor que `before` (ou as mais recentes, se before for None), em
+        ordem cronológica. next_cursor é o clock a ser passado como `before`
+        para buscar a página anterior, ou None se não há mais mensagens.
+        Mensagens com o mesmo clock nunca são divididas entre páginas.
+        """
+        limit = max(1, min(limit, MAX_PAGE_SIZE))
+        with self._lock:
+            entries = self._entries.get(key)
+            if not entries:
+                return [], None
+            end = len(entries) if before is None else bisect.bisect_left(entries, (before,))
+            start = max(0, end - limit)
+            # Não divide um grupo de mensagens com o mesmo clock
+            while start > 0 and entries[start - 1][0] == entries[start][0]:
+                start -= 1
+            selected = entries[start:end]
+
+        messages = self.log.read_records([(offset, length) for _, offset, length in selected])
+        next_cursor = selected[0][0] if selected and start > 0 else None
+        return messages, next_cursor
+
+    def expired(self, retention, limit, age_of):
+        """
+        Registros de canal fora da retenção, como {chave: {offsets}}.
+
+        retention(canal) devolve (quantidade, segundos), 0 = sem limite: ficam
+        só as `quantidade` mensagens mais recentes do canal e as de até
+        `segundos` atrás. age_of(offset) é a idade do registro em segundos.
+        Só offsets menores que `limit` (o que já pode ser reescrito) entram.
+        Mensagens privadas não expiram.
+        """
+        with self._lock:
+            channels = [(key, list(entries)) for key, entries in self._entries.items() if key[0] == "channel"]
+
+        result = {}
+        for key, entries in channels:
+            count, seconds = retention(key[1])
+            if not count and not seconds:
+                continue
+            cut = len(entries) - count if count else 0
+            offsets = {offset for i, (_, offset, _) in enumerate(entries)
+                       if offset < limit and (i < cut or (seconds and age_of(offset) > seconds))}
+            if offsets:
+                result[key] = offsets
+        return result
+
+    def discard(self, expired):
+        """Remove do índice os registros de expired() ({chave: {offsets}})."""
+        with self._lock:
+            for key, offsets in expired.items():
+                entries = [entry for entry in self._entries.get(key, []) if entry[1] not in offsets]
+                if entries:
+                    self._entries[key] = entries
+                else:
+                    self._entries.pop(key, None)
@@ -0,0 +1,76 @@
+# idempotencia.py
+# Cache de deduplicação das escritas com "request_id" (idempotência).
+#
+# Um cliente que repete uma escrita depois de um timeout (ou em outro
+# servidor, depois de um failover) manda o mesmo request_id, no formato
+# "<id do cliente>:<número de sequência>". O servidor guarda a resposta de
+# cada request_id por um tempo limitado: a repetição recebe a resposta
+# guardada em vez de gravar e publicar a mensagem de novo. As escritas
+# replicadas levam o request_id (e a resposta da origem), então uma réplica
+# também reconhece a repetição que chegou a ela, e a operação que já foi
+# aplicada a partir do cliente não é aplicada de novo pela replicação.
+import collections
+import threading
+import time
+
+# Marca de uma requisição ainda em execução (a resposta ainda não existe)
+IN_PROGRESS = object()
+
+
+class DedupCache:
+    """
+    Respostas por request_id, limitadas a `max_entries` (as menos usadas
+    saem primeiro) e a `ttl` segundos. Fica só em memória: depois de um
+    reinício as repetições voltam a ser executadas.
+
+    claim() reserva um request_id antes de executar a escrita; quem reservou
+    chama complete() com a resposta, ou release() se a escrita falhou e
+    pode ser tentada de novo.
+    """
+
+    def __init__(self, max_entries=100000, ttl=300.0):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._entries = collections.OrderedDict() # request_id -> (expira em, resposta ou IN_PROGRESS)
+
+    def __len__(self):
+        return len(self._entries)
+
+    def claim(self, request_id):
+        """
+        Retorna (True, None) se o request_id é novo (e agora está reservado),
+        ou (False, resposta) se já existe; a resposta é IN_PROGRESS enquanto
+        a primeira execução não terminou.
+        """
+        now = time.monotonic()
+        with self._lock:
+            entry = self._entries.get(request_id)
+            if entry is not None and entry[0] > now:
+                self._entries.move_to_end(request_id)
+                return False, entry[1]
+            self._entries[request_id] = (now + self.ttl, IN_PROGRESS)
+            self._entries.move_to_end(request_id)
+            self._evict(now)
+            return True, None
+
+    def complete(self, request_id, reply):
+        with self._lock:
+            self._entries[request_id] = (time.monotonic() + self.ttl, reply)
+            self._entries.move_to_end(request_id)
+
+    def release(self, request_id):
+        with self._lock:
+            entry = self._entries.get(request_id)
+            if entry is not None and entry[1] is IN_PROGRESS:
+                del self._entries[request_id]
+
+    def _evict(self, now):
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+        # As mais antigas ficam no começo; para na primeira que ainda vale
+        while self._entries:
+            request_id, (expires, _) = next(iter(self._entries.items()))
+            if expires > now:
+                break
+            del self._entries[request_id]
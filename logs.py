@@ -0,0 +1,163 @@
+# logs.py
+# Logging com níveis, por componente, com limite de linhas repetidas e
+# gravação em uma thread de fundo (quem loga nunca espera pelo stdout).
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+import threading
+import time
+
+LOG_LEVEL = os.environ.get("LOG_LEVEL", "INFO").upper()
+LOG_FORMAT = os.environ.get("LOG_FORMAT", "text") # "text" ou "json"
+# No máximo LOG_RATE_LIMIT linhas com o mesmo texto base a cada LOG_RATE_WINDOW segundos (0 = sem limite)
+LOG_RATE_LIMIT = int(os.environ.get("LOG_RATE_LIMIT", "20"))
+LOG_RATE_WINDOW = float(os.environ.get("LOG_RATE_WINDOW", "10"))
+LOG_QUEUE_SIZE = 10000
+
+ROOT_LOGGER = "chat"
+
+# Atributos padrão de um LogRecord; o resto veio de extra={...} e vai para o JSON
+_RECORD_FIELDS = set(vars(logging.LogRecord("", 0, "", 0, "", (), None))) | {"message", "asctime", "node", "component", "suppressed", "dropped"}
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Deixa passar no máximo `limit` registros por janela de `window` segundos
+    para cada par (logger, texto base). O texto base é o template antes da
+    formatação (log.info("Catch-up de %s", origem)), então linhas que só
+    mudam nos argumentos contam juntas. O primeiro registro depois da janela
+    leva em `suppressed` quantos foram descartados.
+    """
+
+    def __init__(self, limit, window):
+        super().__init__()
+        self.limit = limit
+        self.window = window
+        self._lock = threading.Lock()
+        self._state = {} # (logger, template) -> [início da janela, contagem, suprimidos]
+
+    def filter(self, record):
+        if self.limit <= 0:
+            return True
+        key = (record.name, record.msg)
+        now = time.monotonic()
+        with self._lock:
+            state = self._state.get(key)
+            if state is None or now - state[0] >= self.window:
+                suppressed = state[2] if state is not None else 0
+                state = self._state[key] = [now, 0, 0]
+                if suppressed:
+                    record.suppressed = suppressed
+            state[1] += 1
+            if state[1] > self.limit:
+                state[2] += 1
+                return False
+        return True
+
+
+class _NonBlockingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler que nunca bloqueia: com a fila cheia o registro é descartado
+    e contado, e o próximo registro que entrar leva a contagem em `dropped`.
+    A formatação fica para a thread de escrita; os argumentos
+    são guardados como estão, então não passe objetos que vão mudar depois.
+    """
+
+    def __init__(self, log_queue):
+        super().__init__(log_queue)
+        self.dropped = 0
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        if self.dropped:
+            record.dropped = self.dropped
+        try:
+            self.queue.put_nowait(record)
+            self.dropped = 0
+        except queue.Full:
+            self.dropped += 1
+
+
+class _TextFormatter(logging.Formatter):
+    def __init__(self):
+        super().__init__("%(asctime)s %(levelname)-7s [%(node)s/%(component)s] %(message)s")
+
+    def format(self, record):
+        line = super().format(record)
+        if getattr(record, "suppressed", 0):
+            line += f" (+{record.suppressed} linhas iguais suprimidas)"
+        if getattr(record, "dropped", 0):
+            line += f" ({record.dropped} linhas descartadas com a fila cheia)"
+        return line
+
+
+class _JsonFormatter(logging.Formatter):
+    def format(self, record):
+        entry = {
+            "ts": self.formatTime(record),
+            "level": record.levelname,
+            "node": record.node,
+            "component": record.component,
+            "msg": record.getMessage(),
+        }
+        entry.update((k, v) for k, v in vars(record).items() if k not in _RECORD_FIELDS)
+        for field in ("suppressed", "dropped"):
+            if getattr(record, field, 0):
+                entry[field] = getattr(record, field)
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, default=str, ensure_ascii=False)
+
+
+class _NodeFilter(logging.Filter):
+    """Acrescenta o nó (processo) e o componente (logger sem o prefixo) ao registro."""
+
+    def __init__(self, node):
+        super().__init__()
+        self.node = node
+
+    def filter(self, record):
+        record.node = self.node
+        record.component = record.name.removeprefix(f"{ROOT_LOGGER}.")
+        return True
+
+
+_listener = None
+
+
+def setup_logging(node):
+    """
+    Configura os loggers do processo (uma vez). `node` identifica o processo
+    nas linhas (nome do servidor, "broker", ...).
+    """
+    global _listener
+    if _listener is not None:
+        return
+
+    handler = logging.StreamHandler(sys.stdout)
+    handler.setFormatter(_JsonFormatter() if LOG_FORMAT == "json" else _TextFormatter())
+    handler.addFilter(_NodeFilter(node))
+
+    log_queue = queue.Queue(LOG_QUEUE_SIZE)
+    queue_handler = _NonBlockingQueueHandler(log_queue)
+    queue_handler.addFilter(RateLimitFilter(LOG_RATE_LIMIT, LOG_RATE_WINDOW))
+
+    root = logging.getLogger(ROOT_LOGGER)
+    root.setLevel(LOG_LEVEL)
+    root.addHandler(queue_handler)
+    root.propagate = False
+
+    _listener = logging.handlers.QueueListener(log_queue, handler)
+    _listener.start()
+    atexit.register(_listener.stop) # Escreve o que ficou na fila ao sair
+
+
+def get_logger(component):
+    """Logger de um componente (ex.: "replicacao", "p2p"). As linhas saem com "[nó/componente]"."""
+    return logging.getLogger(f"{ROOT_LOGGER}.{component}")
@@ -0,0 +1,820 @@
+# persistencia.py
+# Persistência do servidor: log append-only com "group commit" (mensagens)
+# e armazenamento chave/valor incremental (usuários e canais).
+import array
+import bisect
+import collections
+import gzip
+import json
+import os
+import re
+import threading
+import time
+
+# Políticas de fsync aceitas pelo AppendLog
+FSYNC_NONE = "none"      # Apenas write() + flush(): durável até o SO
+FSYNC_BATCH = "batch"    # Um fsync por lote gravado
+FSYNC_RECORD = "record"  # Um fsync por registro (mais lento, mais seguro)
+FSYNC_POLICIES = (FSYNC_NONE, FSYNC_BATCH, FSYNC_RECORD)
+
+
+class AppendLog:
+    """
+    Log append-only com um único handle de arquivo aberto e uma thread de escrita.
+
+    Contrato de durabilidade: append() apenas enfileira o registro e devolve
+    um número de sequência. O registro só é considerado durável (segundo a
+    política de fsync) depois que wait_durable(seq) retorna True. Quem
+    precisa responder ao cliente deve esperar antes de enviar a resposta.
+
+    Os registros são agrupados em lotes de até `max_batch` itens ou até
+    `max_delay` segundos depois que o primeiro registro do lote chegou.
+    Com max_delay=0 o lote é tudo que se acumulou durante a escrita anterior.
+
+    Se `on_write` for informado, ele é chamado pela thread de escrita como
+    on_write(record, offset, length) para cada registro, logo depois que o
+    lote foi gravado no arquivo (usado para indexar o histórico). Os offsets
+    começam em `base_offset` (ver SegmentedLog).
+    """
+
+    def __init__(self, filename, fsync_policy=FSYNC_BATCH, max_batch=256, max_delay=0.0, on_write=None, base_offset=0):
+        if fsync_policy not in FSYNC_POLICIES:
+            raise ValueError(f"Política de fsync inválida: {fsync_policy}")
+
+        self.filename = filename
+        self.fsync_policy = fsync_policy
+        self.max_batch = max_batch
+        self.max_delay = max_delay
+        self.on_write = on_write
+
+        os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+        self._file = open(filename, "ab")
+        self._offset = base_offset + self._file.tell() # Posição onde o próximo registro começa
+
+        self._cond = threading.Condition()
+        self._pending = []       # (registro, linha serializada) aguardando escrita
+        self._next_seq = 0       # Último número de sequência entregue
+        self._durable_seq = 0    # Último número de sequência durável
+        self._error = None
+        self._closed = False
+
+        self._writer = threading.Thread(target=self._writer_loop, daemon=True)
+        self._writer.start()
+
+    def append(self, record):
+        """Enfileira um registro (dict) e retorna seu número de sequência."""
+        line = (json.dumps(record) + "\n").encode("utf-8")
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"Log '{self.filename}' já foi fechado")
+            self._next_seq += 1
+            self._pending.append((record, line))
+            self._cond.notify_all()
+            return self._next_seq
+
+    def append_many(self, records):
+        """
+        Enfileira vários registros de uma vez e retorna o número de sequência
+        do último. Como entram juntos na fila, saem na mesma escrita.
+        """
+        lines = [(record, (json.dumps(record) + "\n").encode("utf-8")) for record in records]
+        with self._cond:
+            if self._closed:
+                raise RuntimeError(f"Log '{self.filename}' já foi fechado")
+            self._next_seq += len(lines)
+            self._pending.extend(lines)
+            self._cond.notify_all()
+            return self._next_seq
+
+    def wait_durable(self, seq, timeout=None):
+        """Bloqueia até que o registro `seq` seja durável. Retorna False em caso de timeout."""
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._cond:
+            while self._durable_seq < seq:
+                if self._error is not None:
+                    raise self._error
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return False
+                self._cond.wait(remaining)
+            return True
+
+    def flush(self):
+        """Espera até que tudo que foi enfileirado até agora esteja durável."""
+        with self._cond:
+            seq = self._next_seq
+        return self.wait_durable(seq)
+
+    def size(self):
+        """Offset do fim do que já foi gravado (registros ainda pendentes não contam)."""
+        return self._offset
+
+    def truncate(self):
+        """
+        Descarta o conteúdo do arquivo depois de gravar o que estava pendente.
+        Quem chama deve garantir que não há append() concorrente.
+        """
+        with self._cond:
+            while self._pending or self._durable_seq < self._next_seq:
+                if self._error is not None:
+                    raise self._error
+                self._cond.wait()
+            self._file.truncate(0)
+            self._offset = 0
+            if self.fsync_policy != FSYNC_NONE:
+                os.fsync(self._file.fileno())
+
+    def rotate(self, archive_filename):
+        """
+        Move o arquivo atual para `archive_filename` (depois de gravar o que
+        estava pendente) e continua gravando em um arquivo novo e vazio.
+        Quem chama deve garantir que não há append() concorrente.
+        """
+        with self._cond:
+            while self._pending or self._durable_seq < self._next_seq:
+                if self._error is not None:
+                    raise self._error
+                self._cond.wait()
+            self._file.close()
+            os.replace(self.filename, archive_filename)
+            self._file = open(self.filename, "ab")
+            self._offset = 0
+
+    def close(self):
+        self.flush()
+        with self._cond:
+            self._closed = True
+            self._cond.notify_all()
+        self._writer.join()
+        self._file.close()
+
+    def _take_batch(self):
+        """Espera pelo primeiro registro e depois até o lote encher ou o tempo acabar."""
+        with self._cond:
+            while not self._pending and not self._closed:
+                self._cond.wait()
+            if not self._pending:
+                return None, self._next_seq
+
+            deadline = time.monotonic() + self.max_delay
+            while len(self._pending) < self.max_batch and not self._closed:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+
+            batch = self._pending
+            self._pending = []
+            # O último seq do lote é o último seq entregue, pois tudo que estava pendente foi retirado
+            return batch, self._next_seq
+
+    def _writer_loop(self):
+        while True:
+            batch, last_seq = self._take_batch()
+            if batch is None:
+                return
+
+            try:
+                if self.fsync_policy == FSYNC_RECORD:
+                    for _, line in batch:
+                        self._file.write(line)
+                        self._file.flush()
+                        os.fsync(self._file.fileno())
+                else:
+                    self._file.write(b"".join(line for _, line in batch))
+                    self._file.flush()
+                    if self.fsync_policy == FSYNC_BATCH:
+                        os.fsync(self._file.fileno())
+            except OSError as e:
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+
+            try:
+                for record, line in batch:
+                    if self.on_write is not None:
+                        self.on_write(record, self._offset, len(line))
+                    self._offset += len(line)
+            except Exception as e:
+                # Sem isso a thread morreria calada e wait_durable esperaria para sempre
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+
+            with self._cond:
+                self._durable_seq = last_seq
+                self._cond.notify_all()
+
+            try:
+                self._after_batch()
+            except OSError as e:
+                with self._cond:
+                    self._error = e
+                    self._cond.notify_all()
+                return
+
+    def _after_batch(self):
+        """Chamado pela thread de escrita depois de cada lote (ver SegmentedLog)."""
+
+
+class _Segment:
+    """
+    Um arquivo do SegmentedLog. `base` é o offset lógico do primeiro byte.
+    Num segmento reescrito pela retenção, `logical`/`physical` dizem onde
+    cada registro mantido está no arquivo novo; sem eles a posição no arquivo
+    é offset - base. Segmentos selados não mudam: uma reescrita cria outro
+    arquivo (geração seguinte) e troca o _Segment inteiro.
+    """
+    __slots__ = ("base", "generation", "path", "compressed", "sealed_at", "logical", "physical")
+
+    def __init__(self, base, generation, path, compressed=False, sealed_at=None, logical=None, physical=None):
+        self.base = base
+        self.generation = generation
+        self.path = path
+        self.compressed = compressed
+        self.sealed_at = sealed_at
+        self.logical = logical
+        self.physical = physical
+
+    def position(self, offset):
+        """Posição no arquivo (descomprimido) do registro com esse offset lógico, ou None se ele foi removido."""
+        if self.logical is None:
+            return offset - self.base
+        i = bisect.bisect_left(self.logical, offset)
+        if i < len(self.logical) and self.logical[i] == offset:
+            return self.physical[i]
+        return None
+
+
+_SEGMENT_NAME = re.compile(r"^(\d{20})(?:-(\d+))?\.jsonl(\.gz)?$")
+
+
+class SegmentedLog(AppendLog):
+    """
+    AppendLog dividido em segmentos de ~`segment_bytes` no diretório `directory`.
+
+    Os offsets são lógicos: o segmento que começa no offset B se chama
+    B.jsonl (20 dígitos), e um registro mantém o seu offset para sempre, mesmo
+    depois de o segmento ser reescrito pela retenção ou comprimido. Por isso
+    quem indexa o log (HistoryIndex) nunca precisa renumerar nada.
+
+    - Rotação: a thread de escrita sela o segmento ativo quando ele passa de
+      segment_bytes e continua em um arquivo novo.
+    - rewrite(): reescreve um segmento selado só com os registros que
+      passam em keep(offset), e/ou comprimido (gzip). O arquivo novo é
+      B-<geração>.jsonl[.gz], com B-<geração>.offsets guardando a posição de
+      cada registro mantido. O arquivo antigo só é apagado na reescrita
+      seguinte, então uma leitura em andamento não o perde.
+    - Um `legacy_file` (o antigo messages.jsonl único) vira o primeiro segmento.
+    """
+
+    def __init__(self, directory, segment_bytes=16 * 1024 * 1024, fsync_policy=FSYNC_BATCH,
+                 max_batch=256, max_delay=0.0, on_write=None, legacy_file=None):
+        self.directory = directory
+        self.segment_bytes = segment_bytes
+        self._segments_lock = threading.Lock()
+        self._trash = [] # Arquivos substituídos, apagados na próxima reescrita
+        self._cache = collections.OrderedDict() # path -> conteúdo descomprimido
+        os.makedirs(directory, exist_ok=True)
+
+        if legacy_file and os.path.exists(legacy_file) and not self._list_files():
+            os.replace(legacy_file, self._path(0, 0, False))
+        self._segments = self._load_segments()
+        if not self._segments or self._segments[-1].generation or self._segments[-1].compressed:
+            base = self._end_of_last_file()
+            self._segments.append(_Segment(base, 0, self._path(base, 0, False)))
+        active = self._segments[-1]
+        active.sealed_at = None
+        truncate_torn_tail(active.path)
+        super().__init__(active.path, fsync_policy=fsync_policy, max_batch=max_batch,
+                         max_delay=max_delay, on_write=on_write, base_offset=active.base)
+
+    # --- Arquivos ---
+    def _path(self, base, generation, compressed, suffix=".jsonl"):
+        name = f"{base:020d}" + (f"-{generation}" if generation else "")
+        return os.path.join(self.directory, name + suffix + (".gz" if compressed else ""))
+
+    def _list_files(self):
+        return [name for name in os.listdir(self.directory) if _SEGMENT_NAME.match(name)]
+
+    def _load_segments(self):
+        """Escolhe a maior geração de cada base e apaga as outras (e sobras de .tmp)."""
+        latest = {}
+        for name in os.listdir(self.directory):
+            if name.endswith(".tmp"):
+                os.remove(os.path.join(self.directory, name))
+                continue
+            match = _SEGMENT_NAME.match(name)
+            if match:
+                base, generation = int(match.group(1)), int(match.group(2) or 0)
+                if base not in latest or latest[base][0] < generation:
+                    latest[base] = (generation, match.group(3) is not None)
+
+        segments = []
+        for base in sorted(latest):
+            generation, compressed = latest[base]
+            segment = _Segment(base, generation, self._path(base, generation, compressed), compressed)
+            segment.sealed_at = os.path.getmtime(segment.path)
+            offsets_path = self._path(base, generation, False, ".offsets")
+            if generation and os.path.exists(offsets_path):
+                segment.logical, segment.physical = self._read_offsets(offsets_path)
+            segments.append(segment)
+            for old in range(generation):
+                for path in (self._path(base, old, False), self._path(base, old, True), self._path(base, old, False, ".offsets")):
+                    if os.path.exists(path):
+                        os.remove(path)
+        return segments
+
+    def _end_of_last_file(self):
+        """Offset lógico seguinte ao último segmento existente (0 sem segmentos)."""
+        if not self._segments:
+            return 0
+        last = self._segments[-1]
+        if last.logical is not None:
+            # Reescrito: o fim original não está no arquivo; o maior offset mantido é um limite seguro
+            data = self._data(last)
+            return (last.logical[-1] + len(data) - last.physical[-1]) if len(last.logical) else last.base + 1
+        return last.base + len(self._data(last))
+
+    @staticmethod
+    def _read_offsets(path):
+        pairs = array.array("Q")
+        with open(path, "rb") as f:
+            pairs.frombytes(f.read())
+        return pairs[0::2], pairs[1::2]
+
+    def _data(self, segment):
+        """Conteúdo (descomprimido) de um segmento selado; os comprimidos ficam em um cache pequeno."""
+        if not segment.compressed:
+            with open(segment.path, "rb") as f:
+                return f.read()
+        with self._segments_lock:
+            data = self._cache.get(segment.path)
+            if data is not None:
+                self._cache.move_to_end(segment.path)
+                return data
+        with open(segment.path, "rb") as f:
+            data = gzip.decompress(f.read())
+        with self._segments_lock:
+            self._cache[segment.path] = data
+            while len(self._cache) > 2:
+                self._cache.popitem(last=False)
+        return data
+
+    # --- Rotação (thread de escrita) ---
+    def _after_batch(self):
+        if self._offset - self._segments[-1].base < self.segment_bytes:
+            return
+        self._file.flush()
+        if self.fsync_policy != FSYNC_NONE:
+            os.fsync(self._file.fileno())
+        self._file.close()
+        segment = _Segment(self._offset, 0, self._path(self._offset, 0, False))
+        self._file = open(segment.path, "ab")
+        with self._segments_lock:
+            self._segments[-1].sealed_at = time.time()
+            self._segments.append(segment)
+
+    # --- Leitura ---
+    def _snapshot(self):
+        """(segmentos, fim lógico de cada um). O fim do ativo é o que já foi gravado."""
+        with self._segments_lock:
+            segments = list(self._segments)
+        ends = [s.base for s in segments[1:]] + [self._offset]
+        return segments, ends
+
+    def _iter_segment(self, segment, end):
+        """(offset lógico, linha) de cada registro do segmento, até o offset `end`."""
+        if segment.logical is not None:
+            data = self._data(segment)
+            for i, (offset, position) in enumerate(zip(segment.logical, segment.physical)):
+                following = segment.physical[i + 1] if i + 1 < len(segment.physical) else len(data)
+                yield offset, data[position:following]
+            return
+        offset = segment.base
+        if segment.compressed:
+            lines = self._data(segment).splitlines(keepends=True)
+        else:
+            lines = open(segment.path, "rb")
+        try:
+            for line in lines:
+                if offset + len(line) > end or not line.endswith(b"\n"):
+                    return
+                yield offset, line
+                offset += len(line)
+        finally:
+            if not segment.compressed:
+                lines.close()
+
+    def scan(self, callback):
+        """Chama callback(registro, offset, tamanho) para cada registro gravado (ex.: reconstruir um índice)."""
+        segments, ends = self._snapshot()
+        for segment, end in zip(segments, ends):
+            for offset, line in self._iter_segment(segment, end):
+                callback(json.loads(line), offset, len(line))
+
+    def read_records(self, locations):
+        """
+        Lê os registros em `locations` [(offset, tamanho), ...], na ordem
+        dada. Registros removidos pela retenção são pulados.
+        """
+        segments, _ = self._snapshot()
+        bases = [s.base for s in segments]
+        records = []
+        fds = {}
+        try:
+            for offset, length in locations:
+                i = bisect.bisect_right(bases, offset) - 1
+                if i < 0:
+                    continue
+                segment = segments[i]
+                position = segment.position(offset)
+                if position is None:
+                    continue
+                if segment.compressed:
+                    line = self._data(segment)[position:position + length]
+                else:
+                    fd = fds.get(segment.path)
+                    if fd is None:
+                        fd = fds[segment.path] = os.open(segment.path, os.O_RDONLY)
+                    line = os.pread(fd, length, position)
+                records.append(json.loads(line))
+        finally:
+            for fd in fds.values():
+                os.close(fd)
+        return records
+
+    def read_lines(self, offset, end, chunk_size):
+        """
+        Linhas inteiras a partir do offset lógico `offset`, até ~chunk_size
+        bytes e sem passar de `end`. Retorna (bytes, offset do que vem depois);
+        bytes vazios quando não há mais nada antes de `end`.
+        """
+        segments, ends = self._snapshot()
+        for segment, segment_end in zip(segments, ends):
+            if segment_end <= offset or segment.base >= end:
+                continue
+            start = max(offset, segment.base)
+            limit = min(end, segment_end)
+            if segment.logical is not None:
+                data = self._data(segment)
+                i = bisect.bisect_left(segment.logical, start)
+                j = i
+                while j < len(segment.logical) and segment.logical[j] < limit and (
+                        j == i or segment.physical[j] - segment.physical[i] < chunk_size):
+                    j += 1
+                if i == j:
+                    offset = segment_end
+                    continue
+                stop = segment.physical[j] if j < len(segment.physical) else len(data)
+                following = segment.logical[j] if j < len(segment.logical) else segment_end
+                return data[segment.physical[i]:stop], min(following, end)
+            payload = self._read_plain(segment, start - segment.base, limit - segment.base, chunk_size)
+            if payload:
+                return payload, start + len(payload)
+            offset = segment_end
+        return b"", end
+
+    def _read_plain(self, segment, position, limit, chunk_size):
+        if position >= limit:
+            return b""
+        if segment.compressed:
+            data = self._data(segment)[position:limit]
+            size = chunk_size
+            while True:
+                cut = data.rfind(b"\n", 0, size)
+                if cut >= 0 or size >= len(data):
+                    return data[:cut + 1] if cut >= 0 else data
+                size *= 2
+        fd = os.open(segment.path, os.O_RDONLY)
+        try:
+            size = chunk_size
+            while True:
+                data = os.pread(fd, min(size, limit - position), position)
+                cut = data.rfind(b"\n")
+                if cut >= 0:
+                    return data[:cut + 1]
+                if position + len(data) >= limit or not data:
+                    return data # Sem quebra de linha até o fim: devolve o que há
+                size *= 2 # Uma linha maior que o pedaço
+        finally:
+            os.close(fd)
+
+    # --- Retenção e compressão ---
+    def sealed_segments(self):
+        """[(base, fim lógico, instante em que foi selado, comprimido), ...] dos segmentos selados."""
+        segments, ends = self._snapshot()
+        return [(s.base, end, s.sealed_at, s.compressed) for s, end in zip(segments[:-1], ends[:-1])]
+
+    def disk_usage(self):
+        segments, _ = self._snapshot()
+        total = 0
+        for segment in segments:
+            try:
+                total += os.path.getsize(segment.path)
+            except OSError:
+                pass
+        return total
+
+    def segment_count(self):
+        with self._segments_lock:
+            return len(self._segments)
+
+    def rewrite(self, base, keep=None, compress=False):
+        """
+        Reescreve o segmento selado `base` mantendo só os registros com
+        keep(offset) verdadeiro (todos, se keep for None) e comprimindo se
+        `compress`. Sem registros mantidos, o segmento é apagado. Retorna
+        quantos registros foram removidos.
+        """
+        self._empty_trash()
+        segments, ends = self._snapshot()
+        index = next((i for i, s in enumerate(segments[:-1]) if s.base == base), None)
+        if index is None:
+            raise ValueError(f"Segmento selado inexistente: {base}")
+        segment, end = segments[index], ends[index]
+
+        kept, logical, physical, removed, identity = [], array.array("Q"), array.array("Q"), 0, segment.logical is None
+        position = 0
+        for offset, line in self._iter_segment(segment, end):
+            if keep is not None and not keep(offset):
+                removed += 1
+                identity = False
+                continue
+            logical.append(offset)
+            physical.append(position)
+            kept.append(line)
+            position += len(line)
+
+        if not kept:
+            with self._segments_lock:
+                self._segments.remove(segment)
+            self._trash.append(segment)
+            return removed
+
+        generation = segment.generation + 1
+        compressed = compress or segment.compressed
+        replacement = _Segment(base, generation, self._path(base, generation, compressed), compressed, segment.sealed_at)
+        if not identity:
+            replacement.logical, replacement.physical = logical, physical
+            pairs = array.array("Q", (v for pair in zip(logical, physical) for v in pair))
+            self._write_file(self._path(base, generation, False, ".offsets"), pairs.tobytes())
+        data = b"".join(kept)
+        self._write_file(replacement.path, gzip.compress(data, 6) if compressed else data, segment.sealed_at)
+
+        with self._segments_lock:
+            self._segments[self._segments.index(segment)] = replacement
+        self._trash.append(segment)
+        return removed
+
+    def _write_file(self, path, data, mtime=None):
+        tmp = f"{path}.tmp"
+        with open(tmp, "wb") as f:
+            f.write(data)
+            f.flush()
+            if self.fsync_policy != FSYNC_NONE:
+                os.fsync(f.fileno())
+        if mtime is not None:
+            os.utime(tmp, (mtime, mtime)) # O instante em que foi selado vale para a retenção por tempo
+        os.replace(tmp, path)
+
+    def _empty_trash(self):
+        trash, self._trash = self._trash, []
+        for segment in trash:
+            paths = [segment.path]
+            if segment.generation:
+                paths.append(self._path(segment.base, segment.generation, False, ".offsets"))
+            for path in paths:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            with self._segments_lock:
+                self._cache.pop(segment.path, None)
+
+
+def write_json_atomic(data, filename):
+    """Grava `data` em um arquivo temporário e o renomeia sobre `filename`."""
+    directory = os.path.dirname(filename) or "."
+    os.makedirs(directory, exist_ok=True)
+    tmp_name = f"{filename}.tmp"
+    with open(tmp_name, "w") as f:
+        json.dump(data, f)
+        f.flush()
+        os.fsync(f.fileno())
+    os.replace(tmp_name, filename)
+    dir_fd = os.open(directory, os.O_RDONLY)
+    try:
+        os.fsync(dir_fd)
+    finally:
+        os.close(dir_fd)
+
+
+def truncate_torn_tail(path):
+    """
+    Descarta uma última linha incompleta (queda no meio de uma escrita).
+    Sem isso o próximo registro anexado ficaria colado no fragmento, e a
+    leitura pararia nessa linha, perdendo tudo o que veio depois.
+    """
+    if not os.path.exists(path):
+        return
+    with open(path, "rb+") as f:
+        size = f.seek(0, os.SEEK_END)
+        if size == 0:
+            return
+        f.seek(max(0, size - 1))
+        if f.read(1) == b"\n":
+            return
+        position = size
+        while position > 0:
+            step = min(64 * 1024, position)
+            f.seek(position - step)
+            cut = f.read(step).rfind(b"\n")
+            if cut >= 0:
+                f.truncate(position - step + cut + 1)
+                return
+            position -= step
+        f.truncate(0)
+
+
+class _Shard:
+    __slots__ = ("lock", "data")
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.data = {}
+
+
+class KeyedStore:
+    """
+    Dicionário persistente, particionado em shards, que grava apenas as alterações.
+
+    O estado em disco é um snapshot JSON (`snapshot_file`, mesmo formato do
+    antigo save_data) mais um changelog append-only (`snapshot_file + ".log"`)
+    com uma linha {"k": chave, "v": valor} por escrita. Na inicialização o
+    snapshot é carregado e o changelog é reaplicado por cima.
+
+    Cada chave pertence a um shard com lock próprio, então escritas em chaves
+    diferentes não competem entre si; apenas a compactação trava todos, e só
+    pelo tempo de copiar os dados e trocar de changelog.
+
+    Quando o changelog passa de max(compact_min, len(dados)) entradas, uma
+    thread de fundo compacta: com os shards travados, copia os dados e move
+    o changelog para `.log.1`; depois, já sem travar ninguém, grava o
+    snapshot atomicamente e apaga o `.log.1`. Quem escreveu não espera pelo
+    snapshot, e o custo por escrita é amortizado O(1). Se o processo cair no
+    meio, a inicialização reaplica o `.log.1` e depois o `.log`; reaplicar
+    uma entrada que já está no snapshot é inofensivo, pois ela apenas
+    sobrescreve uma chave.
+    """
+
+    def __init__(self, snapshot_file, fsync_policy=FSYNC_BATCH, compact_min=1000, shards=16):
+        self.snapshot_file = snapshot_file
+        self.compact_min = compact_min
+        self._shards = [_Shard() for _ in range(shards)]
+        self._compact_lock = threading.Lock()
+        self._counter_lock = threading.Lock()
+
+        for key, value in self._load_snapshot().items():
+            self._shard(key).data[key] = value
+        self._rotated_file = f"{snapshot_file}.log.1"
+        truncate_torn_tail(f"{snapshot_file}.log")
+        if os.path.exists(self._rotated_file):
+            # Compactação interrompida: o snapshot talvez não tenha as entradas do .log.1
+            self._replay_changelog(self._rotated_file)
+            self._log_entries = self._replay_changelog(f"{snapshot_file}.log")
+            self._write_snapshot(self._copy_data())
+        else:
+            self._log_entries = self._replay_changelog(f"{snapshot_file}.log")
+        self._log = AppendLog(f"{snapshot_file}.log", fsync_policy=fsync_policy)
+
+    def _shard(self, key):
+        return self._shards[hash(key) % len(self._shards)]
+
+    def _load_snapshot(self):
+        if not os.path.exists(self.snapshot_file):
+            return {}
+        with open(self.snapshot_file, "r") as f:
+            try:
+                content = f.read()
+                return json.loads(content) if content else {}
+            except json.JSONDecodeError:
+                return {}
+
+    def _replay_changelog(self, changelog):
+        if not os.path.exists(changelog):
+            return 0
+        entries = 0
+        with open(changelog, "r") as f:
+            for line in f:
+                try:
+                    entry = json.loads(line)
+                except json.JSONDecodeError:
+                    break # Última linha incompleta (queda no meio da escrita)
+                self._shard(entry["k"]).data[entry["k"]] = entry["v"]
+                entries += 1
+        return entries
+
+    def __contains__(self, key):
+        return key in self._shard(key).data
+
+    def __len__(self):
+        return sum(len(shard.data) for shard in self._shards)
+
+    def get(self, key, default=None):
+        return self._shard(key).data.get(key, default)
+
+    def keys(self):
+        result = []
+        for shard in self._shards:
+            with shard.lock:
+                result.extend(shard.data.keys())
+        return result
+
+    @property
+    def shard_count(self):
+        return len(self._shards)
+
+    def shard_items(self, index):
+        """Cópia dos pares (chave, valor) de um shard, para transferir o store aos poucos."""
+        shard = self._shards[index]
+        with shard.lock:
+            return list(shard.data.items())
+
+    def put(self, key, value):
+        """Grava a chave e retorna o seq do changelog (ver wait_durable)."""
+        shard = self._shard(key)
+        with shard.lock:
+            seq = self._write_locked(shard, key, value)
+        self._maybe_compact()
+        return seq
+
+    def put_if_absent(self, key, value):
+        """Grava a chave apenas se ela não existe. Retorna o seq ou None se já existia."""
+        shard = self._shard(key)
+        with shard.lock:
+            if key in shard.data:
+                return None
+            seq = self._write_locked(shard, key, value)
+        self._maybe_compact()
+        return seq
+
+    def _write_locked(self, shard, key, value):
+        shard.data[key] = value
+        seq = self._log.append({"k": key, "v": value})
+        with self._counter_lock:
+            self._log_entries += 1
+        return seq
+
+    def _maybe_compact(self):
+        if self._log_entries < max(self.compact_min, len(self)):
+            return
+        # Se outra thread já está compactando, não há por que esperar
+        if self._compact_lock.acquire(blocking=False):
+            threading.Thread(target=self._compact_in_background, name="store-compact", daemon=True).start()
+
+    def _compact_in_background(self):
+        try:
+            self.compact()
+        finally:
+            self._compact_lock.release()
+
+    def compact(self):
+        """
+        Trava todos os shards (sempre na mesma ordem) só para copiar os dados
+        e trocar de changelog; o snapshot é gravado depois, sem os locks.
+        """
+        for shard in self._shards:
+            shard.lock.acquire()
+        try:
+            snapshot = self._copy_data()
+            if os.path.exists(self._rotated_file):
+                # A compactação anterior falhou antes do snapshot: sem ele, trocar
+                # o .log.1 perderia as entradas que só estão lá
+                self._write_snapshot(snapshot)
+            self._log.rotate(self._rotated_file)
+            with self._counter_lock:
+                self._log_entries = 0
+        finally:
+            for shard in reversed(self._shards):
+                shard.lock.release()
+        self._write_snapshot(snapshot)
+
+    def _copy_data(self):
+        snapshot = {}
+        for shard in self._shards:
+            snapshot.update(shard.data)
+        return snapshot
+
+    def _write_snapshot(self, snapshot):
+        write_json_atomic(snapshot, self.snapshot_file)
+        if os.path.exists(self._rotated_file):
+            os.remove(self._rotated_file)
+
+    def wait_durable(self, seq, timeout=None):
+        return self._log.wait_durable(seq, timeout)
+
+    def flush(self):
+        return self._log.flush()
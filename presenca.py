@@ -0,0 +1,79 @@
+# presenca.py
+# Presença: quem está online, a partir de keepalives dos clientes.
+import bisect
+import heapq
+import threading
+import time
+
+
+class PresenceTracker:
+    """
+    Usuários online. Cada keepalive (touch) renova o prazo do usuário por
+    `ttl` segundos; quem passa do prazo fica offline em expire().
+
+    Os prazos ficam em um heap com remoção preguiçosa: uma renovação só
+    empilha o prazo novo, e as entradas antigas são descartadas quando
+    chegam ao topo. expire() custa O(k log n) para k entradas vencidas, sem
+    varrer todos os usuários. Os nomes online ficam também em uma lista
+    ordenada, para paginar a consulta "users" por nome.
+    """
+
+    def __init__(self, ttl=30.0):
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._deadlines = {} # usuário -> prazo (monotonic)
+        self._heap = []      # (prazo, usuário), inclusive prazos já renovados
+        self._sorted = []    # usuários online, ordenados
+
+    def __len__(self):
+        return len(self._deadlines)
+
+    def __contains__(self, user):
+        return user in self._deadlines
+
+    def touch(self, user, now=None):
+        """Renova o prazo do usuário. Retorna True se ele acabou de ficar online."""
+        deadline = (now if now is not None else time.monotonic()) + self.ttl
+        with self._lock:
+            joined = user not in self._deadlines
+            self._deadlines[user] = deadline
+            heapq.heappush(self._heap, (deadline, user))
+            if joined:
+                bisect.insort(self._sorted, user)
+            elif len(self._heap) > 2 * len(self._deadlines) + 1024:
+                # Muitas renovações acumuladas: refaz o heap só com os prazos atuais
+                self._heap = [(d, u) for u, d in self._deadlines.items()]
+                heapq.heapify(self._heap)
+            return joined
+
+    def leave(self, user):
+        """Saída explícita. Retorna True se o usuário estava online."""
+        with self._lock:
+            if self._deadlines.pop(user, None) is None:
+                return False
+            self._remove_sorted(user)
+            return True # A entrada no heap fica e é descartada ao vencer
+
+    def expire(self, now=None):
+        """Tira quem passou do prazo e retorna esses usuários."""
+        now = now if now is not None else time.monotonic()
+        expired = []
+        with self._lock:
+            while self._heap and self._heap[0][0] <= now:
+                deadline, user = heapq.heappop(self._heap)
+                if self._deadlines.get(user) == deadline:
+                    del self._deadlines[user]
+                    self._remove_sorted(user)
+                    expired.append(user)
+        return expired
+
+    def page(self, after=None, limit=100):
+        """Até `limit` usuários online com nome maior que `after`, em ordem."""
+        with self._lock:
+            start = bisect.bisect_right(self._sorted, after) if after is not None else 0
+            return self._sorted[start:start + limit]
+
+    def _remove_sorted(self, user):
+        i = bisect.bisect_left(self._sorted, user)
+        if i < len(self._sorted) and self._sorted[i] == user:
+            del self._sorted[i]
@@ -0,0 +1,97 @@
+# protocolo.py
+# Constantes e utilitários de protocolo compartilhados entre broker.py, servidor.py e referencia.py.
+import threading
+from datetime import datetime
+
+import msgpack
+
+# --- Protocolo broker <-> servidor (backend, porta 5558) ---
+# Os servidores conectam um DEALER no ROUTER do broker. O primeiro frame de
+# cada mensagem (depois da identidade, no lado do broker) é o comando:
+#   servidor -> broker: [READY, msgpack({"name", "capacity"})]
+#                       [HEARTBEAT]
+#                       [REPLY, <envelope do cliente>..., b"", resposta]
+#   broker -> servidor: [HEARTBEAT]
+#                       [REQUEST, <envelope do cliente>..., b"", requisição]
+WORKER_READY = b"\x01"
+WORKER_HEARTBEAT = b"\x02"
+WORKER_REQUEST = b"\x03"
+WORKER_REPLY = b"\x04"
+
+# Intervalo entre heartbeats e quantos podem ser perdidos antes de o
+# outro lado ser considerado morto
+HEARTBEAT_INTERVAL = 1.0
+HEARTBEAT_LIVENESS = 3
+
+
+# --- Formato compacto das mensagens (versão 1) ---
+# Além do mapa {"service", "data": {..., "timestamp", "clock"}} (o formato dos
+# clientes Go e JS), servidores, broker e referencia aceitam um envelope
+# posicional:
+#   [PROTOCOL_VERSION, código do serviço, clock, timestamp, data]
+# com o timestamp em ms desde a epoch (inteiro) e `data` sem "clock" e
+# "timestamp". decode() devolve o timestamp em ISO 8601, como no mapa. O
+# formato é reconhecido pelo primeiro byte (array x mapa) e a resposta sai no
+# mesmo formato da requisição, então cada cliente escolhe o seu.
+PROTOCOL_VERSION = 1
+
+SERVICE_CODES = {
+    "erro": 0,
+    # Clientes
+    "login": 1, "users": 2, "channel": 3, "channels": 4, "publish": 5, "message": 6, "history": 7, "batch": 8,
+    "presence": 9,
+    # Referencia
+    "rank": 16, "list": 17, "heartbeat": 18, "membership": 19, "shard": 20, "shards": 21,
+    # P2P entre servidores
+    "election": 32, "clock": 33, "catchup": 34, "snapshot": 35,
+}
+SERVICE_NAMES = {code: name for name, code in SERVICE_CODES.items()}
+
+# Início já serializado de cada envelope: cabeçalho do array de 5 posições,
+# versão e código do serviço. Só clock, timestamp e data são serializados por mensagem.
+_ENVELOPE_PREFIX = {
+    code: b"\x95" + msgpack.packb(PROTOCOL_VERSION) + msgpack.packb(code)
+    for code in SERVICE_CODES.values()
+}
+_ENVELOPE_FIELDS = ("clock", "timestamp")
+
+# Packer reutilizado por thread (um Packer não pode ser usado por duas threads ao mesmo tempo)
+_packers = threading.local()
+
+
+def _packer():
+    packer = getattr(_packers, "packer", None)
+    if packer is None:
+        packer = _packers.packer = msgpack.Packer(default=str)
+    return packer
+
+
+def decode(packed):
+    """
+    Lê uma mensagem em qualquer dos dois formatos e retorna (mensagem, compacta).
+    A mensagem sai sempre como mapa; no formato compacto, o timestamp em ms
+    vira ISO 8601, como no mapa (ele vai para o log, o histórico e o PUB, que
+    não devem misturar formatos).
+    """
+    # unpackb, e não um Unpacker por thread como o _packer(): ele não cria
+    # objeto Python por chamada, e um Unpacker com feed() copia o quadro para
+    # o seu buffer e precisa ser descartado a cada quadro truncado ou com sobra
+    message = msgpack.unpackb(packed, raw=False)
+    if not isinstance(message, list):
+        return message, False
+    if len(message) != 5 or message[0] != PROTOCOL_VERSION:
+        raise ValueError(f"Envelope compacto inválido ou versão não suportada: {message[:1]}")
+    _, code, clock, timestamp, data = message
+    data = data if isinstance(data, dict) else {}
+    data["clock"] = clock
+    data["timestamp"] = datetime.fromtimestamp(timestamp / 1000).isoformat() if isinstance(timestamp, (int, float)) else timestamp
+    return {"service": SERVICE_NAMES.get(code, code), "data": data}, True
+
+
+def encode_compact(message, timestamp_ms):
+    """Serializa uma mensagem-mapa no envelope compacto (serviço desconhecido vira "erro")."""
+    data = message.get("data", {})
+    packer = _packer()
+    prefix = _ENVELOPE_PREFIX[SERVICE_CODES.get(message.get("service"), 0)]
+    body = {k: v for k, v in data.items() if k not in _ENVELOPE_FIELDS}
+    return b"".join((prefix, packer.pack(data.get("clock", 0)), packer.pack(timestamp_ms), packer.pack(body)))
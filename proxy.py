@@ -1,15 +1,306 @@
+# proxy.py
+# Proxy PUB/SUB que conhece os tópicos.
+#
+# Caminho público (canais, mensagens privadas):
+#   servidores PUB -> XSUB (5555) -> laço do proxy -> XPUB (5556) -> clientes SUB
+#   O laço acompanha as inscrições de cada tópico, guarda as últimas
+#   mensagens de cada canal e entrega a última delas a quem acabou de se
+#   inscrever. Um assinante lento perde só as próprias mensagens (padrão) ou,
+#   com PROXY_NODROP=1, segura o tópico em uma fila (ver TopicProxy).
+#
+# Caminho interno (tópicos "replication" e "servers", só entre servidores):
+#   servidores PUB -> XSUB (5565) -> zmq.proxy -> XPUB (5566) -> servidores SUB
+#   Sockets e thread próprios: o tráfego dos canais não disputa com a
+#   sincronização das réplicas.
+#
+# Replay (5567): ROUTER que devolve as últimas mensagens guardadas de um canal.
+#
+# Shards (PROXY_SHARDS > 1): cada cópia do proxy atende os tópicos com
+# crc32(tópico) % PROXY_SHARDS == PROXY_SHARD e se anuncia ao referencia
+# (ver shards.py). O caminho interno fica só no shard 0.
+import collections
+import os
+import socket
+import threading
+from datetime import datetime
+
+import msgpack
 import zmq
 
+from logs import setup_logging, get_logger
+from metricas import Counter, Gauge, start_metrics_server
+from shards import advertised, announce_shard
+
+# Endereços de bind (configuráveis para rodar cópias locais, ex.: benchmark.py)
+XPUB_BIND = os.environ.get("PROXY_XPUB_BIND", "tcp://*:5556")
+XSUB_BIND = os.environ.get("PROXY_XSUB_BIND", "tcp://*:5555")
+INTERNAL_XPUB_BIND = os.environ.get("PROXY_INTERNAL_XPUB_BIND", "tcp://*:5566")
+INTERNAL_XSUB_BIND = os.environ.get("PROXY_INTERNAL_XSUB_BIND", "tcp://*:5565")
+REPLAY_BIND = os.environ.get("PROXY_REPLAY_BIND", "tcp://*:5567")
+
+# Shards: índice desta cópia, quantidade e o host anunciado no lugar do "*" dos binds
+SHARD = int(os.environ.get("PROXY_SHARD", "0"))
+SHARDS = int(os.environ.get("PROXY_SHARDS", "1"))
+ADVERTISE_HOST = os.environ.get("PROXY_ADVERTISE_HOST", socket.gethostname())
+REFERENCE_ADDRESS = os.environ.get("REFERENCE_ADDRESS", "tcp://referencia:5560")
+INTERNAL = os.environ.get("PROXY_INTERNAL", "1" if SHARD == 0 else "0") == "1"
+
+# Mensagens guardadas por canal (0 = sem cache) e limite da fila de um tópico com assinante lento
+LVC_DEPTH = int(os.environ.get("PROXY_LVC_DEPTH", "50"))
+# 1 = XPUB_NODROP: nada é descartado pelo HWM, mas um assinante lento segura o
+# tópico inteiro para todos. 0 (padrão) = cada assinante perde só o que passa do seu HWM
+NODROP = os.environ.get("PROXY_NODROP", "0") == "1"
+TOPIC_QUEUE_MAX = int(os.environ.get("PROXY_TOPIC_QUEUE", "1000"))
+RETRY_INTERVAL_MS = 10 # Intervalo entre tentativas de esvaziar as filas dos tópicos
+TOPIC_LABELS_MAX = 100 # Tópicos com série própria nas métricas; os demais contam em "outros"
+
+PRIVATE_PREFIX = b"user:" # Mensagens privadas não entram no cache
+RESET_TOPIC = b"\x00proxy" # Tópico que ninguém assina (ver TopicProxy.reset_last_subscriber)
+
+log = get_logger("proxy")
+
+# --- Métricas ---
+MESSAGES = Counter("proxy_messages_total", "Mensagens recebidas dos publicadores, por tópico.", ("topic",))
+BYTES = Counter("proxy_bytes_total", "Bytes recebidos dos publicadores, por tópico.", ("topic",))
+DROPS = Counter("proxy_drops_total", "Mensagens descartadas com a fila do tópico cheia (assinante lento, só com PROXY_NODROP=1).", ("topic",))
+REPLAYED = Counter("proxy_replayed_total", "Mensagens do cache entregues a novos assinantes ou pelo replay.", ("topic",))
+SUBSCRIBERS = Gauge("proxy_subscribers", "Assinantes por tópico.", ("topic",))
+BACKLOG = Gauge("proxy_backlog", "Mensagens na fila de um tópico esperando um assinante lento.", ("topic",))
+SUBSCRIPTION_EVENTS = Counter("proxy_subscription_events_total", "Inscrições e cancelamentos vindos dos assinantes.", ("event",))
+
+
+class Topic:
+    __slots__ = ("name", "label", "subscribers", "cache", "backlog")
+
+    def __init__(self, name, label, cache_depth):
+        self.name = name
+        self.label = label
+        self.subscribers = 0
+        self.cache = collections.deque(maxlen=cache_depth) if cache_depth else None
+        self.backlog = collections.deque()
+
+
+class TopicProxy:
+    """
+    Repassa as mensagens do XSUB para o XPUB acompanhando cada tópico.
+
+    O XPUB fica em modo manual: o proxy aplica as inscrições (e as repassa
+    ao XSUB). Por padrão, um assinante lento perde só as mensagens que passam
+    do HWM dele, e os outros assinantes do tópico não esperam. Com
+    `nodrop` (XPUB_NODROP), o envio que esbarraria no HWM de um assinante
+    volta com EAGAIN: a mensagem vai para a fila do tópico, que é esvaziada
+    quando o assinante volta a consumir. Os outros tópicos continuam
+    fluindo, mas os outros assinantes do mesmo tópico esperam junto (o
+    XPUB só aceita ou recusa o envio para todos). Com a fila cheia, a
+    mensagem mais antiga é descartada e contada.
+
+    O XPUB não diz por qual conexão saiu cada mensagem nem quais o HWM
+    descartou, então as estatísticas são por tópico, não por assinante.
+
+    Com XPUB_MANUAL_LAST_VALUE, o primeiro envio depois de uma inscrição vai
+    só para quem acabou de se inscrever; é assim que a última mensagem do
+    canal chega apenas ao assinante novo.
+    """
+
+    def __init__(self, xpub, xsub, cache_depth=LVC_DEPTH, queue_max=TOPIC_QUEUE_MAX, nodrop=NODROP):
+        self.xpub = xpub
+        self.xsub = xsub
+        self.cache_depth = cache_depth
+        self.queue_max = queue_max
+        self.topics = {}
+        self.backlogged = set() # Tópicos com mensagens na fila
+
+        self.last_value = True
+        try:
+            xpub.setsockopt(zmq.XPUB_MANUAL_LAST_VALUE, 1)
+        except (AttributeError, zmq.ZMQError):
+            # libzmq sem a opção: inscrições manuais, sem entregar a última mensagem
+            xpub.setsockopt(zmq.XPUB_MANUAL, 1)
+            self.last_value = False
+            log.warning("XPUB_MANUAL_LAST_VALUE indisponível; novos assinantes não recebem a última mensagem do canal")
+        if nodrop:
+            xpub.setsockopt(zmq.XPUB_NODROP, 1)
+
+    def topic(self, name):
+        topic = self.topics.get(name)
+        if topic is None:
+            label = name.decode("utf-8", "replace") if len(self.topics) < TOPIC_LABELS_MAX else "outros"
+            cache_depth = 0 if name.startswith(PRIVATE_PREFIX) else self.cache_depth
+            topic = self.topics[name] = Topic(name, label, cache_depth)
+            if label != "outros":
+                BACKLOG.labels(label).set_function(lambda: len(topic.backlog))
+        return topic
+
+    # --- Assinantes ---
+    def handle_subscription(self, frame):
+        """Aplica no XPUB e repassa ao XSUB uma inscrição (\\x01) ou cancelamento (\\x00)."""
+        subscribe, name = frame[:1] == b"\x01", frame[1:]
+        self.xsub.send(frame)
+        topic = self.topic(name)
+
+        if subscribe:
+            self.xpub.setsockopt(zmq.SUBSCRIBE, name)
+            topic.subscribers += 1
+        else:
+            self.xpub.setsockopt(zmq.UNSUBSCRIBE, name)
+            topic.subscribers = max(0, topic.subscribers - 1)
+        SUBSCRIPTION_EVENTS.labels("subscribe" if subscribe else "unsubscribe").inc()
+        SUBSCRIBERS.labels(topic.label).set(topic.subscribers)
+
+        if not self.last_value:
+            return
+        if subscribe and topic.cache:
+            try:
+                self.xpub.send_multipart(topic.cache[-1], zmq.NOBLOCK)
+                REPLAYED.labels(topic.label).inc()
+                return
+            except zmq.Again:
+                pass
+        self.reset_last_subscriber()
+
+    def reset_last_subscriber(self):
+        """
+        No modo "last value", o próximo envio depois de uma inscrição (ou
+        cancelamento) vai só para aquele assinante. Sem nada para entregar a
+        ele, um envio para um tópico que ninguém assina desfaz esse estado
+        antes que a próxima mensagem de verdade seja desviada.
+        """
+        try:
+            self.xpub.send_multipart([RESET_TOPIC, b""], zmq.NOBLOCK)
+        except zmq.Again:
+            pass # HWM cheio (com XPUB_NODROP): a próxima mensagem vai só ao assinante novo, mas o proxy segue de pé
+
+    # --- Publicadores ---
+    def handle_publish(self, frames):
+        topic = self.topic(frames[0])
+        MESSAGES.labels(topic.label).inc()
+        BYTES.labels(topic.label).inc(sum(len(f) for f in frames))
+        if topic.cache is not None:
+            topic.cache.append(frames)
+
+        if topic.backlog:
+            self._enqueue(topic, frames) # Mantém a ordem atrás do que já está na fila
+            return
+        try:
+            self.xpub.send_multipart(frames, zmq.NOBLOCK)
+        except zmq.Again:
+            self._enqueue(topic, frames)
+
+    def _enqueue(self, topic, frames):
+        if len(topic.backlog) >= self.queue_max:
+            topic.backlog.popleft()
+            DROPS.labels(topic.label).inc()
+        topic.backlog.append(frames)
+        self.backlogged.add(topic.name)
+
+    def flush_backlogs(self):
+        for name in list(self.backlogged):
+            topic = self.topics[name]
+            while topic.backlog:
+                try:
+                    self.xpub.send_multipart(topic.backlog[0], zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                topic.backlog.popleft()
+            if not topic.backlog:
+                self.backlogged.discard(name)
+
+    # --- Replay ---
+    def replay(self, name, limit):
+        """Últimas `limit` mensagens guardadas do canal, da mais antiga para a mais nova."""
+        topic = self.topics.get(name)
+        if topic is None or not topic.cache:
+            return []
+        frames = list(topic.cache)[-limit:]
+        REPLAYED.labels(topic.label).inc(len(frames))
+        return [msgpack.unpackb(f[-1], raw=False) for f in frames]
+
+    def handle_replay(self, replay_socket):
+        identity, empty, request_packed = replay_socket.recv_multipart()
+        data = {}
+        try:
+            data = msgpack.unpackb(request_packed, raw=False).get("data", {})
+            limit = max(1, min(int(data.get("limit") or self.cache_depth), self.cache_depth))
+            reply_data = {"status": "OK", "messages": self.replay(str(data["topic"]).encode("utf-8"), limit)}
+        except Exception as e:
+            reply_data = {"status": "erro", "description": f"Requisição de replay inválida: {e}"}
+        reply_data["timestamp"] = datetime.now().isoformat()
+        reply_data["clock"] = data.get("clock", 0) if isinstance(data, dict) else 0
+        replay_socket.send_multipart([identity, empty, msgpack.packb({"service": "replay", "data": reply_data}, default=str)])
+
+    def run(self, replay_socket):
+        poller = zmq.Poller()
+        poller.register(self.xpub, zmq.POLLIN)
+        poller.register(self.xsub, zmq.POLLIN)
+        poller.register(replay_socket, zmq.POLLIN)
+
+        while True:
+            try:
+                self._poll_once(poller, replay_socket)
+            except Exception as e:
+                log.error("Erro no laço do proxy: %r", e)
+
+    def _poll_once(self, poller, replay_socket):
+        socks = dict(poller.poll(RETRY_INTERVAL_MS if self.backlogged else None))
+
+        # Inscrições primeiro: o assinante novo entra no XPUB antes das próximas mensagens
+        if self.xpub in socks:
+            while True:
+                try:
+                    frame = self.xpub.recv(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                if frame[:1] in (b"\x00", b"\x01"):
+                    self.handle_subscription(frame)
+
+        if self.backlogged:
+            self.flush_backlogs()
+
+        if self.xsub in socks:
+            while True:
+                try:
+                    frames = self.xsub.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                self.handle_publish(frames)
+
+        if replay_socket in socks:
+            self.handle_replay(replay_socket)
+
+
+def internal_proxy(context):
+    """Caminho interno entre servidores: repasse direto, sem cache nem filas."""
+    xpub = context.socket(zmq.XPUB)
+    xpub.bind(INTERNAL_XPUB_BIND)
+    xsub = context.socket(zmq.XSUB)
+    xsub.bind(INTERNAL_XSUB_BIND)
+    zmq.proxy(xpub, xsub)
+
+
+setup_logging("proxy")
+start_metrics_server()
 context = zmq.Context()
 
-pub = context.socket(zmq.XPUB)
-pub.bind("tcp://*:5556")
+if INTERNAL:
+    threading.Thread(target=internal_proxy, args=(context,), daemon=True).start()
 
+pub = context.socket(zmq.XPUB)
 sub = context.socket(zmq.XSUB)
-sub.bind("tcp://*:5555")
+proxy = TopicProxy(pub, sub)
+pub.bind(XPUB_BIND)
+sub.bind(XSUB_BIND)
+
+replay_socket = context.socket(zmq.ROUTER)
+replay_socket.bind(REPLAY_BIND)
 
-zmq.proxy(pub, sub)
+if SHARDS > 1:
+    announce_shard(context, REFERENCE_ADDRESS, "proxy", SHARD, SHARDS, {
+        "xsub": advertised(XSUB_BIND, ADVERTISE_HOST),
+        "xpub": advertised(XPUB_BIND, ADVERTISE_HOST),
+        "replay": advertised(REPLAY_BIND, ADVERTISE_HOST),
+    })
 
-pub.close()
-sub.close()
-context.close()
+log.info("Proxy pronto (shard %d/%d, canais %s -> %s, interno %s, replay %s, cache de %d mensagens por canal, nodrop %s)",
+         SHARD, SHARDS, XSUB_BIND, XPUB_BIND, f"{INTERNAL_XSUB_BIND} -> {INTERNAL_XPUB_BIND}" if INTERNAL else "desligado",
+         REPLAY_BIND, LVC_DEPTH, NODROP)
+proxy.run(replay_socket)
@@ -1,49 +1,165 @@
 # referencia.py (Atualizado para Etapa 4)
+import heapq
 import zmq
 import msgpack
+import os
 import time
 from datetime import datetime
 
+from logs import setup_logging, get_logger
+from metricas import Counter, Gauge, Histogram, start_metrics_server
+from protocolo import decode, encode_compact
+
+REFERENCE_BIND = os.environ.get("REFERENCE_BIND", "tcp://*:5560")
+# PUB com as mudanças de membros (tópico "membership")
+REFERENCE_PUB_BIND = os.environ.get("REFERENCE_PUB_BIND", "tcp://*:5561")
+
+# --- Detecção de Falhas ---
+# Sem heartbeat por MEMBERSHIP_SUSPECT_AFTER segundos o servidor fica suspeito;
+# por MEMBERSHIP_FAIL_AFTER segundos ele sai da lista. Os servidores mandam
+# heartbeat a cada MEMBERSHIP_HEARTBEAT segundos (ver servidor.py), então os
+# prazos devem ser alguns intervalos de heartbeat (aceitam frações de segundo).
+SUSPECT_AFTER = float(os.environ.get("MEMBERSHIP_SUSPECT_AFTER", "3.0"))
+FAIL_AFTER = float(os.environ.get("MEMBERSHIP_FAIL_AFTER", "6.0"))
+# Intervalo da mensagem "view" (só a versão atual), para quem perdeu uma mudança perceber
+VIEW_INTERVAL = float(os.environ.get("MEMBERSHIP_VIEW_INTERVAL", "1.0"))
+
+setup_logging("referencia")
+log = get_logger("referencia")
+
 context = zmq.Context()
 rep_socket = context.socket(zmq.ROUTER)
-rep_socket.bind("tcp://*:5560") 
+rep_socket.bind(REFERENCE_BIND)
+pub_socket = context.socket(zmq.PUB)
+pub_socket.bind(REFERENCE_PUB_BIND)
 
-print("Servidor de Referência iniciado na porta 5560...")
+log.info("Servidor de Referência iniciado em %s (membros publicados em %s)...", REFERENCE_BIND, REFERENCE_PUB_BIND)
 
 # --- NOVO: Estrutura de dados alterada ---
 # Agora armazena o endereço P2P junto com o rank
 # server_list -> { "nome_servidor": {"rank": 1, "address": "tcp://..."} }
 server_list = {}
-server_heartbeats = {}
 next_rank = 1
 logical_clock = 0
 
+# --- Membros Ativos ---
+# member_status -> { "nome_servidor": "alive" | "suspect" } (quem saiu não está aqui)
+# last_seen -> { "nome_servidor": instante do último heartbeat (time.monotonic) }
+# deadlines: heap de (prazo, nome). Cada heartbeat empilha um prazo novo; os
+# antigos são descartados quando saem do heap (o prazo vale só se não houve
+# heartbeat depois dele). Assim nada percorre a lista inteira por requisição.
+member_status = {}
+last_seen = {}
+deadlines = []
+view_version = 0
+active_view = [] # Lista ordenada por rank, refeita só quando a versão muda
+
+# --- Mapa de Shards (ver shards.py) ---
+# shard_map -> { "proxy" | "broker": { índice: {"index", "count", endereços...} } }
+# Cada shard se anuncia periodicamente; o último anúncio de um índice vale.
+SHARD_KINDS = ("proxy", "broker")
+shard_map = {kind: {} for kind in SHARD_KINDS}
+
+# --- Métricas ---
+REQUESTS = Counter("referencia_requests_total", "Requisições recebidas por serviço.", ("service",))
+REQUEST_SECONDS = Histogram("referencia_request_seconds", "Tempo de atendimento de uma requisição.")
+REGISTERED = Gauge("referencia_servers_registered", "Servidores que já pediram um rank.")
+REGISTERED.set_function(lambda: len(server_list))
+ACTIVE = Gauge("referencia_servers_active", "Servidores na lista de ativos, por estado.", ("status",))
+ACTIVE.labels("alive").set_function(lambda: sum(1 for s in member_status.values() if s == "alive"))
+ACTIVE.labels("suspect").set_function(lambda: sum(1 for s in member_status.values() if s == "suspect"))
+VIEW_VERSION = Gauge("referencia_membership_version", "Versão atual da lista de membros.")
+VIEW_VERSION.set_function(lambda: view_version)
+MEMBERSHIP_EVENTS = Counter("referencia_membership_events_total", "Mudanças publicadas na lista de membros.", ("event",))
+start_metrics_server()
+
+def server_entry(name):
+    info = server_list[name]
+    return {
+        "name": name,
+        "rank": info["rank"],
+        "address": info["address"], # <-- NOVO: Retorna o endereço
+        "status": member_status[name],
+    }
+
 def get_server_list():
-    """Retorna a lista de servidores que deram heartbeat recentemente."""
-    now = time.time()
-    active_servers = []
-    
-    for name, info in server_list.items():
-        last_heartbeat = server_heartbeats.get(name, 0)
-        # Considera ativo se o último heartbeat foi nos últimos 30 segundos
-        if (now - last_heartbeat) < 30:
-            active_servers.append({
-                "name": name, 
-                "rank": info["rank"],
-                "address": info["address"] # <-- NOVO: Retorna o endereço
-            })
-    
-    # Retorna ordenado pelo rank
-    return sorted(active_servers, key=lambda s: s['rank'])
+    """Retorna a lista de servidores ativos (vivos ou suspeitos), ordenada pelo rank."""
+    return active_view
+
+def publish_membership(event, name=None):
+    """Publica uma mudança (join, alive, suspect, leave) ou a versão atual (view)."""
+    global logical_clock
+    logical_clock += 1
+    data = {"event": event, "version": view_version, "timestamp": datetime.now().isoformat(), "clock": logical_clock}
+    if name is not None:
+        data["server"] = {"name": name, "rank": server_list[name]["rank"], "address": server_list[name]["address"]}
+    pub_socket.send_multipart([b"membership", msgpack.packb({"service": "membership", "data": data}, default=str)])
+
+def change_membership(event, name):
+    """Aplica uma mudança na lista de membros, incrementa a versão e a publica."""
+    global view_version, active_view
+    if event == "leave":
+        member_status.pop(name, None)
+        last_seen.pop(name, None)
+    else:
+        member_status[name] = "suspect" if event == "suspect" else "alive"
+    view_version += 1
+    active_view = sorted((server_entry(n) for n in member_status), key=lambda s: s["rank"])
+    MEMBERSHIP_EVENTS.labels(event).inc()
+    publish_membership(event, name)
+    level = log.warning if event in ("suspect", "leave") else log.info
+    level("Membro '%s': %s (versão %d)", name, event, view_version)
+
+def record_heartbeat(name):
+    now = time.monotonic()
+    last_seen[name] = now
+    heapq.heappush(deadlines, (now + SUSPECT_AFTER, name))
+    status = member_status.get(name)
+    if status is None:
+        change_membership("join", name)
+    elif status == "suspect":
+        change_membership("alive", name)
+
+def expire_members():
+    """Processa os prazos vencidos do heap e retorna quantos segundos faltam para o próximo."""
+    now = time.monotonic()
+    while deadlines and deadlines[0][0] <= now:
+        _, name = heapq.heappop(deadlines)
+        if name not in member_status:
+            continue
+        silent = now - last_seen[name]
+        if silent >= FAIL_AFTER:
+            change_membership("leave", name)
+        elif silent >= SUSPECT_AFTER:
+            if member_status[name] == "alive":
+                change_membership("suspect", name)
+            heapq.heappush(deadlines, (last_seen[name] + FAIL_AFTER, name))
+        # Senão o prazo é antigo: um heartbeat posterior já empilhou outro
+    return max(0.0, deadlines[0][0] - now) if deadlines else None
+
+poller = zmq.Poller()
+poller.register(rep_socket, zmq.POLLIN)
+next_view = time.monotonic() + VIEW_INTERVAL
 
 while True:
     try:
+        timeout = expire_members()
+        now = time.monotonic()
+        if now >= next_view:
+            publish_membership("view")
+            next_view = now + VIEW_INTERVAL
+        timeout = min(timeout if timeout is not None else VIEW_INTERVAL, next_view - now)
+        if not poller.poll(timeout * 1000):
+            continue
+
         frames = rep_socket.recv_multipart()
+        started = time.perf_counter()
         identity = frames[0]
-        empty = frames[1] 
+        empty = frames[1]
         request_packed = frames[2]
-        
-        request = msgpack.unpackb(request_packed, raw=False)
+
+        # Mapa ou envelope compacto (protocolo.py); a resposta sai no mesmo formato
+        request, compact = decode(request_packed)
         received_clock = request.get("data", {}).get("clock", 0)
         logical_clock = max(logical_clock, received_clock)
 
@@ -56,51 +172,74 @@ while True:
             case "rank":
                 server_name = data.get("user")
                 # --- NOVO: Recebe o endereço P2P do servidor ---
-                p2p_address = data.get("p2p_address") 
-                
+                p2p_address = data.get("p2p_address")
+
                 if server_name not in server_list:
                     server_list[server_name] = {
                         "rank": next_rank,
                         "address": p2p_address
                     }
                     next_rank += 1
-                
+
                 # Atualiza o endereço caso tenha mudado
+                moved = server_list[server_name]["address"] != p2p_address
                 server_list[server_name]["address"] = p2p_address
-                server_heartbeats[server_name] = time.time()
-                
+                if moved and server_name in member_status:
+                    change_membership("join", server_name) # Reinício com outro endereço
+                record_heartbeat(server_name)
+
                 reply_data = {"rank": server_list[server_name]["rank"]}
-                print(f"Servidor '{server_name}' (Rank {server_list[server_name]['rank']}) registrado em '{p2p_address}'")
+                log.info("Servidor '%s' (Rank %d) registrado em '%s'", server_name, server_list[server_name]["rank"], p2p_address)
 
             case "list":
-                reply_data = {"list": get_server_list()}
-            
+                reply_data = {"list": get_server_list(), "version": view_version}
+
             case "heartbeat":
                 server_name = data.get("user")
                 if server_name in server_list:
-                    server_heartbeats[server_name] = time.time()
-                    reply_data = {"status": "OK"}
-                    print(f"Heartbeat recebido de '{server_name}'")
+                    record_heartbeat(server_name)
+                    reply_data = {"status": "OK", "version": view_version}
+                    log.debug("Heartbeat recebido de '%s'", server_name)
                 else:
                     reply_data = {"status": "erro", "description": "Servidor não registrado. Peça um 'rank' primeiro."}
 
+            case "shard":
+                kind = data.get("kind")
+                if kind in SHARD_KINDS and isinstance(data.get("index"), int):
+                    entry = {k: v for k, v in data.items() if k not in ("clock", "timestamp", "kind")}
+                    if shard_map[kind].get(entry["index"]) != entry:
+                        log.info("Shard %s %d/%s: %s", kind, entry["index"], entry.get("count"), entry)
+                    shard_map[kind][entry["index"]] = entry
+                    reply_data = {"status": "OK"}
+                else:
+                    reply_data = {"status": "erro", "description": "Shard inválido (kind: proxy ou broker, index inteiro)"}
+
+            case "shards":
+                reply_data = {kind: [entries[i] for i in sorted(entries)] for kind, entries in shard_map.items()}
+
             case _:
                 reply_data = {"status": "erro", "description": "Serviço de referência não encontrado"}
 
         reply = {
             "service": service,
             "data": {
-                **reply_data, 
-                "timestamp": datetime.now().isoformat(),
+                **reply_data,
                 "clock": logical_clock
             }
         }
+        if compact:
+            reply_packed = encode_compact(reply, time.time_ns() // 1_000_000)
+        else:
+            reply["data"]["timestamp"] = datetime.now().isoformat()
+            reply_packed = msgpack.packb(reply, default=str)
 
         rep_socket.send_multipart([
             identity,
             empty,
-            msgpack.packb(reply, default=str)
+            reply_packed
         ])
+        REQUESTS.labels(service if service in ("rank", "list", "heartbeat", "shard", "shards") else "desconhecido").inc()
+        REQUEST_SECONDS.observe(time.perf_counter() - started)
 
     except Exception as e:
-        print(f"Erro no Servidor de Referência: {e}")
\ No newline at end of file
+        log.error("Erro no Servidor de Referência: %r", e)
@@ -0,0 +1,84 @@
+# relogio.py
+# Relógio corrigido: estima a diferença (offset) e o desvio de frequência
+# (drift) em relação ao relógio do coordenador a partir das amostras do
+# Christian's Algorithm.
+import collections
+import threading
+import time
+from datetime import datetime
+
+
+def best_sample(samples):
+    """
+    Escolhe, entre amostras (t0, t1, tempo_remoto) de uma rodada, a de menor
+    round trip e retorna (instante local, offset, rtt), em ns. Quanto menor o
+    RTT, menor a incerteza de supor que a resposta foi gerada no meio dele.
+    """
+    t0, t1, remote = min(samples, key=lambda s: s[1] - s[0])
+    rtt = t1 - t0
+    return t1, remote + rtt / 2 - t1, rtt
+
+
+class ClockEstimator:
+    """
+    Mantém a reta offset(t) = offset_base + drift * (t - t_base) ajustada
+    (mínimos quadrados) sobre as últimas `window` amostras filtradas.
+
+    `now_ns()` é o relógio de parede local corrigido por essa reta. Entre as
+    sincronias, o drift continua sendo aplicado, então o relógio corrigido
+    não dá saltos a cada amostra nem perde precisão enquanto espera a
+    próxima. O drift é limitado a `max_drift_ppm` para que poucas amostras
+    ruidosas não gerem uma extrapolação absurda.
+
+    A reta é trocada inteira (uma tupla), então a leitura não precisa de lock.
+    """
+
+    def __init__(self, window=8, max_drift_ppm=500.0):
+        self.max_drift = max_drift_ppm / 1e6
+        self.samples = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._curve = (0, 0.0, 0.0) # (t_base, offset_base, drift)
+
+    @property
+    def drift(self):
+        """Desvio de frequência estimado (s/s; 1e-6 = 1 ppm)."""
+        return self._curve[2]
+
+    def offset_at(self, local_ns):
+        t_base, offset_base, drift = self._curve
+        return offset_base + drift * (local_ns - t_base)
+
+    def now_ns(self):
+        local = time.time_ns()
+        return local + int(self.offset_at(local))
+
+    def now(self):
+        """Relógio corrigido em segundos (como time.time())."""
+        return self.now_ns() / 1e9
+
+    def now_datetime(self):
+        return datetime.fromtimestamp(self.now_ns() / 1e9)
+
+    def add_sample(self, local_ns, offset_ns):
+        with self._lock:
+            self.samples.append((local_ns, offset_ns))
+            n = len(self.samples)
+            mean_t = sum(t for t, _ in self.samples) / n
+            mean_o = sum(o for _, o in self.samples) / n
+            drift = self._curve[2]
+            if n >= 2:
+                var = sum((t - mean_t) ** 2 for t, _ in self.samples)
+                if var > 0:
+                    cov = sum((t - mean_t) * (o - mean_o) for t, o in self.samples)
+                    drift = max(-self.max_drift, min(self.max_drift, cov / var))
+            self._curve = (mean_t, mean_o, drift)
+
+    def rebase(self):
+        """
+        Descarta as amostras mantendo a reta atual (ex.: o coordenador mudou).
+        O relógio corrigido continua de onde estava até chegarem amostras novas.
+        """
+        with self._lock:
+            self.samples.clear()
+            local = time.time_ns()
+            self._curve = (local, self.offset_at(local), self._curve[2])
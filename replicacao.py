@@ -0,0 +1,239 @@
+# replicacao.py
+# Log de replicação com números de sequência por origem, envio em lotes e catch-up.
+import collections
+import contextlib
+import json
+import os
+import threading
+import time
+
+from persistencia import AppendLog, FSYNC_BATCH, truncate_torn_tail, write_json_atomic
+
+
+class ReplicationLog:
+    """
+    Lado da origem: atribui a cada escrita local um número de sequência
+    monotônico, grava a operação em disco e a acumula em lotes para publicação.
+
+    Cada operação é {"seq", "clock", "time", "request"}, onde "time" é o
+    relógio de parede da origem, lido de `wall_clock` (usado para medir o
+    atraso da replicação).
+    As últimas `retain` operações ficam em memória para atender pedidos de
+    catch-up; o arquivo em disco é rotacionado a cada `retain` operações
+    (mantendo a geração anterior), então a sequência continua de onde parou
+    depois de reiniciar.
+
+    Um lote fica pronto quando tem `batch_max` operações ou quando a mais
+    antiga dele espera há `batch_delay` segundos.
+
+    `epoch` identifica esta encarnação do log: se o diretório de dados for
+    apagado, a sequência recomeça em 1 com um epoch novo e os destinos sabem
+    que devem descartar as posições antigas.
+    """
+
+    def __init__(self, filename, retain=10000, batch_max=64, batch_delay=0.005, fsync_policy=FSYNC_BATCH,
+                 wall_clock=time.time):
+        self.filename = filename
+        self.wall_clock = wall_clock
+        self.archive_filename = f"{filename}.1"
+        self.retain = retain
+        self.batch_max = batch_max
+        self.batch_delay = batch_delay
+
+        self.epoch = self._load_epoch(f"{filename}.epoch")
+        self._cond = threading.Condition()
+        self._retained = collections.deque(maxlen=retain)
+        self._file_entries = 0
+        # Sem o fragmento, a próxima operação não fica colada nele (o que
+        # faria a sequência voltar atrás no reinício seguinte)
+        truncate_torn_tail(self.filename)
+        for path in (self.archive_filename, self.filename):
+            self._file_entries = self._load(path)
+        self.last_seq = self._retained[-1]["seq"] if self._retained else 0
+
+        self.published_seq = self.last_seq # Última sequência já entregue para publicação
+        self._log = AppendLog(filename, fsync_policy=fsync_policy)
+        self._outbox = []
+        self._outbox_since = None
+
+    @staticmethod
+    def _load_epoch(path):
+        if os.path.exists(path):
+            with open(path, "r") as f:
+                return json.load(f)["epoch"]
+        epoch = time.time_ns()
+        write_json_atomic({"epoch": epoch}, path)
+        return epoch
+
+    def _load(self, path):
+        entries = 0
+        if not os.path.exists(path):
+            return entries
+        with open(path, "r") as f:
+            for line in f:
+                try:
+                    self._retained.append(json.loads(line))
+                except json.JSONDecodeError:
+                    break # Última linha incompleta
+                entries += 1
+        return entries
+
+    def submit(self, request, clock):
+        """Registra uma escrita local para replicação e retorna seu número de sequência."""
+        with self._cond:
+            self.last_seq += 1
+            op = {"seq": self.last_seq, "clock": clock, "time": self.wall_clock(), "request": request}
+            self._log.append(op)
+            self._retained.append(op)
+            self._file_entries += 1
+            if self._file_entries >= self.retain:
+                self._log.rotate(self.archive_filename)
+                self._file_entries = 0
+
+            self._outbox.append(op)
+            if self._outbox_since is None:
+                # Lote novo: quem espera em take_batch() estava dormindo até o
+                # heartbeat e precisa recalcular o prazo (batch_delay)
+                self._outbox_since = time.monotonic()
+                self._cond.notify_all()
+            elif len(self._outbox) >= self.batch_max:
+                self._cond.notify_all()
+            return op["seq"]
+
+    def _batch_due(self):
+        return self._outbox and (
+            len(self._outbox) >= self.batch_max
+            or time.monotonic() - self._outbox_since >= self.batch_delay
+        )
+
+    def _take(self):
+        ops = self._outbox
+        self._outbox = []
+        self._outbox_since = None
+        if ops:
+            self.published_seq = ops[-1]["seq"]
+        return ops
+
+    def take_batch(self, timeout):
+        """Bloqueia até um lote ficar pronto ou `timeout` acabar. Retorna a lista de operações (pode ser vazia)."""
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            while not self._batch_due():
+                now = time.monotonic()
+                if now >= deadline:
+                    break
+                wait = deadline - now
+                if self._outbox:
+                    wait = min(wait, self._outbox_since + self.batch_delay - now)
+                self._cond.wait(max(wait, 0))
+            return self._take() if self._outbox else []
+
+    def pop_batch(self):
+        """Versão sem bloqueio de take_batch(): retorna o lote se estiver pronto, senão []."""
+        with self._cond:
+            return self._take() if self._batch_due() else []
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Bloqueia novas escritas locais enquanto o bloco roda (ponto de snapshot)."""
+        with self._cond:
+            yield
+
+    def read_from(self, from_seq, limit):
+        """
+        Retorna (ops, first_seq) com até `limit` operações a partir de `from_seq`.
+        `first_seq` é a operação mais antiga ainda disponível; se for maior
+        que `from_seq`, as operações intermediárias não existem mais aqui.
+        """
+        with self._cond:
+            if not self._retained:
+                return [], self.last_seq + 1
+            first_seq = self._retained[0]["seq"]
+            start = max(from_seq, first_seq) - first_seq
+            ops = [self._retained[i] for i in range(start, min(start + limit, len(self._retained)))]
+            return ops, first_seq
+
+
+class ReplicationState:
+    """
+    Lado do destino: última sequência aplicada de cada origem (e o epoch do
+    log da origem ao qual ela se refere).
+
+    Operações chegam por lotes publicados (que podem se perder ou chegar
+    duplicados) e por respostas de catch-up. Só a próxima sequência
+    esperada é aplicada; operações adiantadas ficam guardadas até a lacuna
+    ser preenchida e operações já vistas são descartadas. As posições são
+    persistidas em um KeyedStore depois de cada lote aplicado.
+    """
+
+    def __init__(self, store, apply_fn):
+        self._store = store
+        self._apply = apply_fn # apply_fn(origin, op)
+        self._lock = threading.RLock()
+        self._buffered = collections.defaultdict(dict) # origem -> {seq: op}
+        self._known_last = {} # origem -> maior sequência anunciada
+
+    def applied(self, origin):
+        return self._store.get(origin, {}).get("seq", 0)
+
+    def behind(self, origin):
+        """Quantas operações a origem já anunciou e ainda não foram aplicadas aqui."""
+        return max(0, self._known_last.get(origin, 0) - self.applied(origin))
+
+    @contextlib.contextmanager
+    def paused(self):
+        """Impede que operações replicadas sejam aplicadas enquanto o bloco roda."""
+        with self._lock:
+            yield
+
+    def positions(self):
+        """Cópia de {origem: {"epoch", "seq"}} com a posição aplicada de cada origem."""
+        with self._lock:
+            return {origin: self._store.get(origin) for origin in self._store.keys()}
+
+    def restore(self, positions):
+        """Adota posições recebidas em um snapshot (a partir daí, só a cauda é aplicada)."""
+        with self._lock:
+            for origin, position in positions.items():
+                self._store.put(origin, {"epoch": position["epoch"], "seq": position["seq"]})
+                self._buffered.pop(origin, None)
+
+    def _check_epoch(self, origin, epoch):
+        """Um epoch novo significa que o log da origem recomeçou: esquece a posição antiga."""
+        position = self._store.get(origin)
+        if position is not None and position.get("epoch") != epoch:
+            self._store.put(origin, {"epoch": epoch, "seq": 0})
+            self._buffered.pop(origin, None)
+            self._known_last.pop(origin, None)
+
+    def offer(self, origin, epoch, ops, last_seq=0):
+        """Aplica o que for possível e retorna True se ainda falta algo (precisa de catch-up)."""
+        with self._lock:
+            self._check_epoch(origin, epoch)
+            applied = self.applied(origin)
+            start = applied
+            buffered = self._buffered[origin]
+            for op in ops:
+                if op["seq"] > applied:
+                    buffered[op["seq"]] = op
+                last_seq = max(last_seq, op["seq"])
+            self._known_last[origin] = max(self._known_last.get(origin, 0), last_seq)
+
+            while applied + 1 in buffered:
+                op = buffered.pop(applied + 1)
+                self._apply(origin, op)
+                applied = op["seq"]
+
+            if applied != start:
+                self._store.put(origin, {"epoch": epoch, "seq": applied})
+            return self._known_last[origin] > applied
+
+    def skip_to(self, origin, epoch, seq):
+        """Desiste das operações anteriores a `seq` (não estão mais disponíveis na origem)."""
+        with self._lock:
+            self._check_epoch(origin, epoch)
+            if seq - 1 > self.applied(origin):
+                self._store.put(origin, {"epoch": epoch, "seq": seq - 1})
+                buffered = self._buffered[origin]
+                for old in [s for s in buffered if s < seq]:
+                    del buffered[old]
@@ -1,129 +1,839 @@
 # servidor.py (Versão Final - Etapa 5: Replicação)
 import zmq
-import json
-from datetime import datetime
+import zmq.asyncio
+import asyncio
 import os
 import msgpack
 import threading
 import time
 import random
+import bisect
+import itertools
+import collections
+import concurrent.futures
+from persistencia import KeyedStore, SegmentedLog
+from historico import HistoryIndex, history_key, DEFAULT_PAGE_SIZE
+from idempotencia import DedupCache, IN_PROGRESS
+from admissao import RateLimiter, parse_service_rates
+from presenca import PresenceTracker
+from replicacao import ReplicationLog, ReplicationState
+from transferencia import first_cursor, read_chunk, decode_chunk
+from relogio import ClockEstimator, best_sample
+from shards import ShardedPublisher, wait_for_shards
+from metricas import Counter, Gauge, Histogram, start_metrics_server
+from logs import setup_logging, get_logger
+from protocolo import (
+    WORKER_READY, WORKER_HEARTBEAT, WORKER_REQUEST, WORKER_REPLY,
+    HEARTBEAT_INTERVAL, HEARTBEAT_LIVENESS,
+    decode, encode_compact,
+)
 
 # --- Constantes de Caminho ---
-DATA_PATH = "/app/data"
+DATA_PATH = os.environ.get("DATA_PATH", "/app/data")
 USERS_FILE = os.path.join(DATA_PATH, "users.json")
 CHANNELS_FILE = os.path.join(DATA_PATH, "channels.json")
-MESSAGES_FILE = os.path.join(DATA_PATH, "messages.jsonl")
+MESSAGES_DIR = os.path.join(DATA_PATH, "messages")
+LEGACY_MESSAGES_FILE = os.path.join(DATA_PATH, "messages.jsonl") # Log único das versões anteriores
+REPLICATION_FILE = os.path.join(DATA_PATH, "replication.jsonl")
+REPLICATION_STATE_FILE = os.path.join(DATA_PATH, "replication_state.json")
+
+# --- Configuração do Log de Mensagens (group commit) ---
+# WAL_FSYNC: "none", "batch" (padrão) ou "record"
+WAL_FSYNC = os.environ.get("WAL_FSYNC", "batch")
+WAL_MAX_BATCH = int(os.environ.get("WAL_MAX_BATCH", "256"))
+WAL_MAX_DELAY = float(os.environ.get("WAL_MAX_DELAY_MS", "0")) / 1000
+# Snapshot de users/channels é regravado depois de max(STORE_COMPACT_MIN, len) alterações
+STORE_COMPACT_MIN = int(os.environ.get("STORE_COMPACT_MIN", "1000"))
+
+# --- Segmentos e Retenção do Log de Mensagens ---
+# O log é dividido em segmentos de MESSAGE_SEGMENT_MB; a cada
+# MESSAGE_RETENTION_INTERVAL segundos os segmentos selados são reescritos sem
+# as mensagens de canal fora da retenção (MESSAGE_RETENTION_COUNT mais
+# recentes por canal e/ou MESSAGE_RETENTION_SECONDS; 0 = sem limite; um canal
+# pode ter os seus próprios limites, ver "channel") e, com
+# MESSAGE_SEGMENT_COMPRESS=1, comprimidos com gzip.
+MESSAGE_SEGMENT_BYTES = int(float(os.environ.get("MESSAGE_SEGMENT_MB", "16")) * 1024 * 1024)
+MESSAGE_SEGMENT_COMPRESS = os.environ.get("MESSAGE_SEGMENT_COMPRESS", "0") == "1"
+MESSAGE_RETENTION_COUNT = int(os.environ.get("MESSAGE_RETENTION_COUNT", "0"))
+MESSAGE_RETENTION_SECONDS = float(os.environ.get("MESSAGE_RETENTION_SECONDS", "0"))
+MESSAGE_RETENTION_INTERVAL = float(os.environ.get("MESSAGE_RETENTION_INTERVAL", "60"))
+
+# --- Configuração da Replicação ---
+# Lotes de até REPL_BATCH_MAX operações ou REPL_BATCH_MS ms; sem escritas, um
+# lote vazio com a última sequência é publicado a cada REPL_HEARTBEAT segundos
+REPL_BATCH_MAX = int(os.environ.get("REPL_BATCH_MAX", "64"))
+REPL_BATCH_DELAY = float(os.environ.get("REPL_BATCH_MS", "5")) / 1000
+REPL_HEARTBEAT = float(os.environ.get("REPL_HEARTBEAT", "2.0"))
+REPL_RETAIN = int(os.environ.get("REPL_RETAIN", "10000"))
+REPL_CATCHUP_LIMIT = 500
+# Caminho dos lotes de replicação e dos anúncios de eleição entre servidores:
+# "mesh" (padrão): PUB/SUB direto entre as réplicas, na porta P2P + REPL_MESH_PORT_OFFSET;
+# "proxy": pelo caminho interno do proxy (PROXY_INTERNAL_*)
+REPLICATION_TRANSPORT = os.environ.get("REPLICATION_TRANSPORT", "mesh")
+REPL_MESH_PORT_OFFSET = int(os.environ.get("REPL_MESH_PORT_OFFSET", "100"))
+P2P_REQUEST_TIMEOUT = 2.0
+
+# --- Requisições em Lote (serviço "batch") ---
+BATCH_MAX_OPS = int(os.environ.get("BATCH_MAX_OPS", "500"))
+BATCH_SERVICES = ("login", "channel", "publish", "message")
+# --- Idempotência das Escritas ---
+# A resposta de uma escrita com "request_id" fica guardada por DEDUP_TTL
+# segundos (até DEDUP_MAX_ENTRIES respostas) e uma repetição recebe a mesma
+# resposta em vez de gravar e publicar de novo (ver idempotencia.py)
+DEDUP_SERVICES = BATCH_SERVICES + ("batch",)
+DEDUP_MAX_ENTRIES = int(os.environ.get("DEDUP_MAX_ENTRIES", "100000"))
+DEDUP_TTL = float(os.environ.get("DEDUP_TTL", "300"))
+# --- Controle de Admissão ---
+# Token buckets: RATE_LIMIT_CLIENT requisições/s por conexão de cliente (rajada
+# RATE_LIMIT_CLIENT_BURST) e RATE_LIMIT_SERVICES por serviço, no formato
+# "serviço=taxa[:rajada],..." (ex.: "publish=2000,history=200:400"). 0/vazio =
+# sem limite. Fora do limite a resposta é {"status": "busy", "retry_after": ms}.
+RATE_LIMIT_CLIENT = float(os.environ.get("RATE_LIMIT_CLIENT", "0"))
+RATE_LIMIT_CLIENT_BURST = float(os.environ.get("RATE_LIMIT_CLIENT_BURST", "0"))
+RATE_LIMIT_SERVICES = parse_service_rates(os.environ.get("RATE_LIMIT_SERVICES", ""))
+# Pedidos P2P de transferência (catchup, snapshot) ficam atrás dos de controle
+# (eleição, relógio), que nunca esperam por uma leitura de disco
+P2P_BULK_SERVICES = ("catchup", "snapshot")
+# Pedidos P2P que podem ficar na fila de um par antes de os novos falharem na hora
+# (par fora do ar ou lento); ver PeerPool
+P2P_PEER_QUEUE = int(os.environ.get("P2P_PEER_QUEUE", "100"))
+# --- Presença ---
+# Um usuário fica online por PRESENCE_TTL segundos depois do último keepalive
+# (serviço "presence", ou login/publish/message dele). A cada PRESENCE_INTERVAL
+# os servidores trocam as renovações e expiram os prazos vencidos; o
+# coordenador publica as mudanças no tópico "presence" (ver presenca.py).
+PRESENCE_TTL = float(os.environ.get("PRESENCE_TTL", "30"))
+PRESENCE_INTERVAL = float(os.environ.get("PRESENCE_INTERVAL", "1.0"))
+USERS_PAGE_SIZE = 100
+USERS_PAGE_MAX = 1000
+
+# --- Bootstrap por Snapshot ---
+# "auto" (padrão): um servidor que inicia sem dados copia o estado de um par
+# ativo antes de atender clientes; "off" desliga
+SNAPSHOT_BOOTSTRAP = os.environ.get("SNAPSHOT_BOOTSTRAP", "auto")
+SNAPSHOT_CHUNK_SIZE = int(os.environ.get("SNAPSHOT_CHUNK_KB", "256")) * 1024
+SNAPSHOT_RETRIES = 3
 
 # --- Constantes de Rede ---
-P2P_PORT = 5570
-ELECTION_TIMEOUT = 2.0 
+# Os endereços podem ser trocados por variáveis de ambiente para rodar
+# cópias locais dos serviços (ex.: benchmark.py)
+P2P_PORT = int(os.environ.get("P2P_PORT", "5570"))
+P2P_HOST = os.environ.get("P2P_HOST") # Padrão: o próprio SERVER_NAME
+PROXY_PUB_ADDRESS = os.environ.get("PROXY_PUB_ADDRESS", "tcp://proxy:5555")
+PROXY_SUB_ADDRESS = os.environ.get("PROXY_SUB_ADDRESS", "tcp://proxy:5556")
+# Caminho interno do proxy, só entre servidores (tópicos "replication" e "servers")
+PROXY_INTERNAL_PUB_ADDRESS = os.environ.get("PROXY_INTERNAL_PUB_ADDRESS", "tcp://proxy:5565")
+PROXY_INTERNAL_SUB_ADDRESS = os.environ.get("PROXY_INTERNAL_SUB_ADDRESS", "tcp://proxy:5566")
+REFERENCE_ADDRESS = os.environ.get("REFERENCE_ADDRESS", "tcp://referencia:5560")
+REFERENCE_PUB_ADDRESS = os.environ.get("REFERENCE_PUB_ADDRESS", "tcp://referencia:5561")
+# Intervalo (s) dos heartbeats para o referencia; aceita frações de segundo.
+# O referencia marca como suspeito/removido quem fica alguns intervalos sem heartbeat.
+MEMBERSHIP_HEARTBEAT = float(os.environ.get("MEMBERSHIP_HEARTBEAT", "1.0"))
+REFERENCE_TIMEOUT = 2.0
+BROKER_ADDRESS = os.environ.get("BROKER_ADDRESS", "tcp://broker:5558")
+ELECTION_TIMEOUT = 2.0
+# Shards do proxy e do broker (ver shards.py). Com mais de um, os endereços
+# vêm do mapa do referencia e substituem PROXY_PUB_ADDRESS/BROKER_ADDRESS.
+PROXY_SHARDS = int(os.environ.get("PROXY_SHARDS", "1"))
+BROKER_SHARDS = int(os.environ.get("BROKER_SHARDS", "1"))
+
+# --- Sincronia de Relógio (Christian's Algorithm) ---
+# A cada CLOCK_SYNC_INTERVAL segundos, independente da carga, o servidor manda
+# CLOCK_SYNC_PROBES pedidos ao coordenador e usa o de menor round trip. As
+# últimas CLOCK_SYNC_WINDOW amostras estimam o offset e o drift (ver relogio.py).
+CLOCK_SYNC_INTERVAL = float(os.environ.get("CLOCK_SYNC_INTERVAL", "5.0"))
+CLOCK_SYNC_PROBES = int(os.environ.get("CLOCK_SYNC_PROBES", "4"))
+CLOCK_SYNC_WINDOW = int(os.environ.get("CLOCK_SYNC_WINDOW", "8"))
+NUM_WORKERS = int(os.environ.get("NUM_WORKERS", "4"))
+WORKERS_ADDRESS = "inproc://workers"
+
+# --- Modo de Execução ---
+# "threads" (padrão): pool de workers + threads P2P/heartbeat
+# "asyncio": tudo como corrotinas em um único event loop (zmq.asyncio)
+SERVER_RUNTIME = os.environ.get("SERVER_RUNTIME", "threads")
+
+# --- Formato das Mensagens (ver protocolo.py) ---
+# As respostas saem no formato da requisição. WIRE_FORMAT escolhe o formato dos
+# pedidos que o próprio servidor envia (P2P e referencia): "map" (padrão,
+# compatível com versões anteriores) ou "compact"
+WIRE_FORMAT = os.environ.get("WIRE_FORMAT", "map")
 
 # --- Variáveis Globais de Servidor ---
 logical_clock = 0
 default_name = f"server_{random.randint(1000, 9999)}"
 server_name = os.environ.get("SERVER_NAME", default_name)
-p2p_address = f"tcp://{server_name}:{P2P_PORT}"
+p2p_address = f"tcp://{P2P_HOST or server_name}:{P2P_PORT}"
+
+# --- Logging (LOG_LEVEL, LOG_FORMAT; ver logs.py) ---
+setup_logging(server_name)
+log = get_logger("servidor")
+request_log = get_logger("requisicoes")
+repl_log = get_logger("replicacao")
+p2p_log = get_logger("p2p")
+election_log = get_logger("eleicao")
+clock_log = get_logger("relogio")
+bootstrap_log = get_logger("bootstrap")
+membership_log = get_logger("membros")
 
 server_rank = None
 clock_mutex = threading.Lock()
 
 coordinator_name = None
-active_servers = [] 
-message_counter = 0 
-MSG_COUNT_TRIGGER = 10 
-election_in_progress = threading.Lock() 
+active_servers = []
+members = {} # nome -> servidor, mantido pelas mudanças publicadas pelo referencia
+membership_version = None # Versão da lista local (None = ainda não sincronizada)
+election_in_progress = threading.Lock()
+
+
+# --- Métricas (expostas em /metrics se METRICS_PORT estiver definida) ---
+REQUESTS = Counter("chat_requests_total", "Requisições de clientes por serviço.", ("service",))
+REQUEST_SECONDS = Histogram("chat_request_seconds", "Tempo de atendimento de uma requisição (inclui a espera pelo disco).", ("service",))
+SAVE_MESSAGE_SECONDS = Histogram("chat_save_message_seconds", "Tempo para enfileirar uma mensagem no log.")
+STORE_WRITE_SECONDS = Histogram("chat_store_write_seconds", "Tempo de escrita em users/channels.", ("store",))
+DURABLE_WAIT_SECONDS = Histogram("chat_durable_wait_seconds", "Espera até as escritas de uma requisição estarem duráveis.")
+REPLICATION_LAG_SECONDS = Histogram("chat_replication_lag_seconds", "Tempo entre a escrita na origem e a aplicação aqui.", ("origin",))
+REPLICATION_APPLIED = Counter("chat_replication_applied_total", "Operações replicadas aplicadas por origem.", ("origin",))
+REPLICATION_BEHIND = Gauge("chat_replication_behind_ops", "Operações anunciadas pela origem e ainda não aplicadas.", ("origin",))
+ELECTION_SECONDS = Histogram("chat_election_seconds", "Duração das eleições (Bully).")
+CLOCK_SYNC_RTT_SECONDS = Histogram("chat_clock_sync_rtt_seconds", "Round trip da sincronia de relógio com o coordenador.")
+CLOCK_OFFSET_SECONDS = Gauge("chat_clock_offset_seconds", "Diferença estimada entre o relógio do coordenador e o local.")
+CLOCK_OFFSET_SECONDS.set_function(lambda: wall_clock.offset_at(time.time_ns()) / 1e9)
+CLOCK_DRIFT_PPM = Gauge("chat_clock_drift_ppm", "Desvio de frequência estimado em relação ao coordenador (ppm).")
+CLOCK_DRIFT_PPM.set_function(lambda: wall_clock.drift * 1e6)
+LOGICAL_CLOCK = Gauge("chat_logical_clock", "Valor atual do relógio lógico (Lamport).")
+LOGICAL_CLOCK.set_function(lambda: logical_clock)
+MESH_PEERS = Gauge("chat_replication_mesh_peers", "Servidores conectados na malha de replicação (inclui este).")
+MESH_PEERS.set_function(lambda: len(mesh_peers))
+P2P_REQUEST_SECONDS = Histogram("chat_p2p_request_seconds", "Round trip dos pedidos P2P pelo pool de conexões.", ("service",))
+P2P_TIMEOUTS = Counter("chat_p2p_timeouts_total", "Pedidos P2P sem resposta dentro do prazo.", ("service",))
+P2P_CONNECTIONS = Gauge("chat_p2p_connections", "Conexões P2P abertas no pool (uma por par).")
+MESSAGE_LOG_BYTES = Gauge("chat_message_log_bytes", "Bytes em disco dos segmentos do log de mensagens.")
+MESSAGE_LOG_SEGMENTS = Gauge("chat_message_log_segments", "Segmentos do log de mensagens (inclui o ativo).")
+DEDUP_HITS = Counter("chat_dedup_hits_total", "Escritas repetidas (mesmo request_id) não executadas de novo.", ("path",))
+DEDUP_ENTRIES = Gauge("chat_dedup_entries", "Respostas guardadas no cache de idempotência.")
+REQUESTS_REJECTED = Counter("chat_requests_rejected_total", "Requisições recusadas com 'busy' pelo controle de admissão.", ("limit",))
+MESSAGES_EXPIRED = Counter("chat_messages_expired_total", "Mensagens de canal removidas pela retenção.")
+USERS_ONLINE = Gauge("chat_users_online", "Usuários online (keepalive dentro do PRESENCE_TTL).")
+PRESENCE_CHANGES = Counter("chat_presence_changes_total", "Mudanças de presença publicadas no tópico 'presence'.", ("status",))
+CLIENT_SERVICES = ("login", "channel", "publish", "message", "users", "channels", "history", "batch", "presence")
+BATCH_OPS = Histogram("chat_batch_ops", "Operações por requisição 'batch'.", buckets=(1, 2, 5, 10, 20, 50, 100, 200, 500, 1000))
+
+
+# --- Relógio Físico ---
+# Relógio de parede corrigido pelo offset em relação ao coordenador. Os
+# timestamps gerados pelo servidor (escritas e mensagens, na origem;
+# respostas; lotes de replicação) vêm dele. O coordenador serve o próprio relógio corrigido: ao
+# assumir, ele mantém a reta que tinha, e o tempo do cluster não salta.
+wall_clock = ClockEstimator(window=CLOCK_SYNC_WINDOW)
+clock_reference = None # Coordenador a que as amostras atuais se referem
+
+def timestamp():
+    return wall_clock.now_datetime().isoformat()
+
+def pack_reply(reply, compact):
+    """Serializa uma resposta no formato da requisição, com o timestamp do relógio corrigido."""
+    if compact:
+        return encode_compact(reply, wall_clock.now_ns() // 1_000_000)
+    reply["data"]["timestamp"] = timestamp()
+    return msgpack.packb(reply, default=str)
+
+def pack_request(message):
+    """Serializa um pedido enviado por este servidor (P2P, referencia) no WIRE_FORMAT."""
+    if WIRE_FORMAT == "compact":
+        return encode_compact(message, wall_clock.now_ns() // 1_000_000)
+    return msgpack.packb(message, default=str)
+
+def unpack(packed):
+    return decode(packed)[0]
 
 
 # --- Inicialização do ZeroMQ ---
 context = zmq.Context()
 
-# --- Socket 1: (Main Thread) REQ/REP para Clientes ---
-rep_socket = context.socket(zmq.REP)
-rep_socket.connect("tcp://broker:5558")
+# --- Shards do Proxy e do Broker ---
+# Resolvidos uma vez, antes de atender clientes (ver resolve_shards)
+proxy_pub_addresses = [PROXY_PUB_ADDRESS]
+broker_addresses = [BROKER_ADDRESS]
+
+def resolve_shards():
+    """Com PROXY_SHARDS/BROKER_SHARDS > 1, espera o mapa completo no referencia."""
+    global proxy_pub_addresses, broker_addresses
+    if PROXY_SHARDS > 1:
+        proxy_pub_addresses = [e["xsub"] for e in wait_for_shards(context, REFERENCE_ADDRESS, "proxy", PROXY_SHARDS)]
+        log.info("Shards do proxy: %s", proxy_pub_addresses)
+    if BROKER_SHARDS > 1:
+        broker_addresses = [e["backend"] for e in wait_for_shards(context, REFERENCE_ADDRESS, "broker", BROKER_SHARDS)]
+        log.info("Shards do broker: %s", broker_addresses)
+
+# --- Socket PUB para Clientes (um por thread, sockets ZMQ não são thread-safe) ---
+_thread_local = threading.local()
+
+def get_pub_socket():
+    """Retorna o socket PUB da thread atual (um por shard do proxy), criando-o na primeira chamada."""
+    pub = getattr(_thread_local, "pub_socket", None)
+    if pub is None:
+        if len(proxy_pub_addresses) > 1:
+            pub = ShardedPublisher(context, proxy_pub_addresses)
+        else:
+            pub = context.socket(zmq.PUB)
+            pub.connect(proxy_pub_addresses[0])
+        _thread_local.pub_socket = pub
+    return pub
+
+# --- PUB Interno (replicação e eleição) ---
+# Um único socket, protegido por lock: as eleições rodam em threads novas, e
+# um PUB recém-conectado perde o que envia antes de a conexão ficar pronta
+# (o anúncio de coordenador se perderia).
+_internal_pub = None
+_internal_pub_lock = threading.Lock()
+_mesh_connected = set()
+_mesh_synced_version = -1
+
+def publish_internal(topic, message):
+    """Publica `message` no tópico interno `topic` ("replication", "servers" ou "presence")."""
+    with _internal_pub_lock:
+        _internal_pub_socket().send_multipart([topic, msgpack.packb(message, default=str)])
+
+def _internal_pub_socket():
+    """Chamada com _internal_pub_lock. Na malha, acompanha as conexões com os pares conhecidos."""
+    global _internal_pub
+    if _internal_pub is None:
+        _internal_pub = context.socket(zmq.PUB)
+        if REPLICATION_TRANSPORT != "mesh":
+            _internal_pub.connect(PROXY_INTERNAL_PUB_ADDRESS)
+    if REPLICATION_TRANSPORT == "mesh" and _mesh_synced_version != mesh_version:
+        _sync_mesh_connections(_internal_pub)
+    return _internal_pub
+
+# --- Malha de Replicação (REPLICATION_TRANSPORT=mesh) ---
+# Cada servidor faz bind do seu SUB de anúncios no endereço da malha
+# (P2P_PORT + REPL_MESH_PORT_OFFSET) e o PUB interno conecta no SUB de cada
+# par: os da lista de membros e as origens dos lotes recebidos. As conexões
+# são feitas assim que a malha muda, antes do próximo envio. Um par novo
+# ainda perde o que é publicado antes de a conexão ficar pronta; o buraco na
+# sequência dispara o catch-up normal.
+_mesh_lock = threading.Lock()
+mesh_peers = frozenset() # Endereços da malha dos pares (inclui este servidor)
+mesh_version = 0 # Incrementa a cada mudança em mesh_peers
+
+def mesh_address(address):
+    """Endereço da malha de um servidor a partir do endereço P2P (tcp://host:porta)."""
+    host, port = address.rsplit(":", 1)
+    return f"{host}:{int(port) + REPL_MESH_PORT_OFFSET}"
+
+def update_mesh_peers(servers):
+    """Troca os pares da malha pelos servidores da lista de membros."""
+    global mesh_peers, mesh_version
+    peers = frozenset(mesh_address(s["address"]) for s in servers if s.get("address")) | {mesh_address(p2p_address)}
+    with _mesh_lock:
+        if peers == mesh_peers:
+            return
+        mesh_peers, mesh_version = peers, mesh_version + 1
+    repl_log.info("Malha de replicação: %s", sorted(peers))
+    with _internal_pub_lock:
+        _internal_pub_socket()
+
+def add_mesh_peer(address):
+    """Inclui na malha a origem de um lote ainda desconhecida (antes da próxima mudança na lista)."""
+    global mesh_peers, mesh_version
+    if not address or mesh_address(address) in mesh_peers:
+        return
+    with _mesh_lock:
+        mesh_peers, mesh_version = mesh_peers | {mesh_address(address)}, mesh_version + 1
+    repl_log.info("Par novo na malha de replicação: %s", mesh_address(address))
+    with _internal_pub_lock:
+        _internal_pub_socket()
+
+def _sync_mesh_connections(pub):
+    global _mesh_synced_version
+    with _mesh_lock:
+        peers, version = mesh_peers, mesh_version
+    for address in _mesh_connected - peers:
+        pub.disconnect(address)
+        _mesh_connected.discard(address)
+    for address in peers - _mesh_connected:
+        try:
+            pub.connect(address)
+            _mesh_connected.add(address)
+        except zmq.ZMQError as e:
+            repl_log.warning("Não foi possível conectar na malha em %s: %r", address, e)
+    _mesh_synced_version = version
+
+# --- Conexões P2P (pool de DEALERs) ---
+# Eleição, sincronia de relógio, catch-up e snapshot usam uma conexão DEALER
+# de longa duração por par, em vez de um REQ novo a cada pedido. Todos os
+# DEALERs pertencem a uma única thread de I/O; quem pede manda o pedido por um
+# PUSH inproc e espera um Future. Cada pedido leva um id no envelope
+# ([id, "", pedido]), que o ROUTER do par devolve com a resposta: vários
+# pedidos ao mesmo par podem estar em andamento, e uma resposta atrasada
+# (de um pedido que já expirou) é descartada.
+class PeerPool:
+    def __init__(self, ctx, endpoint="inproc://p2p-pool"):
+        self.context = ctx
+        self.pending = {} # id -> (endereço, Future)
+        self.peers = {} # endereço -> DEALER (só a thread de I/O mexe aqui)
+        self._ids = itertools.count(1)
+        self._lock = threading.Lock()
+        self._inbox = ctx.socket(zmq.PULL)
+        self._inbox.bind(endpoint)
+        self._outbox = ctx.socket(zmq.PUSH)
+        self._outbox.connect(endpoint)
+        self._thread = threading.Thread(target=self._loop, name="p2p-pool", daemon=True)
+
+    def start(self):
+        self._thread.start()
+        return self
 
-# --- Socket 2: (Main Thread) PUB para Clientes ---
-pub_socket = context.socket(zmq.PUB)
-pub_socket.connect("tcp://proxy:5555") 
+    def submit(self, address, message):
+        """Envia `message` a `address` e retorna (id, Future com a resposta em bytes)."""
+        req_id = next(self._ids).to_bytes(8, "big")
+        future = concurrent.futures.Future()
+        with self._lock:
+            self.pending[req_id] = (address, future)
+            self._outbox.send_multipart([b"req", address.encode(), req_id, pack_request(message)])
+        return req_id, future
 
-# (As funções de persistência load_data, save_data, save_message não mudam)
-def load_data(filename):
-    os.makedirs(os.path.dirname(filename), exist_ok=True) 
-    if os.path.exists(filename):
-        with open(filename, 'r') as f:
+    def forget(self, req_id):
+        """Descarta um pedido (expirado ou abandonado); a resposta, se vier, é ignorada."""
+        with self._lock:
+            self.pending.pop(req_id, None)
+
+    def retain(self, addresses):
+        """Fecha as conexões com pares fora de `addresses` (chamado quando a lista de membros muda)."""
+        with self._lock:
+            self._outbox.send_multipart([b"retain"] + [a.encode() for a in addresses])
+
+    def _fail(self, req_id, error):
+        with self._lock:
+            entry = self.pending.pop(req_id, None)
+        if entry and not entry[1].done():
+            entry[1].set_exception(error)
+
+    def _dealer(self, address, poller):
+        dealer = self.peers.get(address)
+        if dealer is None:
+            dealer = self.context.socket(zmq.DEALER)
+            dealer.setsockopt(zmq.LINGER, 0)
+            dealer.setsockopt(zmq.SNDHWM, P2P_PEER_QUEUE)
+            dealer.connect(address)
+            poller.register(dealer, zmq.POLLIN)
+            self.peers[address] = dealer
+            p2p_log.debug("Conexão P2P aberta com %s", address)
+        return dealer
+
+    def _close(self, address, poller):
+        dealer = self.peers.pop(address)
+        poller.unregister(dealer)
+        dealer.close()
+        with self._lock:
+            orphans = [req_id for req_id, (a, _) in self.pending.items() if a == address]
+        for req_id in orphans:
+            self._fail(req_id, zmq.Again("Par removido da lista de membros"))
+        p2p_log.debug("Conexão P2P fechada com %s", address)
+
+    def _loop(self):
+        poller = zmq.Poller()
+        poller.register(self._inbox, zmq.POLLIN)
+        while True:
             try:
-                content = f.read()
-                return json.loads(content) if content else {}
-            except json.JSONDecodeError:
-                return {}
-    return {}
-
-def save_data(data, filename):
-    os.makedirs(os.path.dirname(filename), exist_ok=True)
-    with open(filename, 'w') as f:
-        json.dump(data, f, indent=4)
-
-def save_message(data_dict, filename):
+                for sock, _ in poller.poll():
+                    if sock is self._inbox:
+                        self._handle_command(self._inbox.recv_multipart(), poller)
+                        continue
+                    req_id, _, reply = sock.recv_multipart()
+                    with self._lock:
+                        entry = self.pending.pop(req_id, None)
+                    if entry and not entry[1].done():
+                        entry[1].set_result(reply)
+            except Exception as e:
+                p2p_log.error("Erro no pool de conexões P2P: %r", e)
+
+    def _handle_command(self, frames, poller):
+        if frames[0] == b"req":
+            address, req_id, packed = frames[1].decode(), frames[2], frames[3]
+            try:
+                self._dealer(address, poller).send_multipart([req_id, b"", packed], zmq.NOBLOCK)
+            except zmq.ZMQError as e:
+                self._fail(req_id, e) # Fila do par cheia (par fora do ar) ou endereço inválido
+        elif frames[0] == b"retain":
+            keep = {f.decode() for f in frames[1:]}
+            for address in [a for a in self.peers if a not in keep]:
+                self._close(address, poller)
+
+
+peer_pool = PeerPool(context).start()
+P2P_CONNECTIONS.set_function(lambda: len(peer_pool.peers))
+
+def peer_request(address, message, timeout=P2P_REQUEST_TIMEOUT):
+    """Pedido P2P pelo pool; retorna a resposta ou levanta zmq.Again no timeout."""
+    service = message.get("service")
+    started = time.perf_counter()
+    req_id, future = peer_pool.submit(address, message)
+    try:
+        reply = future.result(timeout)
+    except concurrent.futures.TimeoutError:
+        P2P_TIMEOUTS.labels(service).inc()
+        raise zmq.Again(f"Sem resposta de {address} em {timeout}s")
+    finally:
+        peer_pool.forget(req_id)
+    P2P_REQUEST_SECONDS.labels(service).observe(time.perf_counter() - started)
+    return unpack(reply)
+
+async def async_peer_request(address, message, timeout=P2P_REQUEST_TIMEOUT):
+    """Como peer_request, esperando a resposta no event loop."""
+    service = message.get("service")
+    started = time.perf_counter()
+    req_id, future = peer_pool.submit(address, message)
+    try:
+        reply = await asyncio.wait_for(asyncio.wrap_future(future), timeout)
+    except asyncio.TimeoutError:
+        P2P_TIMEOUTS.labels(service).inc()
+        raise zmq.Again(f"Sem resposta de {address} em {timeout}s")
+    finally:
+        peer_pool.forget(req_id)
+    P2P_REQUEST_SECONDS.labels(service).observe(time.perf_counter() - started)
+    return unpack(reply)
+
+# Log de mensagens em segmentos, com escrita em lote, e o índice do
+# histórico (reconstruído a partir do log e depois alimentado por ele)
+message_log = SegmentedLog(MESSAGES_DIR, segment_bytes=MESSAGE_SEGMENT_BYTES, fsync_policy=WAL_FSYNC,
+                           max_batch=WAL_MAX_BATCH, max_delay=WAL_MAX_DELAY,
+                           legacy_file=LEGACY_MESSAGES_FILE)
+history = HistoryIndex(message_log)
+MESSAGE_LOG_BYTES.set_function(message_log.disk_usage)
+MESSAGE_LOG_SEGMENTS.set_function(message_log.segment_count)
+
+def save_message(data_dict):
+    """
+    Enfileira a mensagem no log e retorna o número de sequência.
+    A mensagem só está durável depois de message_log.wait_durable(seq).
+    Retorna None se não foi possível enfileirar.
+    """
     try:
-        os.makedirs(os.path.dirname(filename), exist_ok=True)
-        json_line = json.dumps(data_dict)
-        with open(filename, 'a') as f:
-            f.write(json_line + '\n')
+        with SAVE_MESSAGE_SECONDS.time():
+            return message_log.append(data_dict)
     except Exception as e:
-        print(f"[{server_name}] [ERRO AO SALVAR MENSAGEM] {e}")
+        log.error("Erro ao salvar mensagem: %r", e)
+        return None
 
-# Carrega os dados
-users = load_data(USERS_FILE)
-channels = load_data(CHANNELS_FILE)
+def channel_retention(channel_name):
+    """(quantidade, segundos) de retenção do canal: os do próprio canal ou os padrões."""
+    retention = (channels.get(channel_name) or {}).get("retention") or {}
+    return (int(retention.get("count", MESSAGE_RETENTION_COUNT) or 0),
+            float(retention.get("seconds", MESSAGE_RETENTION_SECONDS) or 0))
 
-def replicate_request(request):
-    """Publica a requisição original em um tópico de replicação."""
+def maintain_message_log():
+    """
+    Uma passada de retenção sobre os segmentos selados do log de mensagens:
+    reescreve os que têm mensagens expiradas (tirando-as também do índice) e
+    comprime os demais se MESSAGE_SEGMENT_COMPRESS. O segmento ativo não é
+    tocado. A idade de uma mensagem é a do seu segmento (instante em que foi
+    selado), então a retenção por tempo pode guardar um segmento a mais.
+    """
+    sealed = message_log.sealed_segments()
+    if not sealed:
+        return
+    now = time.time()
+    bases = [base for base, _, _, _ in sealed]
+
+    def age_of(offset):
+        i = bisect.bisect_right(bases, offset) - 1
+        return now - sealed[i][2] if i >= 0 else 0
+
+    expired = history.expired(channel_retention, sealed[-1][1], age_of)
+    by_segment = {}
+    for key, offsets in expired.items():
+        for offset in offsets:
+            by_segment.setdefault(bases[bisect.bisect_right(bases, offset) - 1], set()).add(offset)
+
+    for base, _, _, compressed in sealed:
+        offsets = by_segment.get(base)
+        if offsets:
+            removed = message_log.rewrite(base, lambda offset: offset not in offsets, compress=MESSAGE_SEGMENT_COMPRESS)
+            MESSAGES_EXPIRED.inc(removed)
+        elif MESSAGE_SEGMENT_COMPRESS and not compressed:
+            message_log.rewrite(base, compress=True)
+    # Só depois da troca dos arquivos: até lá as leituras ainda acham os registros
+    history.discard(expired)
+    if expired:
+        log.info("Retenção: %d mensagens expiradas em %d segmentos",
+                 sum(len(offsets) for offsets in expired.values()), len(by_segment))
+
+def message_retention_thread():
+    while True:
+        time.sleep(MESSAGE_RETENTION_INTERVAL)
+        try:
+            maintain_message_log()
+        except Exception as e:
+            log.error("Erro na retenção do log de mensagens: %r", e)
+
+# Limites de taxa por conexão de cliente e por serviço (ver admissao.py)
+client_limiter = RateLimiter(RATE_LIMIT_CLIENT, RATE_LIMIT_CLIENT_BURST)
+service_limiters = {service: RateLimiter(rate, burst, max_keys=1) for service, (rate, burst) in RATE_LIMIT_SERVICES.items()}
+
+# Respostas das escritas com request_id (cliente e replicação)
+dedup = DedupCache(max_entries=DEDUP_MAX_ENTRIES, ttl=DEDUP_TTL)
+DEDUP_ENTRIES.set_function(lambda: len(dedup))
+
+# Usuários online. As mudanças locais esperam em _presence_outbox até o
+# próximo envio aos outros servidores; as transições (online <-> offline) em
+# _presence_changes, até o coordenador publicá-las no tópico "presence".
+presence = PresenceTracker(ttl=PRESENCE_TTL)
+USERS_ONLINE.set_function(lambda: len(presence))
+_presence_lock = threading.Lock()
+_presence_outbox = {}    # usuário -> "online" | "offline"
+_presence_changes = []   # (usuário, status)
+
+# Carrega os dados (snapshot + changelog de alterações)
+# Cada store é particionado em shards com locks próprios (não usa o clock_mutex)
+users = KeyedStore(USERS_FILE, fsync_policy=WAL_FSYNC, compact_min=STORE_COMPACT_MIN)
+channels = KeyedStore(CHANNELS_FILE, fsync_policy=WAL_FSYNC, compact_min=STORE_COMPACT_MIN)
+
+# Log de replicação das escritas locais e posição aplicada de cada origem
+replication_log = ReplicationLog(REPLICATION_FILE, retain=REPL_RETAIN, batch_max=REPL_BATCH_MAX,
+                                 batch_delay=REPL_BATCH_DELAY, fsync_policy=WAL_FSYNC,
+                                 wall_clock=wall_clock.now)
+
+
+# --- Relógio Lógico (Lamport) ---
+def tick():
+    """Incrementa o relógio lógico e retorna o novo valor."""
+    global logical_clock
+    with clock_mutex:
+        logical_clock += 1
+        return logical_clock
+
+def merge_clock(message):
+    """Aplica max(local, recebido) com o clock de uma mensagem e retorna o clock recebido."""
+    global logical_clock
+    received_clock = message.get("data", {}).get("clock", 0)
+    with clock_mutex:
+        logical_clock = max(logical_clock, received_clock)
+    return received_clock
+
+def build_message(service, **data):
+    """Monta uma mensagem {"service", "data"} com timestamp e um novo clock."""
+    return {
+        "service": service,
+        "data": {**data, "timestamp": timestamp(), "clock": tick()}
+    }
+
+
+# --- Tarefas em Segundo Plano ---
+_background_tasks = set()
+
+def run_in_background(sync_fn, async_fn):
+    """
+    Dispara uma tarefa de fundo (eleição, sincronia) conforme o modo de execução:
+    uma thread com `sync_fn` ou uma tarefa no event loop com a corrotina `async_fn`.
+    """
+    if SERVER_RUNTIME == "asyncio":
+        # Pode vir do pool de clientes ou dos anúncios (fora do loop): agenda no loop
+        event_loop.call_soon_threadsafe(_create_background_task, async_fn)
+    else:
+        threading.Thread(target=sync_fn, daemon=True).start()
+
+def _create_background_task(async_fn):
+    task = asyncio.get_running_loop().create_task(async_fn())
+    _background_tasks.add(task)
+    task.add_done_callback(_background_tasks.discard)
+
+def trigger_election():
+    """Inicia uma eleição se nenhuma estiver em andamento."""
+    if election_in_progress.acquire(blocking=False):
+        run_in_background(start_election, async_start_election)
+
+
+def replicate_request(request, clock, reply_data=None):
+    """
+    Registra a requisição original no log de replicação, com o clock lógico
+    que este servidor atribuiu à escrita. Ela é publicada no próximo lote.
+    Com request_id, a resposta vai junto, para uma réplica responder igual
+    a uma repetição.
+    """
+    if reply_data is not None and request_id_of(request) is not None:
+        request = dict(request, reply=cacheable_reply(reply_data))
     try:
-        # print(f"[{server_name}] Replicando: {request.get('service')}")
-        pub_socket.send_multipart([
-            b"replication", # O tópico
-            msgpack.packb(request, default=str) # O payload é a requisição inteira
-        ])
+        replication_log.submit(request, clock)
     except Exception as e:
-        print(f"[{server_name}] Erro ao replicar request: {e}")
+        repl_log.error("Erro ao replicar request: %r", e)
+
+def publish_replication_batch(ops):
+    """
+    Publica um lote no tópico 'replication'. Lotes vazios servem de
+    heartbeat: carregam a última sequência para que as réplicas percebam lotes perdidos.
+    """
+    frame = build_message(
+        "replication", origin=server_name, address=p2p_address, epoch=replication_log.epoch,
+        ops=ops, last_seq=replication_log.published_seq
+    )
+    publish_internal(b"replication", frame)
+
+def replication_flusher_thread():
+    while True:
+        try:
+            ops = replication_log.take_batch(REPL_HEARTBEAT)
+            publish_replication_batch(ops)
+        except Exception as e:
+            repl_log.error("Erro ao publicar lote de replicação: %r", e)
+
+
+# --- Presença ---
+def mark_presence(user, online=True):
+    """Keepalive (ou saída, com online=False) de um cliente deste servidor."""
+    changed = presence.touch(user) if online else presence.leave(user)
+    status = "online" if online else "offline"
+    with _presence_lock:
+        _presence_outbox[user] = status
+        if changed:
+            _presence_changes.append((user, status))
+
+def apply_presence(data):
+    """Aplica as renovações e saídas anunciadas por outro servidor."""
+    changes = []
+    for user in data.get("online", []):
+        if presence.touch(user):
+            changes.append((user, "online"))
+    for user in data.get("offline", []):
+        if presence.leave(user):
+            changes.append((user, "offline"))
+    if changes:
+        with _presence_lock:
+            _presence_changes.extend(changes)
+
+def presence_tick():
+    """
+    Expira os prazos vencidos, anuncia aos outros servidores as mudanças
+    locais desde o último tick e, no coordenador, publica as transições no
+    tópico "presence". Cada servidor expira pelo seu próprio heap; como
+    todos recebem as mesmas renovações, só o coordenador publica, para o
+    cliente não receber a mesma transição de cada servidor.
+    """
+    expired = presence.expire()
+    with _presence_lock:
+        outbox = _presence_outbox.copy()
+        _presence_outbox.clear()
+        changes = _presence_changes[:]
+        _presence_changes.clear()
+    changes.extend((user, "offline") for user in expired)
+
+    if outbox:
+        publish_internal(b"presence", build_message(
+            "presence", origin=server_name,
+            online=[user for user, status in outbox.items() if status == "online"],
+            offline=[user for user, status in outbox.items() if status == "offline"]
+        ))
+    if changes and coordinator_name == server_name:
+        pub = get_pub_socket()
+        for user, status in changes:
+            payload = {"user": user, "status": status, "timestamp": timestamp(), "clock": tick()}
+            pub.send_multipart([b"presence", msgpack.packb(payload, default=str)])
+            PRESENCE_CHANGES.labels(status).inc()
+
+def presence_thread():
+    get_pub_socket() # Conecta o PUB antes: um PUB recém-conectado perde as primeiras mensagens
+    while True:
+        time.sleep(PRESENCE_INTERVAL)
+        try:
+            presence_tick()
+        except Exception as e:
+            log.error("Erro na presença: %r", e)
+
+_sorted_users = []
+
+def sorted_user_names():
+    """Nomes de todos os usuários em ordem, refeitos só quando entra um usuário novo."""
+    global _sorted_users
+    names = _sorted_users
+    if len(names) != len(users):
+        names = _sorted_users = sorted(users.keys())
+    return names
+
+def users_reply(data):
+    """
+    Serviço 'users'. Sem parâmetros, todos os usuários (como nas versões
+    anteriores). Com {"online": true|false} filtra pela presença, e
+    "after" (o "next" da página anterior) e "limit" paginam pelo nome.
+    """
+    online = data.get("online")
+    after = data.get("after")
+    if online is None and after is None and data.get("limit") is None:
+        return {"users": users.keys()}
 
-def handle_replication(request):
+    if after is not None and not isinstance(after, str):
+        return {"status": "erro", "description": "'after' deve ser um texto"}
+    try:
+        limit = max(1, min(int(data.get("limit") or USERS_PAGE_SIZE), USERS_PAGE_MAX))
+    except (TypeError, ValueError):
+        return {"status": "erro", "description": "'limit' deve ser um número"}
+    if online:
+        names = presence.page(after, limit + 1)
+    else:
+        all_names = sorted_user_names()
+        start = bisect.bisect_right(all_names, after) if after is not None else 0
+        if online is None:
+            names = all_names[start:start + limit + 1]
+        else:
+            names = []
+            for i in range(start, len(all_names)):
+                if all_names[i] not in presence:
+                    names.append(all_names[i])
+                    if len(names) > limit:
+                        break
+    more = len(names) > limit
+    names = names[:limit]
+    return {"status": "OK", "users": names, "next": names[-1] if more else None}
+
+def handle_replication(request, origin_clock):
     """
-    Processa uma requisição replicada recebida do tópico PUB/SUB.
+    Aplica uma requisição replicada de outro servidor.
     Apenas executa a lógica de *escrita*.
     """
-    global users, channels # Precisa modificar o global
     service = request.get("service")
     data = request.get("data", {})
 
+    field = invalid_name_field(service, data)
+    if field is not None:
+        repl_log.warning("Replicação %s ignorada: '%s' não é um texto", service, field)
+        return
+
+    # A mesma escrita pode chegar de duas origens: a repetição de um cliente
+    # depois de um failover é executada pelo outro servidor
+    request_id = request_id_of(request)
+    if request_id is not None and not dedup.claim(request_id)[0]:
+        DEDUP_HITS.labels("replication").inc()
+        repl_log.debug("Replicação repetida ignorada (%s): %s", service, request_id)
+        return
+
     try:
-        if service == "login":
+        if service == "batch":
+            # Lote de um cliente: cada operação leva o clock atribuído pela origem
+            for op in data.get("ops", []):
+                handle_replication(op, op.get("clock", origin_clock))
+
+        elif service == "login":
             user_name = data.get("user")
             timestamp = data.get("timestamp")
-            if user_name and user_name not in users:
-                with clock_mutex: # Protege o 'users' dict e o 'save_data'
-                    users[user_name] = {"timestamp": timestamp}
-                    save_data(users, USERS_FILE)
-                print(f"[{server_name}] REPLICADO login: {user_name}")
+            # put_if_absent é atômico (lock interno do KeyedStore)
+            if user_name and users.put_if_absent(user_name, {"timestamp": timestamp}) is not None:
+                repl_log.debug("Replicado login: %s", user_name)
 
         elif service == "channel":
             channel_name = data.get("channel")
-            timestamp = data.get("timestamp")
-            if channel_name and channel_name not in channels:
-                with clock_mutex: # Protege 'channels' e 'save_data'
-                    channels[channel_name] = {"timestamp": timestamp}
-                    save_data(channels, CHANNELS_FILE)
-                print(f"[{server_name}] REPLICADO canal: {channel_name}")
-        
+            if channel_name and channels.put_if_absent(channel_name, channel_value(data)) is not None:
+                repl_log.debug("Replicado canal: %s", channel_name)
+
         elif service == "publish":
             message_to_log = {
                 "type": "channel",
                 "channel": data.get("channel"),
                 "user": data.get("user"),
                 "message": data.get("message"),
-                "timestamp": data.get("timestamp")
+                "timestamp": data.get("timestamp"),
+                "clock": origin_clock
             }
-            save_message(message_to_log, MESSAGES_FILE) # save_message já é thread-safe
-            print(f"[{server_name}] REPLICADO publish: {data.get('user')} -> {data.get('channel')}")
+            save_message(message_to_log) # save_message já é thread-safe
+            repl_log.debug("Replicado publish: %s -> %s", data.get("user"), data.get("channel"))
 
         elif service == "message":
             message_to_log = {
@@ -131,13 +841,285 @@ def handle_replication(request):
                 "from_user": data.get("src"),
                 "to_user": data.get("dst"),
                 "message": data.get("message"),
-                "timestamp": data.get("timestamp")
+                "timestamp": data.get("timestamp"),
+                "clock": origin_clock
             }
-            save_message(message_to_log, MESSAGES_FILE)
-            print(f"[{server_name}] REPLICADO msg: {data.get('src')} -> {data.get('dst')}")
+            save_message(message_to_log)
+            repl_log.debug("Replicado msg: %s -> %s", data.get("src"), data.get("dst"))
+
+        if request_id is not None:
+            dedup.complete(request_id, request.get("reply") or {"status": "OK"})
+
+    except Exception as e:
+        repl_log.error("Erro ao processar replicação %s: %r", service, e)
+        if request_id is not None:
+            dedup.release(request_id)
+
+def apply_replicated_op(origin, op):
+    handle_replication(op["request"], op["clock"])
+    REPLICATION_APPLIED.labels(origin).inc()
+    if "time" in op:
+        REPLICATION_LAG_SECONDS.labels(origin).observe(max(0.0, wall_clock.now() - op["time"]))
+
+replication_state = ReplicationState(
+    KeyedStore(REPLICATION_STATE_FILE, fsync_policy=WAL_FSYNC, compact_min=STORE_COMPACT_MIN),
+    apply_replicated_op
+)
+
+
+# --- Catch-up da Replicação ---
+# Quando um lote chega com lacuna (ou o heartbeat anuncia uma sequência que
+# não temos), as operações que faltam são pedidas à origem via P2P ('catchup').
+_catch_up_lock = threading.Lock()
+_catching_up = set()
+
+def start_catch_up(origin, address, epoch):
+    with _catch_up_lock:
+        if origin in _catching_up:
+            return
+        _catching_up.add(origin)
+    run_in_background(lambda: catch_up(origin, address, epoch),
+                      lambda: async_catch_up(origin, address, epoch))
+
+def catch_up_request(origin):
+    return build_message("catchup", origin=origin, limit=REPL_CATCHUP_LIMIT,
+                         **{"from": replication_state.applied(origin) + 1})
+
+def apply_catch_up_reply(origin, epoch, reply):
+    """Aplica uma resposta de catch-up. Retorna True se ainda falta algo."""
+    merge_clock(reply)
+    data = reply.get("data", {})
+    if data.get("epoch") != epoch:
+        return False # A origem reiniciou com um log novo; o próximo lote dispara outro catch-up
+    first_seq = data.get("first_seq", 1)
+    if replication_state.applied(origin) + 1 < first_seq:
+        repl_log.warning("Operações de '%s' anteriores a %d não estão mais disponíveis.", origin, first_seq)
+        replication_state.skip_to(origin, epoch, first_seq)
+    return bool(data.get("ops")) and replication_state.offer(origin, epoch, data.get("ops", []), data.get("last_seq", 0))
+
+def catch_up(origin, address, epoch):
+    try:
+        repl_log.info("Catch-up de '%s' a partir de %d", origin, replication_state.applied(origin) + 1)
+        while apply_catch_up_reply(origin, epoch, peer_request(address, catch_up_request(origin))):
+            pass
+    except Exception as e:
+        repl_log.error("Erro no catch-up de '%s': %r", origin, e)
+    finally:
+        with _catch_up_lock:
+            _catching_up.discard(origin)
+
+def p2p_request(address, message, timeout=P2P_REQUEST_TIMEOUT):
+    """
+    Envia uma requisição avulsa (REQ) e retorna a resposta, ou levanta
+    zmq.Again no timeout. Usada com o referencia; entre servidores, ver peer_request.
+    """
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+    socket.setsockopt(zmq.SNDTIMEO, int(timeout * 1000))
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.connect(address)
+    try:
+        socket.send(pack_request(message))
+        return unpack(socket.recv())
+    finally:
+        socket.close()
+
+
+# --- Snapshot (transferência de estado para réplicas novas) ---
+def snapshot_point():
+    """
+    Marca o ponto do snapshot: a posição de replicação de cada origem (inclusive
+    a nossa) e até onde o log de mensagens vai.
+
+    Com a aplicação de réplicas e o log de replicação pausados, toda escrita
+    coberta pelas posições já está no log de mensagens antes de `message_end`.
+    Uma escrita local concorrente pode estar no log sem estar nas posições;
+    nesse caso ela aparece de novo na cauda aplicada por quem recebe.
+    """
+    with replication_state.paused(), replication_log.paused():
+        positions = replication_state.positions()
+        positions[server_name] = {"epoch": replication_log.epoch, "seq": replication_log.last_seq}
+        message_log.flush()
+        return positions, message_log.size()
+
+def snapshot_reply(cursor):
+    """Sem cursor, abre a transferência; com cursor, devolve o próximo pedaço."""
+    if cursor is None:
+        positions, message_end = snapshot_point()
+        bootstrap_log.info("Enviando snapshot (%d bytes de mensagens)", message_end)
+        return {"origin": server_name, "positions": positions, "next": first_cursor(message_end)}
+    chunk, following = read_chunk(cursor, {"users": users, "channels": channels}, message_log, SNAPSHOT_CHUNK_SIZE)
+    return {"part": cursor["part"], "chunk": chunk, "next": following}
+
+def needs_bootstrap():
+    return (SNAPSHOT_BOOTSTRAP == "auto" and len(users) == 0 and len(channels) == 0
+            and message_log.size() == 0 and not replication_state.positions())
+
+def bootstrap_peers():
+    """Servidores ativos segundo o referencia, do maior rank (provável coordenador) para o menor."""
+    reply = p2p_request(REFERENCE_ADDRESS, build_message("list"))
+    merge_clock(reply)
+    peers = [s for s in reply.get("data", {}).get("list", []) if s["name"] != server_name]
+    return sorted(peers, key=lambda s: s["rank"], reverse=True)
 
+def snapshot_chunk_request(address, cursor):
+    for attempt in range(SNAPSHOT_RETRIES):
+        try:
+            reply = peer_request(address, build_message("snapshot", cursor=cursor))
+            merge_clock(reply)
+            return reply.get("data", {})
+        except zmq.Again:
+            if attempt == SNAPSHOT_RETRIES - 1:
+                raise
+
+def apply_snapshot_items(part, items):
+    if part == "users":
+        for key, value in items:
+            users.put_if_absent(key, value)
+    elif part == "channels":
+        for key, value in items:
+            channels.put_if_absent(key, value)
+    elif part == "messages":
+        for record in items:
+            save_message(record)
+
+def bootstrap_from_peer(peer):
+    """Copia o snapshot de `peer` pedaço por pedaço e adota as posições de replicação dele."""
+    data = snapshot_chunk_request(peer["address"], None)
+    positions, cursor = data["positions"], data["next"]
+
+    chunks = 0
+    while cursor is not None:
+        data = snapshot_chunk_request(peer["address"], cursor)
+        apply_snapshot_items(data["part"], decode_chunk(data["part"], data["chunk"]))
+        cursor = data["next"]
+        chunks += 1
+
+    users.flush()
+    channels.flush()
+    message_log.flush()
+
+    # Nossas próprias escritas vêm do nosso log; o resto chega como cauda via catch-up
+    positions.pop(server_name, None)
+    replication_state.restore(positions)
+    bootstrap_log.info("Snapshot de '%s' aplicado (%d pedaços): %d usuários, %d canais, %d bytes de mensagens",
+                       peer["name"], chunks, len(users), len(channels), message_log.size())
+
+def bootstrap():
+    """
+    Se este servidor não tem dados, copia o estado de um par antes de atender
+    clientes. Depois disso, só as operações posteriores ao snapshot (a cauda
+    da replicação) são aplicadas, pelo catch-up normal.
+    """
+    if not needs_bootstrap():
+        return
+    try:
+        peers = bootstrap_peers()
     except Exception as e:
-        print(f"[{server_name}] Erro ao processar replicação {service}: {e}")
+        bootstrap_log.warning("Não foi possível listar os servidores (%r). Iniciando vazio.", e)
+        return
+
+    for peer in peers:
+        bootstrap_log.info("Pedindo snapshot a '%s' (%s)...", peer["name"], peer["address"])
+        try:
+            bootstrap_from_peer(peer)
+            return
+        except Exception as e:
+            bootstrap_log.warning("Bootstrap com '%s' falhou: %r", peer["name"], e)
+            if not needs_bootstrap():
+                bootstrap_log.error("Bootstrap interrompido com estado parcial; o catch-up completa o que estiver disponível.")
+                return
+    if peers:
+        bootstrap_log.warning("Nenhum servidor respondeu. Iniciando vazio.")
+
+
+# --- Lógica P2P (compartilhada pelos dois modos de execução) ---
+def handle_p2p_request(request):
+    """Processa uma requisição P2P de outro servidor (Eleição, Clock, Catch-up, Snapshot) e retorna a resposta."""
+    received_clock = merge_clock(request)
+
+    service = request.get("service")
+    data = request.get("data", {})
+    reply_data = {}
+
+    current_clock = tick()
+    p2p_log.debug("Recebeu P2P '%s' (Clock: %s)", service, received_clock)
+
+    if service == "election":
+        reply_data = {"election": "OK"}
+        sender_rank = data.get("rank", 0)
+        if server_rank is not None and sender_rank < server_rank:
+            trigger_election()
+
+    elif service == "clock":
+        reply_data = {"time": wall_clock.now_ns()}
+
+    elif service == "catchup":
+        # Só servimos o nosso próprio log de replicação
+        if data.get("origin") == server_name:
+            ops, first_seq = replication_log.read_from(data.get("from", 1), min(data.get("limit", REPL_CATCHUP_LIMIT), REPL_CATCHUP_LIMIT))
+            reply_data = {"ops": ops, "first_seq": first_seq, "last_seq": replication_log.last_seq,
+                          "epoch": replication_log.epoch}
+        else:
+            reply_data = {"status": "erro", "description": "Origem desconhecida"}
+
+    elif service == "snapshot":
+        reply_data = snapshot_reply(data.get("cursor"))
+
+    return {
+        "service": service,
+        "data": {**reply_data, "clock": current_clock}
+    }
+
+def handle_announcement(topic, payload):
+    """Processa um anúncio recebido no SUB ('servers', 'replication' ou 'presence')."""
+    global coordinator_name
+
+    # Tanto o lote de replicação quanto o anúncio de eleição têm um 'data'
+    received_clock = merge_clock(payload)
+
+    if topic == "servers":
+        service = payload.get("service")
+        if service == "election":
+            data = payload.get("data", {})
+            new_coordinator = data.get("coordinator")
+            announced_rank = data.get("rank")
+            if server_rank is not None and announced_rank is not None and announced_rank < server_rank:
+                # Bully: um servidor de rank menor se declarou coordenador; quem tem rank maior assume
+                trigger_election()
+                return
+            if new_coordinator != coordinator_name:
+                election_log.info("*** NOVO COORDENADOR ELEITO: %s (Clock: %s) ***", new_coordinator, received_clock)
+            coordinator_name = new_coordinator
+
+    elif topic == "replication":
+        data = payload.get("data", {})
+        origin = data.get("origin")
+        if origin == server_name:
+            return # Nossas escritas já foram aplicadas por quem atendeu o cliente
+        if REPLICATION_TRANSPORT == "mesh":
+            add_mesh_peer(data.get("address"))
+        needs_catch_up = replication_state.offer(origin, data.get("epoch"), data.get("ops", []), data.get("last_seq", 0))
+        REPLICATION_BEHIND.labels(origin).set(replication_state.behind(origin))
+        if needs_catch_up:
+            start_catch_up(origin, data.get("address"), data.get("epoch"))
+
+    elif topic == "presence":
+        data = payload.get("data", {})
+        if data.get("origin") != server_name:
+            apply_presence(data)
+
+def subscribe_announcements(sub_socket):
+    if REPLICATION_TRANSPORT == "mesh":
+        endpoint = f"tcp://*:{P2P_PORT + REPL_MESH_PORT_OFFSET}"
+        sub_socket.bind(endpoint)
+    else:
+        endpoint = PROXY_INTERNAL_SUB_ADDRESS
+        sub_socket.connect(endpoint)
+    sub_socket.setsockopt_string(zmq.SUBSCRIBE, "servers")
+    sub_socket.setsockopt_string(zmq.SUBSCRIBE, "replication")
+    sub_socket.setsockopt_string(zmq.SUBSCRIBE, "presence")
+    p2p_log.info("Listener P2P (SUB) inscrito em 'servers', 'replication' e 'presence' (%s, %s)", REPLICATION_TRANSPORT, endpoint)
 
 
 def p2p_listener_thread():
@@ -145,500 +1127,1123 @@ def p2p_listener_thread():
     Ouve por conexões P2P de *outros servidores* (Eleição, Clock)
     e por anúncios no Proxy (Eleição, Replicação).
     """
-    global logical_clock, coordinator_name, server_rank
-    
     p2p_router_socket = context.socket(zmq.ROUTER)
     p2p_router_socket.bind(f"tcp://*:{P2P_PORT}")
-    print(f"[{server_name}] Listener P2P (ROUTER) iniciado em tcp://*:{P2P_PORT}")
-    
+    p2p_log.info("Listener P2P (ROUTER) iniciado em tcp://*:%d", P2P_PORT)
+
     p2p_sub_socket = context.socket(zmq.SUB)
-    p2p_sub_socket.connect("tcp://proxy:5556")
-    p2p_sub_socket.setsockopt_string(zmq.SUBSCRIBE, "servers")
-    p2p_sub_socket.setsockopt_string(zmq.SUBSCRIBE, "replication") # <-- NOVO
-    print(f"[{server_name}] Listener P2P (SUB) inscrito em 'servers' e 'replication'")
+    subscribe_announcements(p2p_sub_socket)
 
     poller = zmq.Poller()
     poller.register(p2p_router_socket, zmq.POLLIN)
     poller.register(p2p_sub_socket, zmq.POLLIN)
+    bulk = collections.deque() # Pedidos de transferência esperando a vez (P2P_BULK_SERVICES)
 
     while True:
         try:
-            socks = dict(poller.poll())
+            socks = dict(poller.poll(0 if bulk else None))
 
             if p2p_router_socket in socks:
-                frames = p2p_router_socket.recv_multipart()
-                identity, empty, request_packed = frames
-                request = msgpack.unpackb(request_packed, raw=False)
-                
-                with clock_mutex:
-                    received_clock = request.get("data", {}).get("clock", 0)
-                    logical_clock = max(logical_clock, received_clock)
-                
-                service = request.get("service")
-                data = request.get("data", {})
-                reply_data = {}
-
-                with clock_mutex:
-                    logical_clock += 1
-                    current_clock = logical_clock
-                
-                print(f"[{server_name}] Recebeu P2P '{service}' (Clock: {received_clock})")
-                
-                if service == "election":
-                    reply_data = {"election": "OK"}
-                    sender_rank = data.get("rank", 0)
-                    if server_rank is not None and sender_rank < server_rank:
-                        threading.Thread(target=start_election, daemon=True).start()
-
-                elif service == "clock":
-                    reply_data = {"time": time.time_ns()}
-
-                reply = {
-                    "service": service, 
-                    "data": {**reply_data, "timestamp": datetime.now().isoformat(), "clock": current_clock}
-                }
-                p2p_router_socket.send_multipart([identity, empty, msgpack.packb(reply, default=str)])
+                # Lê tudo o que já chegou: controle é respondido na hora e
+                # transferência vai para a fila, atendida um pedido por volta
+                while True:
+                    try:
+                        # Envelope: [identidade, id do pedido, "", pedido] (PeerPool) ou [identidade, "", pedido] (REQ)
+                        *envelope, request_packed = p2p_router_socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    request, compact = decode(request_packed)
+                    if request.get("service") in P2P_BULK_SERVICES:
+                        bulk.append((envelope, request, compact))
+                    else:
+                        p2p_router_socket.send_multipart(envelope + [pack_reply(handle_p2p_request(request), compact)])
 
             # --- 2. Anúncio (SUB) ---
             if p2p_sub_socket in socks:
                 topic_bytes, payload_packed = p2p_sub_socket.recv_multipart()
-                topic = topic_bytes.decode('utf-8')
-                payload = msgpack.unpackb(payload_packed, raw=False)
-                
-                # O payload de replicação é a *própria request*
-                # O payload de eleição tem um 'data'
-                received_clock = 0
-                if topic == "replication":
-                    received_clock = payload.get("data", {}).get("clock", 0)
-                else: # topic == "servers"
-                    received_clock = payload.get("data", {}).get("clock", 0)
-                
-                with clock_mutex:
-                    logical_clock = max(logical_clock, received_clock)
-                
-                if topic == "servers":
-                    service = payload.get("service")
-                    if service == "election":
-                        new_coordinator = payload.get("data", {}).get("coordinator")
-                        coordinator_name = new_coordinator
-                        print(f"*** [{server_name}] NOVO COORDENADOR ELEITO: {coordinator_name} (Clock: {received_clock}) ***")
-                
-                elif topic == "replication":
-                    # --- NOVO: Lidar com replicação ---
-                    handle_replication(payload)
+                handle_announcement(topic_bytes.decode('utf-8'), msgpack.unpackb(payload_packed, raw=False))
+
+            if bulk:
+                envelope, request, compact = bulk.popleft()
+                p2p_router_socket.send_multipart(envelope + [pack_reply(handle_p2p_request(request), compact)])
 
         except Exception as e:
-            print(f"[{server_name}] Erro na thread P2P: {e}")
+            p2p_log.error("Erro na thread P2P: %r", e)
+
+
+# --- Registro, Heartbeat e Eleição ---
+def handle_rank_reply(reply):
+    global server_rank
+    merge_clock(reply)
+    server_rank = reply.get("data", {}).get("rank")
+    election_log.info("*** SERVIDOR '%s' REGISTRADO COM RANK: %s (Endereço: %s) ***", server_name, server_rank, p2p_address)
+
+def set_active_servers(servers):
+    """Atualiza a lista de servidores ativos e dispara a eleição se o coordenador sumiu."""
+    global active_servers
+    active_servers = sorted(servers, key=lambda s: s["rank"])
+    election_log.debug("Servidores ativos: %s", [s["name"] for s in active_servers])
+    if REPLICATION_TRANSPORT == "mesh":
+        update_mesh_peers(active_servers)
+    # Fecha as conexões P2P com quem saiu; as dos pares novos abrem no primeiro pedido
+    peer_pool.retain([s["address"] for s in active_servers if s.get("address")])
+
+    # --- Lógica de Eleição (Trigger) ---
+    if server_rank is None:
+        return # Não faz nada se ainda não tem rank
+
+    coordinator_is_alive = any(s["name"] == coordinator_name for s in active_servers)
+
+    # Trigger: (Não tem coordenador OU o coordenador está morto) E uma eleição não está em progresso
+    if (not coordinator_name or not coordinator_is_alive) and not election_in_progress.locked():
+        election_log.warning("Coordenador '%s' está offline. Iniciando eleição.", coordinator_name)
+        trigger_election()
+
+def handle_list_reply(list_reply):
+    """Substitui a lista local pela lista completa do referencia (partida ou mudança perdida)."""
+    global members, membership_version
+    merge_clock(list_reply)
+    data = list_reply.get("data", {})
+    members = {s["name"]: s for s in data.get("list", [])}
+    membership_version = data.get("version")
+    set_active_servers(list(members.values()))
+
+def handle_membership(payload):
+    """
+    Aplica uma mudança publicada pelo referencia (join, alive, suspect, leave).
+    Retorna True se a lista local ficou para trás (mudança perdida) e
+    precisa ser pedida de novo com 'list'.
+    """
+    global membership_version
+    merge_clock(payload)
+    data = payload.get("data", {})
+    version = data.get("version", 0)
+    if membership_version is None:
+        return True
+    if version <= membership_version:
+        return False # Já incluída na lista que temos
+    if data.get("event") == "view" or version != membership_version + 1:
+        return True
+
+    server = data.get("server", {})
+    event = data.get("event")
+    if event == "leave":
+        members.pop(server.get("name"), None)
+    else:
+        members[server["name"]] = {**server, "status": "suspect" if event == "suspect" else "alive"}
+    membership_version = version
+    level = membership_log.warning if event in ("suspect", "leave") else membership_log.info
+    level("Membro '%s': %s (versão %d)", server.get("name"), event, version)
+    set_active_servers(list(members.values()))
+    return False
+
+def reference_request(socket, message):
+    socket.send(pack_request(message))
+    return unpack(socket.recv())
 
 def heartbeat_thread():
     """
-    Cuida de se registrar, enviar heartbeats, e
-    INICIAR a lógica de eleição e sincronia.
-    """
-    global logical_clock, server_rank, coordinator_name, active_servers
-    
-    # Socket 5: (Thread HB) REQ para o Servidor de Referência
-    ref_socket = context.socket(zmq.REQ)
-    ref_socket.connect("tcp://referencia:5560")
-    
-    print(f"Servidor '{server_name}' iniciando thread de heartbeat...")
-    
-    # 1. Pedir Rank
-    try:
-        with clock_mutex:
-            logical_clock += 1
-            rank_req = {
-                "service": "rank",
-                "data": {
-                    "user": server_name,
-                    "p2p_address": p2p_address,
-                    "timestamp": datetime.now().isoformat(),
-                    "clock": logical_clock
-                }
-            }
-        
-        ref_socket.send(msgpack.packb(rank_req, default=str))
-        reply = msgpack.unpackb(ref_socket.recv(), raw=False)
-        
-        with clock_mutex:
-            received_clock = reply.get("data", {}).get("clock", 0)
-            logical_clock = max(logical_clock, received_clock)
-            
-        server_rank = reply.get("data", {}).get("rank")
-        print(f"*** SERVIDOR '{server_name}' REGISTRADO COM RANK: {server_rank} (Endereço: {p2p_address}) ***")
+    Cuida de se registrar, enviar heartbeats, acompanhar a lista de membros
+    publicada pelo referencia e INICIAR a lógica de eleição e sincronia.
+    """
+    def new_ref_socket():
+        # Socket 5: (Thread HB) REQ para o Servidor de Referência
+        socket = context.socket(zmq.REQ)
+        socket.setsockopt(zmq.RCVTIMEO, int(REFERENCE_TIMEOUT * 1000))
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(REFERENCE_ADDRESS)
+        return socket
 
-    except Exception as e:
-        print(f"[{server_name}] [ERRO NO REGISTRO DE RANK] {e}")
+    ref_socket = new_ref_socket()
+    membership_socket = context.socket(zmq.SUB)
+    membership_socket.connect(REFERENCE_PUB_ADDRESS)
+    membership_socket.setsockopt_string(zmq.SUBSCRIBE, "membership")
+
+    log.info("Iniciando thread de heartbeat (a cada %.2f s)...", MEMBERSHIP_HEARTBEAT)
+    next_heartbeat = time.monotonic()
 
-    # 2. Loop de Heartbeat e Lógica de Sincronia
     while True:
         try:
-            time.sleep(15)
-            
-            # --- A. Enviar Heartbeat ---
-            with clock_mutex:
-                logical_clock += 1
-                heartbeat_req = {
-                    "service": "heartbeat",
-                    "data": {"user": server_name, "timestamp": datetime.now().isoformat(), "clock": logical_clock}
-                }
-            
-            ref_socket.send(msgpack.packb(heartbeat_req, default=str))
-            reply = msgpack.unpackb(ref_socket.recv(), raw=False)
-            
-            with clock_mutex:
-                received_clock = reply.get("data", {}).get("clock", 0)
-                logical_clock = max(logical_clock, received_clock)
-            
-            # --- B. Pedir Lista de Servidores ---
-            with clock_mutex:
-                logical_clock += 1
-                list_req = {"service": "list", "data": {"timestamp": datetime.now().isoformat(), "clock": logical_clock}}
-            
-            ref_socket.send(msgpack.packb(list_req, default=str))
-            list_reply = msgpack.unpackb(ref_socket.recv(), raw=False)
-            
-            with clock_mutex:
-                list_clock = list_reply.get("data", {}).get("clock", 0)
-                logical_clock = max(logical_clock, list_clock)
-            
-            active_servers = list_reply.get("data", {}).get("list", [])
-            # print(f"[{server_name}] Servidores Ativos: {[s['name'] for s in active_servers]}")
-
-            # --- C. Lógica de Eleição (Trigger) ---
+            # 1. Pedir Rank (de novo se o referencia reiniciou e nos esqueceu)
             if server_rank is None:
-                continue # Não faz nada se ainda não tem rank
-            
-            coordinator_is_alive = False
-            if coordinator_name:
-                for s in active_servers:
-                    if s["name"] == coordinator_name:
-                        coordinator_is_alive = True
+                handle_rank_reply(reference_request(ref_socket, build_message("rank", user=server_name, p2p_address=p2p_address)))
+                handle_list_reply(reference_request(ref_socket, build_message("list")))
+                continue
+
+            # 2. Mudanças na lista de membros (push do referencia)
+            timeout = max(0, next_heartbeat - time.monotonic())
+            if membership_socket.poll(timeout * 1000):
+                stale = False
+                while True:
+                    try:
+                        _, payload = membership_socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
                         break
-            
-            # Trigger: (Não tem coordenador OU o coordenador está morto) E uma eleição não está em progresso
-            if (not coordinator_name or not coordinator_is_alive) and election_in_progress.acquire(blocking=False):
-                print(f"[{server_name}] Coordenador '{coordinator_name}' está offline. Iniciando eleição.")
-                threading.Thread(target=start_election, daemon=True).start()
+                    stale |= handle_membership(msgpack.unpackb(payload, raw=False))
+                if stale:
+                    handle_list_reply(reference_request(ref_socket, build_message("list")))
+
+            # 3. Heartbeat
+            if time.monotonic() >= next_heartbeat:
+                reply = reference_request(ref_socket, build_message("heartbeat", user=server_name))
+                merge_clock(reply)
+                if reply.get("data", {}).get("status") != "OK":
+                    handle_rank_reply(reference_request(ref_socket, build_message("rank", user=server_name, p2p_address=p2p_address)))
+                if coordinator_name == server_name:
+                    publish_coordinator()
+                next_heartbeat = time.monotonic() + MEMBERSHIP_HEARTBEAT
 
         except Exception as e:
-            print(f"[{server_name}] Erro no loop de heartbeat: {e}")
+            log.error("Erro no loop de heartbeat: %r", e)
             ref_socket.close()
-            time.sleep(5)
-            ref_socket = context.socket(zmq.REQ)
-            ref_socket.connect("tcp://referencia:5560")
+            time.sleep(MEMBERSHIP_HEARTBEAT)
+            ref_socket = new_ref_socket()
 
 def announce_new_coordinator():
     """Anuncia a todos (via PUB) que este servidor é o novo coordenador."""
-    global coordinator_name, logical_clock
-    
+    global coordinator_name
+
     if coordinator_name == server_name:
-        print(f"[{server_name}] Já sou o coordenador, não preciso anunciar.")
+        election_log.info("Já sou o coordenador, não preciso anunciar.")
         return
 
-    print(f"*** [{server_name}] ME ELEGI COMO NOVO COORDENADOR! ***")
+    election_log.info("*** ME ELEGI COMO NOVO COORDENADOR! ***")
     coordinator_name = server_name
-    
-    with clock_mutex:
-        logical_clock += 1
-        announcement = {
-            "service": "election",
-            "data": {
-                "coordinator": server_name,
-                "timestamp": datetime.now().isoformat(),
-                "clock": logical_clock
-            }
-        }
-    
-    # Usa o socket PUB da thread principal para anunciar no tópico 'servers'
+    publish_coordinator()
+
+def publish_coordinator():
+    """
+    Publica no tópico 'servers' que este servidor é o coordenador. Além da
+    eleição, o coordenador repete o anúncio a cada heartbeat: um par que
+    acabou de conectar na malha perde o primeiro anúncio.
+    """
+    announcement = build_message("election", coordinator=server_name, rank=server_rank)
     try:
-        pub_socket.send_multipart([
-            b"servers",
-            msgpack.packb(announcement, default=str)
-        ])
+        publish_internal(b"servers", announcement)
     except Exception as e:
-        print(f"[{server_name}] Erro ao anunciar coordenador: {e}")
+        election_log.error("Erro ao anunciar coordenador: %r", e)
+
+def finish_election(responses):
+    if responses == 0:
+        # Ninguém com rank maior respondeu. Eu sou o líder.
+        announce_new_coordinator()
+    else:
+        # Alguém com rank maior respondeu. Eu perdi.
+        election_log.info("Eleição perdida. %d servidor(es) de rank maior responderam.", responses)
 
 def start_election():
-    """Inicia o Bully Algorithm."""
-    global server_rank, active_servers, election_in_progress
-    
+    """Inicia o Bully Algorithm. Quem chama já adquiriu election_in_progress."""
+    started = time.perf_counter()
     try:
         higher_rank_servers = [s for s in active_servers if s["rank"] > server_rank]
-        
+
         if not higher_rank_servers:
             # Não há ninguém com rank maior. Eu sou o líder.
             announce_new_coordinator()
             return
 
-        print(f"[{server_name}] Enviando 'election' para {len(higher_rank_servers)} servidores com rank maior.")
-        
+        election_log.info("Enviando 'election' para %d servidores com rank maior.", len(higher_rank_servers))
+
+        # Um pedido por par, todos em andamento ao mesmo tempo nas conexões do pool
+        request = build_message("election", rank=server_rank)
+        pending = dict(peer_pool.submit(server["address"], request) for server in higher_rank_servers)
         responses = 0
-        poller = zmq.Poller()
-        sockets = []
-        
-        for server in higher_rank_servers:
-            # Conecta em cada servidor com rank maior
-            p2p_socket = context.socket(zmq.REQ)
-            # Define um timeout de envio e recebimento curto
-            p2p_socket.setsockopt(zmq.RCVTIMEO, int(ELECTION_TIMEOUT * 1000 / 2))
-            p2p_socket.setsockopt(zmq.SNDTIMEO, int(ELECTION_TIMEOUT * 1000 / 2))
-            p2p_socket.connect(server["address"])
-            sockets.append(p2p_socket)
-            
-            poller.register(p2p_socket, zmq.POLLIN)
-            
-            with clock_mutex:
-                logical_clock += 1
-                req = {
-                    "service": "election",
-                    "data": {"rank": server_rank, "timestamp": datetime.now().isoformat(), "clock": logical_clock}
-                }
-            p2p_socket.send(msgpack.packb(req, default=str))
-
-        # Espera por respostas (com timeout)
-        start_time = time.time()
-        while time.time() - start_time < ELECTION_TIMEOUT:
-            socks = dict(poller.poll(timeout=100)) # Poll curto
-            for s in sockets:
-                if s in socks:
-                    # Alguém respondeu 'OK'
-                    try:
-                        reply = msgpack.unpackb(s.recv(), raw=False)
-                        if reply.get("data", {}).get("election") == "OK":
-                            responses += 1
-                    except:
-                        pass # Ignora erro de recv
-            if responses > 0:
-                break # Alguém respondeu, podemos parar
-        
-        for s in sockets:
-            s.close() # Fecha todos os sockets
-
-        if responses == 0:
-            # Ninguém com rank maior respondeu. Eu sou o líder.
-            announce_new_coordinator()
-        else:
-            # Alguém com rank maior respondeu. Eu perdi.
-            print(f"[{server_name}] Eleição perdida. {responses} servidor(es) de rank maior responderam.")
-    
+        deadline = time.monotonic() + ELECTION_TIMEOUT
+        try:
+            futures = set(pending.values())
+            while futures and responses == 0:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                done, futures = concurrent.futures.wait(futures, timeout=remaining, return_when=concurrent.futures.FIRST_COMPLETED)
+                for future in done:
+                    if future.exception() is None and unpack(future.result()).get("data", {}).get("election") == "OK":
+                        responses += 1 # Alguém respondeu 'OK'
+        finally:
+            for req_id in pending:
+                peer_pool.forget(req_id)
+
+        finish_election(responses)
+
     except Exception as e:
-        print(f"[{server_name}] Erro durante a eleição: {e}")
+        election_log.error("Erro durante a eleição: %r", e)
     finally:
+        ELECTION_SECONDS.observe(time.perf_counter() - started)
         # Libera o lock para que outra eleição possa começar se necessário
         election_in_progress.release()
 
 
-def sync_clock_with_coordinator():
-    """Pede o relógio ao coordenador (Christian's Algorithm)."""
-    global logical_clock, message_counter
-    
+# --- Sincronização de Relógio (Christian's Algorithm) ---
+def coordinator_address():
+    """Endereço P2P do coordenador, ou None se não for conhecido."""
+    for s in active_servers:
+        if s["name"] == coordinator_name:
+            return s["address"]
+    return None
+
+def clock_sync_target():
+    """Endereço do coordenador a sincronizar, ou None (sem coordenador ou este é o coordenador)."""
+    global clock_reference
     if not coordinator_name or server_name == coordinator_name:
-        message_counter = 0
+        return None
+    if coordinator_name != clock_reference:
+        # Amostras de outro coordenador não entram na mesma reta
+        wall_clock.rebase()
+        clock_reference = coordinator_name
+    address = coordinator_address()
+    if not address:
+        clock_log.warning("Não foi possível encontrar o endereço do coordenador. Abortando sincronia.")
+    return address
+
+def clock_probe(t0, t1, reply):
+    merge_clock(reply)
+    return t0, t1, reply.get("data", {}).get("time", 0)
+
+def apply_clock_samples(samples):
+    """Fica com a amostra de menor RTT da rodada e atualiza a estimativa de offset e drift."""
+    if not samples:
         return
-    
-    print(f"[{server_name}] Contador atingiu {MSG_COUNT_TRIGGER}. Sincronizando relógio com o Coordenador ({coordinator_name})...")
-    
+    local_ns, offset_ns, rtt = best_sample(samples)
+    wall_clock.add_sample(local_ns, offset_ns)
+    CLOCK_SYNC_RTT_SECONDS.observe(rtt / 1e9)
+    clock_log.debug("Sincronia com '%s': amostra %.3f ms (RTT %.3f ms), offset %.3f ms, drift %.1f ppm",
+                    coordinator_name, offset_ns / 1e6, rtt / 1e6,
+                    wall_clock.offset_at(time.time_ns()) / 1e6, wall_clock.drift * 1e6)
+
+def sync_clock_with_coordinator():
+    """Uma rodada de sincronia: CLOCK_SYNC_PROBES pedidos ao coordenador."""
+    address = clock_sync_target()
+    if not address:
+        return
+    samples = []
     try:
-        # Pega o endereço do coordenador
-        coord_address = None
-        for s in active_servers:
-            if s["name"] == coordinator_name:
-                coord_address = s["address"]
-                break
-        
-        if not coord_address:
-            print(f"[{server_name}] Não foi possível encontrar o endereço do coordenador. Abortando sincronia.")
-            message_counter = 0 # Zera mesmo se falhar
-            return
+        for _ in range(CLOCK_SYNC_PROBES):
+            t0 = time.time_ns()
+            reply = peer_request(address, build_message("clock"))
+            samples.append(clock_probe(t0, time.time_ns(), reply))
+    except Exception as e:
+        clock_log.error("Erro ao sincronizar relógio: %r", e)
+    apply_clock_samples(samples)
 
-        # Conecta, envia, recebe
-        sync_socket = context.socket(zmq.REQ)
-        sync_socket.setsockopt(zmq.RCVTIMEO, 2000) # 2s timeout
-        sync_socket.setsockopt(zmq.SNDTIMEO, 2000) # 2s timeout
-        sync_socket.connect(coord_address)
-        
-        with clock_mutex:
-            logical_clock += 1
-            req = {"service": "clock", "data": {"timestamp": datetime.now().isoformat(), "clock": logical_clock}}
-        
-        t0 = time.time_ns()
-        sync_socket.send(msgpack.packb(req, default=str))
-        
-        reply_packed = sync_socket.recv()
-        t1 = time.time_ns()
-        
-        reply = msgpack.unpackb(reply_packed, raw=False)
-        
-        with clock_mutex:
-            received_clock = reply.get("data", {}).get("clock", 0)
-            logical_clock = max(logical_clock, received_clock)
-        
-        # Lógica de Christian's Algorithm
-        rtt = t1 - t0
-        coordinator_time_ns = reply.get("data", {}).get("time", 0)
-        
-        # Tempo estimado do coordenador = (Tempo dele) + (Metade do Round Trip Time)
-        estimated_coordinator_time = coordinator_time_ns + (rtt / 2)
-        my_time_ns = t1
-        
-        time_diff = estimated_coordinator_time - my_time_ns
-        
-        print(f"[{server_name}] Sincronia: Meu tempo está {time_diff / 1_000_000:,.2f} ms diferente do coordenador.")
-        # Em um sistema real, você ajustaria o relógio (time.settime() ou apenas um offset)
-        
-        sync_socket.close()
+def clock_sync_thread():
+    """Sincroniza o relógio a cada CLOCK_SYNC_INTERVAL segundos, sem depender da carga."""
+    while True:
+        time.sleep(CLOCK_SYNC_INTERVAL)
+        sync_clock_with_coordinator()
 
-    except Exception as e:
-        print(f"[{server_name}] Erro ao sincronizar relógio: {e}")
-    finally:
-        message_counter = 0 # Zera o contador
 
+# --- Requisições de Clientes ---
+def channel_value(data):
+    """Valor guardado para um canal novo; "retention" ({"count", "seconds"}) é opcional."""
+    value = {"timestamp": data.get("timestamp")}
+    retention = data.get("retention")
+    if isinstance(retention, dict):
+        value["retention"] = {k: retention[k] for k in ("count", "seconds") if isinstance(retention.get(k), (int, float))}
+    return value
+
+# Campos com nomes (usuário, canal) de cada escrita: precisam ser texto
+NAME_FIELDS = {"login": ("user",), "channel": ("channel",), "publish": ("channel", "user"), "message": ("src", "dst")}
+
+def invalid_name_field(service, data):
+    """Primeiro campo de nome da escrita que não é um texto não vazio, ou None."""
+    for field in NAME_FIELDS.get(service, ()):
+        value = data.get(field)
+        if not isinstance(value, str) or not value:
+            return field
+    return None
 
-# --- Inicia as Threads ---
-p2p_thread = threading.Thread(target=p2p_listener_thread, daemon=True)
-p2p_thread.start()
+def execute_write(service, data, clock, pub, messages):
+    """
+    Executa uma escrita de cliente (login, channel, publish, message) com o
+    clock `clock`, sem esperar pelo disco. users/channels são gravados aqui;
+    as mensagens vão para `messages` como (registro, tópico, payload), e quem
+    chama as grava e publica (ver store_messages).
+    Retorna (reply_data, pending, wrote): `wrote` diz se a escrita deve ser replicada.
+    Login, publish e message também valem como keepalive do usuário.
+    """
+    pending = []
 
-hb_thread = threading.Thread(target=heartbeat_thread, daemon=True)
-hb_thread.start()
-# --- FIM ---
+    field = invalid_name_field(service, data)
+    if field is not None:
+        return {"status": "erro", "description": f"'{field}' deve ser um texto"}, pending, False
 
+    # O timestamp gravado e publicado é o do relógio corrigido (wall_clock).
+    # Ele fica em `data`, que é a requisição replicada, e as réplicas gravam o
+    # mesmo valor; o do cliente é guardado em "client_timestamp"
+    if "timestamp" in data:
+        data["client_timestamp"] = data["timestamp"]
+    data["timestamp"] = timestamp()
 
-print(f"Servidor '{server_name}' REQ/REP e PUB (Main Thread) iniciado, aguardando clientes...")
+    if service == "login":
+        with STORE_WRITE_SECONDS.labels("users").time():
+            seq = users.put_if_absent(data.get("user"), {"timestamp": data.get("timestamp")})
+        mark_presence(data.get("user")) # "Usuário já existe" é o login de quem volta
+        if seq is None:
+            return {"status": "erro", "description": "Usuário já existe"}, pending, False
+        pending.append((users, seq))
+        return {"status": "sucesso"}, pending, True
 
-# --- Loop Principal (Processando comandos de clientes) ---
-while True:
-    try:
-        frames = rep_socket.recv_multipart()
-        request_packed = frames[-1]
-        request = msgpack.unpackb(request_packed, raw=False)
-        
-        received_clock = request.get("data", {}).get("clock", 0)
-        with clock_mutex:
-            logical_clock = max(logical_clock, received_clock)
+    if service == "channel":
+        with STORE_WRITE_SECONDS.labels("channels").time():
+            seq = channels.put_if_absent(data.get("channel"), channel_value(data))
+        if seq is None:
+            return {"status": "erro", "description": "Canal já existe"}, pending, False
+        pending.append((channels, seq))
+        return {"status": "sucesso"}, pending, True
 
+    if service == "publish":
+        channel_name = data.get("channel")
+        user_name = data.get("user")
+        message = data.get("message")
+        if channel_name not in channels:
+            return {"status": "erro", "message": "Canal não existe."}, pending, False
+
+        record = {
+            "type": "channel", "channel": channel_name, "user": user_name,
+            "message": message, "timestamp": data.get("timestamp"), "clock": clock
+        }
+        message_payload = {"user": user_name, "message": message, "timestamp": data.get("timestamp"), "clock": clock}
+        messages.append((record, channel_name.encode('utf-8'), message_payload))
+        if user_name in users:
+            mark_presence(user_name)
+        return {"status": "OK", "message": "Mensagem publicada."}, pending, True
+
+    if service == "message":
+        dest_user = data.get("dst")
+        src_user = data.get("src")
+        message = data.get("message")
+        if dest_user not in users:
+            return {"status": "erro", "message": "Usuário de destino não existe."}, pending, False
+
+        record = {
+            "type": "private", "from_user": src_user, "to_user": dest_user,
+            "message": message, "timestamp": data.get("timestamp"), "clock": clock
+        }
+        message_payload = {"src": src_user, "message": message, "timestamp": data.get("timestamp"), "clock": clock}
+        messages.append((record, f"user:{dest_user}".encode('utf-8'), message_payload))
+        if src_user in users:
+            mark_presence(src_user)
+        return {"status": "OK", "message": "Mensagem privada enviada."}, pending, True
+
+    raise ValueError(f"Escrita desconhecida: {service}")
+
+def store_messages(messages, pub):
+    """
+    Enfileira no log as mensagens de execute_write (uma escrita) e só então
+    as publica. Retorna o seq do log, ou None se a gravação falhou: nesse caso
+    nada foi publicado, e a escrita não deve ser replicada nem respondida com
+    sucesso (a repetição do cliente não duplica a mensagem).
+    """
+    try:
+        with SAVE_MESSAGE_SECONDS.time():
+            seq = message_log.append_many([record for record, _, _ in messages])
     except Exception as e:
-        print(f"[{server_name}] ERRO GERAL no recebimento REQ/REP: {e}")
-        continue
+        log.error("Erro ao salvar mensagens: %r", e)
+        return None
+    for _, topic, payload in messages:
+        pub.send_multipart([topic, msgpack.packb(payload, default=str)])
+    return seq
+
+def execute_batch(data, clock, pub, pending):
+    """
+    Serviço 'batch': executa em ordem as operações de {"ops": [{"service", "data"}, ...]}
+    (login, channel, publish, message), cada uma com o seu clock. As mensagens
+    entram no log de uma vez (uma escrita) e as operações bem-sucedidas são
+    replicadas como uma única operação 'batch' (as mensagens só se a gravação
+    no log deu certo). A resposta traz "results",
+    um status por operação, na ordem recebida.
+    """
+    ops = data.get("ops")
+    if not isinstance(ops, list) or not ops:
+        return {"service": "batch", "data": {"status": "erro", "description": "Informe 'ops' (lista de operações)"}}
+    if len(ops) > BATCH_MAX_OPS:
+        return {"service": "batch", "data": {"status": "erro", "description": f"Lote com mais de {BATCH_MAX_OPS} operações"}}
+    BATCH_OPS.observe(len(ops))
+
+    results, messages, replicated = [], [], []
+    message_results = [] # Resultados que dependem da gravação das mensagens
+    for op in ops:
+        op = op if isinstance(op, dict) else {}
+        service = op.get("service")
+        op_data = op.get("data") if isinstance(op.get("data"), dict) else {}
+        op_clock = clock if not results else tick() # A primeira usa o clock da requisição
+
+        if service not in BATCH_SERVICES:
+            result, op_pending, wrote = {"status": "erro", "description": "Serviço não permitido em lote"}, [], False
+        else:
+            result, op_pending, wrote = execute_write(service, op_data, op_clock, pub, messages)
+        result["clock"] = op_clock
+        results.append(result)
+        pending.extend(op_pending)
+        if wrote:
+            replicated.append({"service": service, "data": op_data, "clock": op_clock})
+            if service in ("publish", "message"):
+                message_results.append(result)
+
+    if messages:
+        seq = store_messages(messages, pub)
+        if seq is not None:
+            pending.append((message_log, seq))
+        else:
+            for result in message_results:
+                result.clear()
+                result.update({"status": "erro", "message": "Falha ao gravar mensagem.", "clock": result.get("clock")})
+            replicated = [op for op in replicated if op["service"] not in ("publish", "message")]
+    reply = {"service": "batch", "data": {"status": "OK", "results": results, "clock": results[-1]["clock"]}}
+    if replicated:
+        replicated_data = {"ops": replicated}
+        if data.get("request_id") is not None:
+            replicated_data["request_id"] = data["request_id"]
+        replicate_request({"service": "batch", "data": replicated_data}, clock, reply["data"])
+    return reply
+
+def execute_request(request, pub):
+    """
+    Executa uma requisição de cliente sem esperar pelo disco.
+    Retorna (reply, pending): `pending` são pares (log, seq) que precisam
+    estar duráveis antes de a resposta ser enviada (ver finish_reply).
+    """
+    received_clock = merge_clock(request)
 
     service = request.get("service")
     data = request.get("data", {})
-    reply = {} 
+    reply = {}
+    pending = [] # (log, seq) que precisam estar duráveis antes da resposta
 
-    print(f"[{server_name}] Requisição REQ/REP (Clock: {received_clock}): {request}")
+    request_log.debug("Requisição %s (Clock: %s)", request.get("service"), received_clock)
 
-    # Trigger do Berkeley/Christian's
-    message_counter += 1
-    if message_counter >= MSG_COUNT_TRIGGER and coordinator_name != server_name:
-        threading.Thread(target=sync_clock_with_coordinator, daemon=True).start()
+    current_clock_for_reply = tick()
 
-    current_clock_for_reply = 0
-    with clock_mutex:
-        logical_clock += 1
-        current_clock_for_reply = logical_clock
-    
-    
     match service:
         # --- LÓGICA DE ESCRITA ---
         # (login, channel, publish, message)
-        
-        case "login":
-            user_name = data.get("user")
-            timestamp = data.get("timestamp")
-            reply = {"service": "login", "data": {}}
-            if user_name not in users:
-                users[user_name] = {"timestamp": timestamp}
-                save_data(users, USERS_FILE)
-                replicate_request(request)
-                reply["data"]["status"] = "sucesso"
-            else:
-                reply["data"]["status"] = "erro"
-                reply["data"]["description"] = "Usuário já existe"
-        
-        case "channel":
-            channel_name = data.get("channel")
-            timestamp = data.get("timestamp")
-            reply = {"service": "channel", "data": {}}
-            if channel_name not in channels:
-                channels[channel_name] = {"timestamp": timestamp}
-                save_data(channels, CHANNELS_FILE)
-                replicate_request(request)
-                reply["data"]["status"] = "sucesso"
-            else:
-                reply["data"]["status"] = "erro"
-                reply["data"]["description"] = "Canal já existe"
 
-        case "publish":
-            channel_name = data.get("channel")
-            user_name = data.get("user")
-            message = data.get("message")
-            reply["service"] = "publish"
-            
-            if channel_name not in channels:
-                reply["data"] = {"status": "erro", "message": "Canal não existe."}
-            else:
-                message_payload = {
-                    "user": user_name, "message": message,
-                    "timestamp": data.get("timestamp"), "clock": current_clock_for_reply 
-                }
-                message_to_log = {
-                    "type": "channel", "channel": channel_name, "user": user_name,
-                    "message": message, "timestamp": data.get("timestamp")
-                }
-                save_message(message_to_log, MESSAGES_FILE)
-                replicate_request(request)
-                
-                pub_socket.send_multipart([
-                    channel_name.encode('utf-8'),
-                    msgpack.packb(message_payload, default=str)
-                ])
-                reply["data"] = {"status": "OK", "message": "Mensagem publicada."}
-
-        case "message":
-            dest_user = data.get("dst")
-            src_user = data.get("src")
-            message = data.get("message")
-            reply["service"] = "message"
-            
-            if dest_user not in users:
-                reply["data"] = {"status": "erro", "message": "Usuário de destino não existe."}
-            else:
-                message_payload = {
-                    "src": src_user, "message": message,
-                    "timestamp": data.get("timestamp"), "clock": current_clock_for_reply
-                }
-                message_to_log = {
-                    "type": "private", "from_user": src_user, "to_user": dest_user,
-                    "message": message, "timestamp": data.get("timestamp")
-                }
-                save_message(message_to_log, MESSAGES_FILE)
-                replicate_request(request)
-                
-                topic = f"user:{dest_user}"
-                pub_socket.send_multipart([
-                    topic.encode('utf-8'),
-                    msgpack.packb(message_payload, default=str)
-                ])
-                reply["data"] = {"status": "OK", "message": "Mensagem privada enviada."}
+        case "login" | "channel" | "publish" | "message":
+            messages = []
+            reply_data, pending, wrote = execute_write(service, data, current_clock_for_reply, pub, messages)
+            if messages:
+                seq = store_messages(messages, pub)
+                if seq is not None:
+                    pending.append((message_log, seq))
+                else: # Nem publicada nem replicada: o cliente pode repetir
+                    reply_data, wrote = {"status": "erro", "message": "Falha ao gravar mensagem."}, False
+            if wrote:
+                replicate_request(request, current_clock_for_reply, reply_data)
+            reply = {"service": service, "data": reply_data}
+
+        case "batch":
+            reply = execute_batch(data, current_clock_for_reply, pub, pending)
 
         # --- LÓGICA DE LEITURA ---
-        # (users, channels)
-        
+        # (users, channels, history)
+
         case "users":
-            reply = {"service": "users", "data": {"users": list(users.keys())}}
+            reply = {"service": "users", "data": users_reply(data)}
+
+        case "presence":
+            # Keepalive: {"user", "status": "online"} (padrão) ou "offline" ao sair
+            user_name = data.get("user")
+            status = data.get("status", "online")
+            if user_name not in users:
+                reply = {"service": "presence", "data": {"status": "erro", "description": "Usuário não existe"}}
+            elif status not in ("online", "offline"):
+                reply = {"service": "presence", "data": {"status": "erro", "description": "Status deve ser 'online' ou 'offline'"}}
+            else:
+                mark_presence(user_name, status == "online")
+                reply = {"service": "presence", "data": {"status": "OK", "ttl": PRESENCE_TTL}}
 
         case "channels":
-            reply = {"service": "channels", "data": {"channels": list(channels.keys())}}
+            reply = {"service": "channels", "data": {"channels": channels.keys()}}
+
+        case "history":
+            # Canal: {"channel": X}. Privado: {"user": A, "peer": B}.
+            # Paginação para trás: {"before": <clock>} com o "next" da página anterior.
+            if data.get("channel") is not None:
+                key = history_key({"type": "channel", "channel": data.get("channel")})
+            else:
+                key = history_key({"type": "private", "from_user": data.get("user"), "to_user": data.get("peer")})
+
+            if key is None:
+                reply = {"service": "history", "data": {"status": "erro", "description": "Informe 'channel' ou 'user' e 'peer'"}}
+            else:
+                messages, next_cursor = history.page(
+                    key, before=data.get("before"), limit=int(data.get("limit") or DEFAULT_PAGE_SIZE)
+                )
+                reply = {"service": "history", "data": {"status": "OK", "messages": messages, "next": next_cursor}}
 
         case _:
             reply = {"service": "erro", "data": {"status": "erro", "description": "Serviço não encontrado"}}
 
-    # --- ENVIA A RESPOSTA REQ/REP ---
     if "data" not in reply:
         reply["data"] = {}
-    
-    reply["data"]["timestamp"] = datetime.now().isoformat()
-    reply["data"]["clock"] = current_clock_for_reply
+    reply["data"].setdefault("clock", current_clock_for_reply) # Um lote responde com o clock da última operação
+
+    return reply, pending
+
+def finish_reply(reply, pending):
+    """
+    Contrato de durabilidade: bloqueia até que o lote com as escritas da
+    requisição esteja gravado e só então completa a resposta.
+    """
+    try:
+        with DURABLE_WAIT_SECONDS.time():
+            for store, seq in pending:
+                store.wait_durable(seq)
+    except Exception as e:
+        log.error("Erro ao persistir: %r", e)
+        reply["data"] = {"status": "erro", "description": "Falha ao gravar no disco.", "clock": reply["data"]["clock"]}
+    return reply
+
+def busy_reply(service, wait):
+    """Recusa por sobrecarga: o cliente deve esperar `retry_after` ms antes de repetir."""
+    return {"service": service, "data": {"status": "busy", "description": "Servidor sobrecarregado, tente novamente",
+                                         "retry_after": max(1, int(wait * 1000)), "clock": tick()}}
+
+def admit_client(link, frames):
+    """
+    Limite por conexão de cliente, antes de a requisição entrar na fila dos
+    workers. Retorna None para admitir ou a resposta "busy" já serializada.
+    `frames` é [WORKER_REQUEST, identidade do cliente, ..., requisição].
+    """
+    wait = client_limiter.take((link.tag, frames[1]))
+    if not wait:
+        return None
+    REQUESTS_REJECTED.labels("client").inc()
+    try:
+        request, compact = decode(frames[-1])
+    except Exception:
+        request, compact = {}, False
+    return pack_reply(busy_reply(request.get("service"), wait), compact)
+
+def admit_service(request):
+    """Limite por serviço. Retorna None para admitir ou a resposta "busy"."""
+    limiter = service_limiters.get(request.get("service"))
+    wait = limiter.take(request.get("service")) if limiter is not None else 0
+    if not wait:
+        return None
+    REQUESTS_REJECTED.labels("service").inc()
+    merge_clock(request)
+    return busy_reply(request.get("service"), wait)
+
+def request_id_of(request):
+    """request_id de uma escrita, ou None (leituras e escritas sem id não são deduplicadas)."""
+    if request.get("service") not in DEDUP_SERVICES:
+        return None
+    request_id = request.get("data", {}).get("request_id")
+    return request_id if isinstance(request_id, str) and request_id else None
+
+def cacheable_reply(reply_data):
+    return {k: v for k, v in reply_data.items() if k not in ("clock", "timestamp")}
+
+def claim_request(request):
+    """
+    Reserva o request_id da requisição no cache de idempotência. Retorna
+    (request_id, None) quando ela deve ser executada, ou (None, resposta)
+    para uma repetição: a resposta guardada, com o clock atual, ou um erro
+    se a primeira ainda está em execução.
+    """
+    request_id = request_id_of(request)
+    if request_id is None:
+        return None, None
+    claimed, cached = dedup.claim(request_id)
+    if claimed:
+        return request_id, None
+    DEDUP_HITS.labels("client").inc()
+    merge_clock(request)
+    if cached is IN_PROGRESS:
+        return None, error_reply(request.get("service"), "Requisição repetida ainda em execução")
+    return None, {"service": request.get("service"), "data": {**cached, "clock": tick()}}
+
+def complete_request(request_id, reply):
+    """Guarda a resposta de uma escrita com request_id; uma falha libera o id para nova tentativa."""
+    if request_id is None:
+        return
+    if reply is None or reply["data"].get("status") == "erro":
+        dedup.release(request_id)
+    else:
+        dedup.complete(request_id, cacheable_reply(reply["data"]))
+
+def handle_request(request, pub):
+    """
+    Executa uma requisição de cliente e retorna a resposta (com clock; o
+    timestamp entra ao serializar, ver pack_reply).
+    Chamada concorrentemente pelas threads de worker; `pub` é o socket PUB da thread.
+    """
+    started = time.perf_counter()
+    reply = admit_service(request)
+    if reply is not None:
+        return reply
+    request_id, reply = claim_request(request)
+    if reply is None:
+        try:
+            reply, pending = execute_request(request, pub)
+            reply = finish_reply(reply, pending)
+        except Exception:
+            complete_request(request_id, None)
+            raise
+        complete_request(request_id, reply)
+    observe_request(request.get("service"), started)
+    return reply
+
+def observe_request(service, started):
+    # Serviços desconhecidos vão para um label só (o cliente não cria séries novas)
+    service = service if service in CLIENT_SERVICES else "desconhecido"
+    REQUESTS.labels(service).inc()
+    REQUEST_SECONDS.labels(service).observe(time.perf_counter() - started)
+
+def error_reply(service, description):
+    return {"service": service, "data": {"status": "erro", "description": description, "clock": tick()}}
+
+
+def client_worker_thread(worker_id):
+    """Worker do pool: recebe requisições do backend interno (inproc) e responde."""
+    rep_socket = context.socket(zmq.REP)
+    rep_socket.connect(WORKERS_ADDRESS)
+    pub = get_pub_socket()
+
+    while True:
+        try:
+            request_packed = rep_socket.recv()
+        except zmq.ContextTerminated:
+            return
+
+        compact = False
+        try:
+            request, compact = decode(request_packed)
+        except Exception as e:
+            request_log.error("Requisição inválida: %r", e)
+            reply = error_reply("erro", "Requisição inválida")
+        else:
+            try:
+                reply = handle_request(request, pub)
+            except Exception as e:
+                request_log.error("[Worker %d] Erro ao processar requisição: %r", worker_id, e)
+                reply = error_reply(request.get("service"), "Erro interno")
+
+        rep_socket.send(pack_reply(reply, compact))
+
+
+# --- Ligação com o Broker ---
+# O servidor conecta um DEALER no backend de cada broker, se anuncia com
+# READY (capacidade = NUM_WORKERS) e troca heartbeats; se um broker ficar
+# mudo por HEARTBEAT_LIVENESS intervalos, a conexão com ele é refeita.
+class BrokerLink:
+    """Conexão com um broker. `tag` (o índice) identifica de qual broker veio uma requisição."""
+
+    def __init__(self, ctx, index, address):
+        self.ctx = ctx
+        self.tag = bytes([index])
+        self.address = address
+        self.socket = None
+        self.connect()
+
+    def connect(self):
+        if self.socket is not None:
+            self.socket.close()
+        self.socket = self.ctx.socket(zmq.DEALER)
+        self.socket.setsockopt(zmq.LINGER, 0)
+        self.socket.connect(self.address)
+        self.alive()
+
+    def alive(self):
+        self.expiry = time.monotonic() + HEARTBEAT_INTERVAL * HEARTBEAT_LIVENESS
+
+def ready_frames():
+    return [WORKER_READY, msgpack.packb({"name": server_name, "capacity": NUM_WORKERS})]
+
+def broker_link_loop(backend_socket):
+    """
+    Repassa requisições dos brokers para os workers (inproc) e as respostas de
+    volta. A tag do broker vai como primeiro frame do envelope, e o REP a
+    devolve com a resposta.
+    """
+    links = [BrokerLink(context, i, address) for i, address in enumerate(broker_addresses)]
+    poller = zmq.Poller()
+    poller.register(backend_socket, zmq.POLLIN)
+    for link in links:
+        link.socket.send_multipart(ready_frames())
+        poller.register(link.socket, zmq.POLLIN)
+    next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+
+    while True:
+        timeout = max(0, next_heartbeat - time.monotonic())
+        socks = dict(poller.poll(timeout * 1000))
+
+        for link in links:
+            if link.socket in socks:
+                frames = link.socket.recv_multipart()
+                link.alive()
+                if frames[0] == WORKER_REQUEST:
+                    rejected = admit_client(link, frames)
+                    if rejected is None:
+                        backend_socket.send_multipart([link.tag] + frames[1:])
+                    else:
+                        link.socket.send_multipart([WORKER_REPLY] + frames[1:-1] + [rejected])
+
+        if backend_socket in socks:
+            tag, *frames = backend_socket.recv_multipart()
+            links[tag[0]].socket.send_multipart([WORKER_REPLY] + frames)
+
+        now = time.monotonic()
+        if now >= next_heartbeat:
+            for link in links:
+                if now > link.expiry:
+                    log.warning("Broker %s sem resposta, reconectando...", link.address)
+                    poller.unregister(link.socket)
+                    link.connect()
+                    poller.register(link.socket, zmq.POLLIN)
+                    link.socket.send_multipart(ready_frames())
+                else:
+                    link.socket.send(WORKER_HEARTBEAT)
+            next_heartbeat = now + HEARTBEAT_INTERVAL
+
+
+def run_threads():
+    # --- Inicia as Threads ---
+    p2p_thread = threading.Thread(target=p2p_listener_thread, daemon=True)
+    p2p_thread.start()
+
+    hb_thread = threading.Thread(target=heartbeat_thread, daemon=True)
+    hb_thread.start()
+
+    repl_thread = threading.Thread(target=replication_flusher_thread, daemon=True)
+    repl_thread.start()
+
+    threading.Thread(target=clock_sync_thread, daemon=True).start()
+    threading.Thread(target=message_retention_thread, daemon=True).start()
+    threading.Thread(target=presence_thread, daemon=True).start()
+
+    # --- Pool de Workers ---
+    # A ligação com o broker (DEALER) repassa as requisições para o backend
+    # DEALER interno, que as distribui entre os workers REP em paralelo.
+    backend_socket = context.socket(zmq.DEALER)
+    backend_socket.bind(WORKERS_ADDRESS)
+
+    for worker_id in range(NUM_WORKERS):
+        threading.Thread(target=client_worker_thread, args=(worker_id,), daemon=True).start()
+    # --- FIM ---
+
+    log.info("REQ/REP (%d workers) e PUB iniciado, aguardando clientes...", NUM_WORKERS)
+
+    broker_link_loop(backend_socket)
+
+
+# --- Modo asyncio (SERVER_RUNTIME=asyncio) ---
+# Mesma lógica do modo com threads, mas a recepção de clientes, P2P, replicação,
+# heartbeat, eleição e sincronia rodam como corrotinas em um único event loop.
+# A execução das requisições vai para um pool de NUM_WORKERS threads, como os
+# workers do modo com threads, e os anúncios (replicação aplicada no armazenamento)
+# para o executor padrão, um por vez e na ordem de chegada; as esperas pelo
+# disco também vão para o executor padrão.
+async_context = None
+event_loop = None
+client_executor = None
+
+def execute_request_in_pool(request):
+    """execute_request no pool de clientes, com o PUB da thread (sockets ZMQ não são thread-safe)."""
+    return execute_request(request, get_pub_socket())
+
+async def start_client_executor():
+    """Cria o pool e já sobe as suas threads, para os PUBs estarem conectados antes das requisições."""
+    global client_executor
+    client_executor = concurrent.futures.ThreadPoolExecutor(NUM_WORKERS, thread_name_prefix="cliente")
+    barrier = threading.Barrier(NUM_WORKERS)
+    warm_up = lambda: (get_pub_socket(), barrier.wait())
+    await asyncio.gather(*(event_loop.run_in_executor(client_executor, warm_up) for _ in range(NUM_WORKERS)))
+
+async def async_handle_client(link, envelope, request_packed):
+    loop = asyncio.get_running_loop()
+    compact = False
+    try:
+        request, compact = decode(request_packed)
+    except Exception as e:
+        request_log.error("Requisição inválida: %r", e)
+        reply = error_reply("erro", "Requisição inválida")
+    else:
+        started = time.perf_counter()
+        request_id = None
+        try:
+            reply = admit_service(request)
+            if reply is None:
+                request_id, reply = claim_request(request)
+            if reply is None:
+                reply, pending = await loop.run_in_executor(client_executor, execute_request_in_pool, request)
+                if pending:
+                    reply = await loop.run_in_executor(None, finish_reply, reply, pending)
+                else:
+                    reply = finish_reply(reply, pending)
+                complete_request(request_id, reply)
+            observe_request(request.get("service"), started)
+        except Exception as e:
+            request_log.error("Erro ao processar requisição: %r", e)
+            complete_request(request_id, None)
+            reply = error_reply(request.get("service"), "Erro interno")
+
+    # Usa o socket atual do link: a ligação pode ter sido refeita enquanto a requisição rodava
+    await link.socket.send_multipart([WORKER_REPLY] + envelope + [pack_reply(reply, compact)])
+
+async def async_client_loop():
+    """Recebe requisições dos brokers e trata cada uma em uma tarefa própria."""
+    links = [BrokerLink(async_context, i, address) for i, address in enumerate(broker_addresses)]
+    poller = zmq.asyncio.Poller()
+    for link in links:
+        await link.socket.send_multipart(ready_frames())
+        poller.register(link.socket, zmq.POLLIN)
+    next_heartbeat = time.monotonic() + HEARTBEAT_INTERVAL
+
+    log.info("REQ/REP (asyncio, pool de %d threads) e PUB iniciado, aguardando clientes...", NUM_WORKERS)
+
+    while True:
+        timeout = max(0, next_heartbeat - time.monotonic())
+        socks = dict(await poller.poll(timeout * 1000))
+        for link in links:
+            if link.socket not in socks:
+                continue
+            link.alive()
+            # Consome tudo o que já chegou antes de voltar ao poll
+            while True:
+                try:
+                    frames = await link.socket.recv_multipart(zmq.NOBLOCK)
+                except zmq.Again:
+                    break
+                if frames[0] == WORKER_REQUEST:
+                    rejected = admit_client(link, frames)
+                    if rejected is not None:
+                        await link.socket.send_multipart([WORKER_REPLY] + frames[1:-1] + [rejected])
+                        continue
+                    task = asyncio.create_task(async_handle_client(link, frames[1:-1], frames[-1]))
+                    _background_tasks.add(task)
+                    task.add_done_callback(_background_tasks.discard)
+
+        now = time.monotonic()
+        if now >= next_heartbeat:
+            for link in links:
+                if now > link.expiry:
+                    log.warning("Broker %s sem resposta, reconectando...", link.address)
+                    poller.unregister(link.socket)
+                    link.connect()
+                    poller.register(link.socket, zmq.POLLIN)
+                    await link.socket.send_multipart(ready_frames())
+                else:
+                    await link.socket.send(WORKER_HEARTBEAT)
+            next_heartbeat = now + HEARTBEAT_INTERVAL
+
+async def async_p2p_router_loop():
+    p2p_router_socket = async_context.socket(zmq.ROUTER)
+    p2p_router_socket.bind(f"tcp://*:{P2P_PORT}")
+    p2p_log.info("Listener P2P (ROUTER) iniciado em tcp://*:%d", P2P_PORT)
+
+    while True:
+        try:
+            *envelope, request_packed = await p2p_router_socket.recv_multipart()
+            request, compact = decode(request_packed)
+            if request.get("service") in P2P_BULK_SERVICES:
+                # Transferência lê do disco: vai para o executor e não atrasa eleição e relógio
+                task = asyncio.create_task(async_bulk_p2p_reply(p2p_router_socket, envelope, request, compact))
+                _background_tasks.add(task)
+                task.add_done_callback(_background_tasks.discard)
+                continue
+            await p2p_router_socket.send_multipart(envelope + [pack_reply(handle_p2p_request(request), compact)])
+        except Exception as e:
+            p2p_log.error("Erro no listener P2P: %r", e)
+
+async def async_bulk_p2p_reply(p2p_router_socket, envelope, request, compact):
+    try:
+        reply = await asyncio.get_running_loop().run_in_executor(None, handle_p2p_request, request)
+        await p2p_router_socket.send_multipart(envelope + [pack_reply(reply, compact)])
+    except Exception as e:
+        p2p_log.error("Erro no pedido P2P '%s': %r", request.get("service"), e)
+
+async def async_announcement_loop():
+    p2p_sub_socket = async_context.socket(zmq.SUB)
+    subscribe_announcements(p2p_sub_socket)
+    loop = asyncio.get_running_loop()
+
+    while True:
+        try:
+            topic_bytes, payload_packed = await p2p_sub_socket.recv_multipart()
+            # Um por vez: os lotes de replicação de uma origem são aplicados em ordem
+            await loop.run_in_executor(None, handle_announcement, topic_bytes.decode('utf-8'),
+                                       msgpack.unpackb(payload_packed, raw=False))
+        except Exception as e:
+            p2p_log.error("Erro no listener de anúncios: %r", e)
+
+async def async_request(socket, message, timeout):
+    """Envia `message` em um socket REQ assíncrono e espera a resposta por até `timeout` segundos."""
+    await socket.send(pack_request(message))
+    return unpack(await asyncio.wait_for(socket.recv(), timeout))
+
+async def async_heartbeat_loop():
+    def new_ref_socket():
+        socket = async_context.socket(zmq.REQ)
+        socket.setsockopt(zmq.LINGER, 0)
+        socket.connect(REFERENCE_ADDRESS)
+        return socket
+
+    ref_socket = new_ref_socket()
+    membership_socket = async_context.socket(zmq.SUB)
+    membership_socket.connect(REFERENCE_PUB_ADDRESS)
+    membership_socket.setsockopt_string(zmq.SUBSCRIBE, "membership")
+
+    log.info("Iniciando heartbeat (asyncio, a cada %.2f s)...", MEMBERSHIP_HEARTBEAT)
+    next_heartbeat = time.monotonic()
+
+    while True:
+        try:
+            if server_rank is None:
+                rank_req = build_message("rank", user=server_name, p2p_address=p2p_address)
+                handle_rank_reply(await async_request(ref_socket, rank_req, REFERENCE_TIMEOUT))
+                handle_list_reply(await async_request(ref_socket, build_message("list"), REFERENCE_TIMEOUT))
+                continue
+
+            timeout = max(0, next_heartbeat - time.monotonic())
+            if await membership_socket.poll(timeout * 1000):
+                stale = False
+                while True:
+                    try:
+                        _, payload = await membership_socket.recv_multipart(zmq.NOBLOCK)
+                    except zmq.Again:
+                        break
+                    stale |= handle_membership(msgpack.unpackb(payload, raw=False))
+                if stale:
+                    handle_list_reply(await async_request(ref_socket, build_message("list"), REFERENCE_TIMEOUT))
+
+            if time.monotonic() >= next_heartbeat:
+                reply = await async_request(ref_socket, build_message("heartbeat", user=server_name), REFERENCE_TIMEOUT)
+                merge_clock(reply)
+                if reply.get("data", {}).get("status") != "OK":
+                    rank_req = build_message("rank", user=server_name, p2p_address=p2p_address)
+                    handle_rank_reply(await async_request(ref_socket, rank_req, REFERENCE_TIMEOUT))
+                if coordinator_name == server_name:
+                    publish_coordinator()
+                next_heartbeat = time.monotonic() + MEMBERSHIP_HEARTBEAT
+        except Exception as e:
+            log.error("Erro no loop de heartbeat: %r", e)
+            ref_socket.close()
+            await asyncio.sleep(MEMBERSHIP_HEARTBEAT)
+            ref_socket = new_ref_socket()
+
+async def async_start_election():
+    """Bully Algorithm como corrotina. Quem chama já adquiriu election_in_progress."""
+    started = time.perf_counter()
+    try:
+        higher_rank_servers = [s for s in active_servers if s["rank"] > server_rank]
+        if not higher_rank_servers:
+            announce_new_coordinator()
+            return
+
+        election_log.info("Enviando 'election' para %d servidores com rank maior.", len(higher_rank_servers))
+        request = build_message("election", rank=server_rank)
+        pending = {asyncio.ensure_future(async_peer_request(server["address"], request, ELECTION_TIMEOUT))
+                   for server in higher_rank_servers}
+
+        responses = 0
+        deadline = asyncio.get_running_loop().time() + ELECTION_TIMEOUT
+        while pending and responses == 0:
+            remaining = deadline - asyncio.get_running_loop().time()
+            if remaining <= 0:
+                break
+            done, pending = await asyncio.wait(pending, timeout=remaining, return_when=asyncio.FIRST_COMPLETED)
+            for task in done:
+                if not task.exception() and task.result().get("data", {}).get("election") == "OK":
+                    responses += 1
+        for task in pending:
+            task.cancel()
+
+        finish_election(responses)
+
+    except Exception as e:
+        election_log.error("Erro durante a eleição: %r", e)
+    finally:
+        ELECTION_SECONDS.observe(time.perf_counter() - started)
+        election_in_progress.release()
+
+async def async_sync_clock_with_coordinator():
+    """Christian's Algorithm como corrotina (uma rodada)."""
+    address = clock_sync_target()
+    if not address:
+        return
+    samples = []
+    try:
+        for _ in range(CLOCK_SYNC_PROBES):
+            t0 = time.time_ns()
+            reply = await async_peer_request(address, build_message("clock"))
+            samples.append(clock_probe(t0, time.time_ns(), reply))
+    except Exception as e:
+        clock_log.error("Erro ao sincronizar relógio: %r", e)
+    apply_clock_samples(samples)
+
+async def async_clock_sync_loop():
+    while True:
+        await asyncio.sleep(CLOCK_SYNC_INTERVAL)
+        await async_sync_clock_with_coordinator()
+
+async def async_message_retention_loop():
+    loop = asyncio.get_running_loop()
+    while True:
+        await asyncio.sleep(MESSAGE_RETENTION_INTERVAL)
+        try:
+            await loop.run_in_executor(None, maintain_message_log)
+        except Exception as e:
+            log.error("Erro na retenção do log de mensagens: %r", e)
+
+async def async_presence_loop():
+    while True:
+        await asyncio.sleep(PRESENCE_INTERVAL)
+        try:
+            presence_tick()
+        except Exception as e:
+            log.error("Erro na presença: %r", e)
+
+async def async_replication_flusher():
+    next_heartbeat = time.monotonic() + REPL_HEARTBEAT
+    while True:
+        await asyncio.sleep(REPL_BATCH_DELAY)
+        try:
+            ops = replication_log.pop_batch()
+            if ops or time.monotonic() >= next_heartbeat:
+                publish_replication_batch(ops)
+                next_heartbeat = time.monotonic() + REPL_HEARTBEAT
+        except Exception as e:
+            repl_log.error("Erro ao publicar lote de replicação: %r", e)
+
+async def async_catch_up(origin, address, epoch):
+    try:
+        repl_log.info("Catch-up de '%s' a partir de %d", origin, replication_state.applied(origin) + 1)
+        while True:
+            reply = await async_peer_request(address, catch_up_request(origin))
+            if not apply_catch_up_reply(origin, epoch, reply):
+                break
+    except Exception as e:
+        repl_log.error("Erro no catch-up de '%s': %r", origin, e)
+    finally:
+        with _catch_up_lock:
+            _catching_up.discard(origin)
+
+async def run_asyncio():
+    global async_context, event_loop
+    async_context = zmq.asyncio.Context.shadow(context)
+    event_loop = asyncio.get_running_loop()
+    await start_client_executor()
+    await asyncio.gather(
+        async_client_loop(),
+        async_p2p_router_loop(),
+        async_announcement_loop(),
+        async_heartbeat_loop(),
+        async_replication_flusher(),
+        async_clock_sync_loop(),
+        async_message_retention_loop(),
+        async_presence_loop(),
+    )
+
+
+start_metrics_server()
+resolve_shards()
+bootstrap()
+with _internal_pub_lock:
+    _internal_pub_socket() # Conecta o PUB interno antes do primeiro anúncio
 
-    reply_packed = msgpack.packb(reply, default=str) 
-    rep_socket.send(reply_packed)
\ No newline at end of file
+if SERVER_RUNTIME == "asyncio":
+    asyncio.run(run_asyncio())
+else:
+    run_threads()
@@ -0,0 +1,119 @@
+# shards.py
+# Modo escalado do proxy e do broker: várias cópias (shards), cada uma em
+# seu processo, e o mapa delas guardado no referencia.
+#
+# - Proxy: os tópicos (canais e "user:<nome>") são divididos entre os
+#   shards por crc32(tópico) % N. Os servidores publicam cada mensagem só
+#   no shard dono do tópico (ShardedPublisher). Os clientes conectam o SUB
+#   em todos os shards: a inscrição chega a todos, mas cada mensagem só
+#   passa pelo dono, então não há duplicatas e o trabalho de fan-out se
+#   divide entre os processos.
+# - Broker: cada shard é um broker completo. Os servidores conectam-se a
+#   todos e os clientes podem usar qualquer um (ou todos: REQ e DEALER
+#   conectados em vários endereços alternam entre eles).
+#
+# Cada shard se anuncia ao referencia (serviço "shard") com índice,
+# quantidade e endereços; o serviço "shards" devolve o mapa.
+import threading
+import time
+import zlib
+from datetime import datetime
+
+import msgpack
+import zmq
+
+from logs import get_logger
+
+ANNOUNCE_INTERVAL = 2.0 # Segundos entre os anúncios de um shard ao referencia
+REQUEST_TIMEOUT = 2.0
+
+log = get_logger("shards")
+
+
+def shard_of(topic, count):
+    """Shard dono de um tópico (bytes): crc32 (IEEE) % count, fácil de reproduzir em outras linguagens."""
+    return zlib.crc32(topic) % count if count > 1 else 0
+
+
+def advertised(bind_address, host):
+    """Endereço de conexão a partir do de bind (tcp://*:porta -> tcp://host:porta)."""
+    return bind_address.replace("*", host, 1)
+
+
+class ShardedPublisher:
+    """
+    Um PUB por shard do proxy. send_multipart() escolhe o socket pelo tópico
+    (primeiro frame), então substitui um PUB comum no caminho de publicação.
+    Como um PUB, não é thread-safe: uma instância por thread.
+    """
+
+    def __init__(self, context, addresses):
+        self.sockets = []
+        for address in addresses:
+            socket = context.socket(zmq.PUB)
+            socket.connect(address)
+            self.sockets.append(socket)
+
+    def send_multipart(self, frames, flags=0):
+        self.sockets[shard_of(frames[0], len(self.sockets))].send_multipart(frames, flags)
+
+    def close(self):
+        for socket in self.sockets:
+            socket.close()
+
+
+def _request(context, address, service, data, timeout=REQUEST_TIMEOUT):
+    """Uma requisição REQ ao referencia; levanta zmq.Again sem resposta em `timeout` segundos."""
+    socket = context.socket(zmq.REQ)
+    socket.setsockopt(zmq.LINGER, 0)
+    socket.setsockopt(zmq.RCVTIMEO, int(timeout * 1000))
+    socket.connect(address)
+    try:
+        socket.send(msgpack.packb({"service": service, "data": {**data, "timestamp": datetime.now().isoformat(), "clock": 0}}))
+        return msgpack.unpackb(socket.recv(), raw=False).get("data", {})
+    finally:
+        socket.close()
+
+
+def announce_shard(context, reference_address, kind, index, count, addresses, interval=ANNOUNCE_INTERVAL):
+    """
+    Anuncia este shard ao referencia a cada `interval` segundos, em uma
+    thread própria (o referencia pode reiniciar ou subir depois do shard).
+    """
+    entry = {"kind": kind, "index": index, "count": count, **addresses}
+
+    def run():
+        announced = False
+        while True:
+            try:
+                _request(context, reference_address, "shard", entry)
+                if not announced:
+                    log.info("Shard %s %d/%d anunciado ao referencia: %s", kind, index, count, addresses)
+                    announced = True
+            except Exception as e:
+                log.warning("Falha ao anunciar o shard %s %d ao referencia: %r", kind, index, e)
+                announced = False
+            time.sleep(interval)
+
+    threading.Thread(target=run, name=f"shard-{kind}", daemon=True).start()
+
+
+def complete_shards(shard_map, kind, count):
+    """Entradas 0..count-1 do tipo `kind`, ou None se o mapa ainda não tem todas."""
+    entries = {e["index"]: e for e in shard_map.get(kind, []) if e.get("count") == count}
+    if len(entries) < count or any(i not in entries for i in range(count)):
+        return None
+    return [entries[i] for i in range(count)]
+
+
+def wait_for_shards(context, reference_address, kind, count, interval=1.0):
+    """Consulta o mapa ("shards") até os `count` shards de `kind` estarem anunciados."""
+    while True:
+        try:
+            entries = complete_shards(_request(context, reference_address, "shards", {}), kind, count)
+            if entries is not None:
+                return entries
+            log.info("Esperando os %d shards de %s se anunciarem ao referencia...", count, kind)
+        except Exception as e:
+            log.warning("Falha ao consultar os shards no referencia: %r", e)
+        time.sleep(interval)
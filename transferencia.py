@@ -0,0 +1,64 @@
+# transferencia.py
+# Transferência de estado (snapshot) em pedaços comprimidos entre servidores.
+import json
+import zlib
+
+import msgpack
+
+# Ordem em que as partes do estado são transferidas
+PARTS = ("users", "channels", "messages")
+DEFAULT_CHUNK_SIZE = 256 * 1024
+COMPRESS_LEVEL = 1 # Compressão rápida: o gargalo é a rede, não a CPU
+
+
+def first_cursor(message_end):
+    """Cursor do primeiro pedaço. `message_end` limita o log de mensagens ao ponto do snapshot."""
+    return {"part": PARTS[0], "index": 0, "end": message_end}
+
+
+def _next_part(cursor):
+    i = PARTS.index(cursor["part"]) + 1
+    return {"part": PARTS[i], "index": 0, "end": cursor["end"]} if i < len(PARTS) else None
+
+
+def read_chunk(cursor, stores, messages, chunk_size=DEFAULT_CHUNK_SIZE):
+    """
+    Lado do doador: lê o pedaço apontado por `cursor` e retorna
+    (pedaço comprimido, próximo cursor ou None no fim).
+
+    O doador não guarda estado entre pedaços: o cursor diz tudo. Usuários e
+    canais são enviados um shard por vez do KeyedStore (`stores[parte]`);
+    o log de mensagens (`messages`, um SegmentedLog) é lido a partir do
+    offset do cursor, em linhas inteiras, até o offset `end` registrado no
+    início da transferência.
+    Assim nunca existe uma segunda cópia completa do estado em memória.
+    """
+    part, index = cursor["part"], cursor["index"]
+
+    if part in ("users", "channels"):
+        store = stores[part]
+        payload = msgpack.packb(store.shard_items(index))
+        following = dict(cursor, index=index + 1) if index + 1 < store.shard_count else _next_part(cursor)
+        return zlib.compress(payload, COMPRESS_LEVEL), following
+
+    if part == "messages":
+        end = cursor["end"]
+        payload, offset = messages.read_lines(index, end, chunk_size) if index < end else (b"", end)
+        following = dict(cursor, index=offset) if payload and offset < end else _next_part(cursor)
+        return zlib.compress(payload, COMPRESS_LEVEL), following
+
+    raise ValueError(f"Parte desconhecida: {part}")
+
+
+def decode_chunk(part, chunk):
+    """
+    Lado de quem recebe: retorna os itens do pedaço.
+    Para "users"/"channels" uma lista de (chave, valor); para "messages" os
+    registros do log, em ordem.
+    """
+    payload = zlib.decompress(chunk)
+    if part in ("users", "channels"):
+        return [tuple(item) for item in msgpack.unpackb(payload, raw=False)]
+    if part == "messages":
+        return [json.loads(line) for line in payload.splitlines() if line]
+    raise ValueError(f"Parte desconhecida: {part}")